@@ -0,0 +1,110 @@
+import math
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+from analysis import PHASES, Summary
+from experiment_utils import timings_fmt
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Adaptive sequential sampling.
+
+With --adaptive, the runs of an experiment are planned in rounds (every browser/h3
+combination once per round, shuffled within the round) up to --runs rounds. Before each
+run, the combination's samples of the metric so far are checked: once it has at least
+`min_runs` successful runs and the half-width of the 95% confidence interval of the mean is
+within `target_error` of the mean, its remaining runs are skipped. Stable combinations
+stop after a few rounds, noisy ones keep going up to --runs.
+"""
+
+# executed instead of a run that is not needed anymore
+SKIP_RUN = "UPDATE plan SET completed = 2 WHERE runID = ?"
+
+# two-sided 95% quantiles of Student's t distribution, by degrees of freedom
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def t_95(df: int) -> float:
+    if df <= len(T_95):
+        return T_95[df - 1]
+    # first order expansion around the normal quantile
+    return 1.96 + 2.37 / df
+
+
+"""
+Return the (end, start) columns of the given metric: a phase of analysis.PHASES,
+or two timing columns separated by a minus, e.g. responseEnd-requestStart
+"""
+def parse_metric(metric: str) -> Tuple[str, str]:
+    if metric in PHASES:
+        return PHASES[metric]
+    end, _, start = metric.replace(" ", "").partition("-")
+    if end not in timings_fmt or start not in timings_fmt:
+        raise ValueError(f"Unknown metric: {metric}")
+    return end, start
+
+
+class AdaptiveSampler():
+    def __init__(self, metric: str, target_error: float, min_runs: int):
+        self.metric = metric
+        self.end, self.start = parse_metric(metric)
+        self.target_error = target_error
+        self.min_runs = max(min_runs, 2)
+        # (browser, h3): samples of the metric
+        self.summaries: Dict[Tuple[str, bool], Summary] = {}
+        self.done: Dict[Tuple[str, bool], bool] = {}
+
+    """
+    Add the results of a run; failed runs have no sample
+    """
+    def add(self, browser: str, h3: bool, results: dict):
+        end, start = results.get(self.end), results.get(self.start)
+        if results.get("error") or not isinstance(end, (int, float)) or not isinstance(start, (int, float)):
+            return
+        self.summaries.setdefault((browser, h3), Summary()).add(end - start)
+
+    """
+    Return the relative half-width of the 95% confidence interval of the combination's mean,
+    None while it has less than `min_runs` samples
+    """
+    def relative_error(self, browser: str, h3: bool) -> Optional[float]:
+        summary = self.summaries.get((browser, h3))
+        if summary is None or summary.count < self.min_runs:
+            return None
+        half_width = t_95(summary.count - 1) * math.sqrt(summary.variance() / summary.count)
+        if summary.mean == 0:
+            return 0.0 if half_width == 0 else math.inf
+        return half_width / abs(summary.mean)
+
+    """
+    Return True if the combination needs no more runs
+    """
+    def converged(self, browser: str, h3: bool) -> bool:
+        if self.done.get((browser, h3)):
+            return True
+        error = self.relative_error(browser, h3)
+        if error is None or error > self.target_error:
+            return False
+        summary = self.summaries[(browser, h3)]
+        logger.info(f"{browser} {'h3' if h3 else 'h2'}: {self.metric} converged after {summary.count} runs "
+                    f"({summary.mean:.1f} ms +/- {error * 100:.1f}%)")
+        self.done[(browser, h3)] = True
+        return True
+
+    """
+    Add the results of the runs of the experiment that are already in the database,
+    when resuming it
+    """
+    def load(self, out: str, experiment_id: int):
+        db = sqlite3.connect(out, timeout=30)
+        try:
+            rows = db.execute(f"SELECT browser, httpVersion, error, {self.end}, {self.start} FROM timings WHERE experimentID = ?",
+                              (str(experiment_id),)).fetchall()
+        finally:
+            db.close()
+        for browser, version, error, end, start in rows:
+            self.add(browser, version == "h3", {"error": error, self.end: end, self.start: start})
@@ -0,0 +1,286 @@
+import argparse
+import csv
+import json
+import math
+import sqlite3
+import sys
+from typing import Dict, List, Tuple
+
+"""
+Incremental analysis of the timings table.
+
+Rows are read from the database in chunks of increasing rowid, starting after the last
+row seen by the previous update, and folded into one summary per group (browser, server,
+condition, payload, httpVersion) and phase. A summary keeps the count, mean and variance
+(Welford) and a quantile sketch; all of them can be merged, so updating only costs the new
+rows, and groups can be combined afterwards without going back to the rows. The summaries
+and the position of the last row are stored in the database next to the results
+(analysis_summaries and analysis_cursor), so every update only reads the new experiments.
+"""
+
+GROUP_COLUMNS = ["browser", "server", "netemParams", "payloadSize", "httpVersion"]
+
+# phase name: (end, start) columns of the navigation timing, same phases as visualization.py
+PHASES = {
+    "App_Fetch": ("domainLookupStart", "fetchStart"),
+    "DNC_Lookup": ("domainLookupEnd", "domainLookupStart"),
+    "Secure_Connection_Start": ("secureConnectionStart", "connectStart"),
+    "TCP_Connection": ("connectEnd", "connectStart"),
+    "Request": ("responseStart", "requestStart"),
+    "Response": ("responseEnd", "responseStart"),
+    "Processing": ("domComplete", "responseEnd"),
+    "Onload": ("loadEventEnd", "loadEventStart"),
+    "Page_Load": ("domInteractive", "startTime"),
+}
+
+CHUNK_SIZE = 10000
+# relative accuracy of the quantiles
+SKETCH_ACCURACY = 0.01
+
+
+"""
+Mergeable quantile sketch with relative accuracy (as in DDSketch): values are counted in
+logarithmically sized buckets, so any quantile is within `accuracy` of the true value and
+two sketches merge by adding their bucket counts. Negative values (e.g. a phase whose start
+is 0 because it was skipped) are counted in mirrored buckets, zeros on their own.
+"""
+class QuantileSketch():
+    def __init__(self, accuracy: float = SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+
+    def key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    # value in the middle of the bucket, within `accuracy` of every value of the bucket
+    def value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (1 + self.gamma)
+
+    def add(self, value: float):
+        if value > 0:
+            key = self.key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < 0:
+            key = self.key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def merge(self, other: "QuantileSketch"):
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    """
+    Return the (value, cumulative fraction) points of the CDF, in increasing order of value
+    """
+    def cdf(self) -> List[Tuple[float, float]]:
+        points = []
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            points.append((-self.value(key), seen / self.count))
+        if self.zeros:
+            seen += self.zeros
+            points.append((0.0, seen / self.count))
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            points.append((self.value(key), seen / self.count))
+        return points
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        cdf = self.cdf()
+        for value, fraction in cdf:
+            if fraction * self.count > rank:
+                return value
+        return cdf[-1][0]
+
+    def to_dict(self) -> dict:
+        return {"accuracy": self.accuracy, "positive": self.positive, "negative": self.negative, "zeros": self.zeros}
+
+    @staticmethod
+    def from_dict(data: dict) -> "QuantileSketch":
+        sketch = QuantileSketch(data["accuracy"])
+        sketch.positive = {int(key): count for key, count in data["positive"].items()}
+        sketch.negative = {int(key): count for key, count in data["negative"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = sketch.zeros + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+
+
+"""
+Count, mean, variance, min and max (Welford's algorithm, merged with Chan et al.'s formula)
+and a quantile sketch of one metric
+"""
+class Summary():
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch()
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+
+    def merge(self, other: "Summary"):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max,
+                "sketch": self.sketch.to_dict()}
+
+    @staticmethod
+    def from_dict(data: dict) -> "Summary":
+        summary = Summary()
+        summary.count, summary.mean, summary.m2 = data["count"], data["mean"], data["m2"]
+        summary.min, summary.max = data["min"], data["max"]
+        summary.sketch = QuantileSketch.from_dict(data["sketch"])
+        return summary
+
+
+"""
+The runs and errors of one group, and a summary per phase of its successful runs
+"""
+class GroupStats():
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.phases: Dict[str, Summary] = {phase: Summary() for phase in PHASES}
+
+    def merge(self, other: "GroupStats"):
+        self.runs += other.runs
+        self.errors += other.errors
+        for phase, summary in other.phases.items():
+            self.phases[phase].merge(summary)
+
+
+class StreamingAnalysis():
+    def __init__(self, database: str):
+        self.db = sqlite3.connect(database, timeout=30)
+        self.db.execute("CREATE TABLE IF NOT EXISTS analysis_cursor (lastRowid INT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS analysis_summaries (groupKey TEXT PRIMARY KEY, summary TEXT)")
+        self.db.commit()
+        row = self.db.execute("SELECT lastRowid FROM analysis_cursor").fetchone()
+        self.last_rowid = row[0] if row else 0
+        self.groups: Dict[tuple, GroupStats] = {}
+        for key, data in self.db.execute("SELECT groupKey, summary FROM analysis_summaries"):
+            data = json.loads(data)
+            stats = GroupStats()
+            stats.runs, stats.errors = data["runs"], data["errors"]
+            stats.phases = {phase: Summary.from_dict(summary) for phase, summary in data["phases"].items()}
+            self.groups[tuple(json.loads(key))] = stats
+
+    """
+    Fold the timings rows added since the last update into the summaries, chunk by chunk,
+    and store the summaries. Return the number of new rows.
+    """
+    def update(self, chunk_size: int = CHUNK_SIZE) -> int:
+        columns = sorted({column for phase in PHASES.values() for column in phase})
+        query = f"SELECT rowid, error, {', '.join(GROUP_COLUMNS + columns)} FROM timings WHERE rowid > ? ORDER BY rowid LIMIT ?"
+        changed = set()
+        new_rows = 0
+        while True:
+            rows = self.db.execute(query, (self.last_rowid, chunk_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                key = tuple(row[2:2 + len(GROUP_COLUMNS)])
+                values = dict(zip(columns, row[2 + len(GROUP_COLUMNS):]))
+                stats = self.groups.setdefault(key, GroupStats())
+                stats.runs += 1
+                changed.add(key)
+                if row[1]:
+                    stats.errors += 1
+                    continue
+                for phase, (end, start) in PHASES.items():
+                    if isinstance(values[end], (int, float)) and isinstance(values[start], (int, float)):
+                        stats.phases[phase].add(values[end] - values[start])
+            self.last_rowid = rows[-1][0]
+            new_rows += len(rows)
+        self.save(changed)
+        return new_rows
+
+    def save(self, changed):
+        with self.db:
+            for key in changed:
+                stats = self.groups[key]
+                data = {"runs": stats.runs, "errors": stats.errors,
+                        "phases": {phase: summary.to_dict() for phase, summary in stats.phases.items()}}
+                self.db.execute("INSERT OR REPLACE INTO analysis_summaries VALUES (?, ?)", (json.dumps(key), json.dumps(data)))
+            self.db.execute("DELETE FROM analysis_cursor")
+            self.db.execute("INSERT INTO analysis_cursor VALUES (?)", (self.last_rowid,))
+
+    """
+    Merge the groups over the columns not in `by`; return a dict from the values of the
+    `by` columns to the merged stats
+    """
+    def grouped(self, by: List[str] = GROUP_COLUMNS) -> Dict[tuple, GroupStats]:
+        indices = [GROUP_COLUMNS.index(column) for column in by]
+        merged: Dict[tuple, GroupStats] = {}
+        for key, stats in self.groups.items():
+            merged.setdefault(tuple(key[i] for i in indices), GroupStats()).merge(stats)
+        return merged
+
+    """
+    Return one row per group and phase: the group, phase, runs, errors, count, mean,
+    standard deviation and the given percentiles
+    """
+    def percentile_table(self, percentiles: List[float], by: List[str] = GROUP_COLUMNS) -> List[list]:
+        table = []
+        for key, stats in sorted(self.grouped(by).items(), key=lambda item: str(item[0])):
+            for phase, summary in stats.phases.items():
+                table.append(list(key) + [phase, stats.runs, stats.errors, summary.count, summary.mean,
+                             math.sqrt(summary.variance())] + [summary.sketch.quantile(p / 100) for p in percentiles])
+        return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="incrementally summarize the timings of a results database")
+    parser.add_argument("database", metavar="DB", help="results database")
+    parser.add_argument("--by", nargs="+", default=GROUP_COLUMNS, choices=GROUP_COLUMNS,
+                        help="columns to group by (default: all of them)")
+    parser.add_argument("--percentiles", "-p", nargs="+", type=float, default=[50, 90, 99],
+                        help="percentiles to report")
+    parser.add_argument("--output", "-o", metavar="FILE", help="save the percentile table to FILE as csv")
+    args = parser.parse_args()
+
+    analysis = StreamingAnalysis(args.database)
+    new_rows = analysis.update()
+    print(f"{new_rows} new rows", file=sys.stderr)
+    header = args.by + ["phase", "runs", "errors", "count", "mean", "std"] + [f"p{p:g}" for p in args.percentiles]
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(header)
+    writer.writerows(analysis.percentile_table(args.percentiles, args.by))
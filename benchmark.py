@@ -0,0 +1,319 @@
+"""Harness Self-Benchmark
+
+Measures how long each stage of a page-load run takes in the harness itself, against the
+local reference server (see local_server.py) and without any network condition applied.
+The runs go through the same entry points as the experiments (`launch_browser_sync` /
+`launch_browser_async` with a browser pool and a RunResourceTracker, results queued to a
+ThreadedWriter), and the stages are the spans they record (see tracing.py): acquiring the
+browser, new_context, new_page, goto, the timing evaluate, closing the context, releasing
+the browser, tracking the run's resources and queueing its results. Closing the writer
+(writing the queued rows to SQLite), the process monitoring of systemUtil (discovering and
+sampling the browser processes) and, with --tc, applying and resetting the qdiscs are
+measured outside of the runs, like they happen outside of them in an experiment.
+
+Every browser is measured in sync mode, and in async mode with each of the given
+throughputs, both launching a browser for every run (cold) and reusing the browsers of a
+BrowserPool (warm). The latency distribution of every stage, the runs per second and the
+failed runs of every mode are printed and saved as JSON, which `compare` checks against a
+baseline: a stage whose median got slower, or a mode whose runs per second dropped, by
+more than the threshold, or a mode with more failed runs, is reported as a regression
+(and the exit code is 1).
+
+Usage:
+    benchmark.py run [--browsers BROWSERS ...] [--runs RUNS] [--throughputs THROUGHPUTS ...] [--launches LAUNCHES ...] [--payload PAYLOAD] [--out OUT] [--device DEVICE] [--tc]
+    benchmark.py compare BASELINE CURRENT [--threshold PERCENT]
+
+Options:
+    -h --help                   Show this screen
+    --browsers BROWSERS         Browsers to benchmark [default: chromium edge firefox]
+    --runs RUNS                 Page loads per browser and mode [default: 20]
+    --throughputs THROUGHPUTS   Throughputs of the async mode [default: 1 4 8]
+    --launches LAUNCHES         Browser launch modes to measure, cold and/or warm [default: cold warm]
+    --payload PAYLOAD           Payload of the local reference server to load [default: 1kb]
+    --out OUT                   File to save the results to [default: results/benchmark.json]
+    --device DEVICE             Device the qdiscs are applied to with --tc, and the runs' traffic is counted on [default: lo]
+    --tc                        Also measure applying and resetting a network condition (needs sudo)
+    --threshold PERCENT         Slowdown reported as a regression [default: 10]
+"""
+
+import os, sys, json, time, socket, asyncio, platform, tempfile, subprocess
+from contextlib import contextmanager
+from typing import Dict, List
+from docopt import docopt
+from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
+
+from endpoint import Endpoint
+from launchBrowserSync import launch_browser_sync
+from launchBrowserAsync import launch_browser_async
+from browser_pool import BrowserPool, AsyncBrowserPool
+from run_resources import RunResourceTracker
+from experiment_utils import ThreadedWriter, insert_statement, timing_row, run_resources_row
+from local_server import start_local_server
+from systemUtil import ProcessSampler, CLIENT_PROCS
+from qdisc import QdiscManager
+from tracing import tracer, span, run_context
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+# condition applied and reset by the tc stages, it is never active during a page load
+TC_CONDITION = "4g-lte-good"
+PERCENTILES = [50, 90, 99]
+# experiment ID of the benchmark's runs and spans
+EXPERIMENT_ID = "benchmark"
+
+
+"""
+Latencies of the stages of the runs, in milliseconds, and the errors of the failed runs.
+The span a run failed in is not timed.
+"""
+class StageTimes():
+    def __init__(self):
+        self.times: Dict[str, List[float]] = {}
+        self.failures: List[dict] = []
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.times.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+
+    """
+    Add the spans the harness recorded for the benchmark's runs
+    """
+    def add_spans(self, rows: List[tuple]):
+        for experiment_id, _, _, _, name, start, end, _, _, error in rows:
+            if experiment_id == EXPERIMENT_ID and error is None:
+                self.times.setdefault(name, []).append((end - start) * 1000)
+
+    def fail(self, run_id: int, error):
+        logger.warning(f"Run {run_id} failed: {error}")
+        self.failures.append({"runID": run_id, "error": str(error)})
+
+
+"""
+Return the count, mean, min, max and percentiles of the given latencies
+"""
+def distribution(times: List[float]) -> Dict[str, float]:
+    ordered = sorted(times)
+    result = {"count": len(ordered), "mean": sum(ordered) / len(ordered), "min": ordered[0], "max": ordered[-1]}
+    for p in PERCENTILES:
+        result[f"p{p}"] = ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return result
+
+
+"""
+Return the rows an experiment writes for the results of a run
+"""
+def result_statements(h3: bool, browser_type: str, endpoint: Endpoint, run_id: int, results: dict) -> list:
+    resources = results.pop("resources", None)
+    results.pop("entries", None)
+    results.update(experimentID=EXPERIMENT_ID, runID=run_id, browser=browser_type, url=endpoint.get_url(),
+                   httpVersion="h3" if h3 else "h2", netemParams="none", payloadSize=endpoint.get_payload())
+    statements = [(insert_statement("timings"), timing_row(results))]
+    if resources:
+        resources.update(experimentID=EXPERIMENT_ID, browser=browser_type)
+        statements.append((insert_statement("run_resources"), run_resources_row(resources)))
+    return statements
+
+
+"""
+Stages that happen outside of the runs of an experiment: process monitoring, which systemUtil
+does in its own process, and optionally applying and resetting a network condition, once
+per experiment
+"""
+def harness_stages(stages: StageTimes, runs: int, sampler: ProcessSampler, qdisc: QdiscManager):
+    for _ in range(runs):
+        with stages.time("monitor_discover"):
+            sampler.discover()
+        with stages.time("monitor_sample"):
+            sampler.sample()
+        if qdisc:
+            with stages.time("tc_apply"):
+                qdisc.apply(TC_CONDITION)
+            with stages.time("tc_reset"):
+                qdisc.reset()
+
+
+def new_writer() -> ThreadedWriter:
+    return ThreadedWriter(os.path.join(tempfile.mkdtemp(), "benchmark.db"))
+
+
+"""
+Close the writer of a mode, which writes its queued rows
+"""
+def close_writer(stages: StageTimes, writer: ThreadedWriter):
+    with stages.time("sqlite_close"):
+        writer.close()
+
+
+def run_sync(pw_instance, browser_type: str, endpoint: Endpoint, runs: int, pool: BrowserPool, tracker: RunResourceTracker) -> dict:
+    stages = StageTimes()
+    writer = new_writer()
+    tracer.drain()
+    start = time.perf_counter()
+    for run_id in range(runs):
+        h3 = run_id % 2 == 0
+        with run_context(EXPERIMENT_ID, run_id), stages.time("run"):
+            try:
+                results = launch_browser_sync(pw_instance, browser_type, h3, endpoint, False, False, False,
+                                              EXPERIMENT_ID, run_id, pool, tracker)
+            except Exception as e:
+                results = {"error": str(e)}
+            if results.get("error"):
+                stages.fail(run_id, results["error"])
+            with span("record"):
+                writer.execute_group(result_statements(h3, browser_type, endpoint, run_id, results))
+    elapsed = time.perf_counter() - start
+    pool.close()
+    close_writer(stages, writer)
+    stages.add_spans(tracer.drain())
+    return {"runs_per_sec": (runs - len(stages.failures)) / elapsed, "stages": stages}
+
+
+async def run_async(pw_instance, browser_type: str, endpoint: Endpoint, runs: int, throughput: int, pool: AsyncBrowserPool,
+                    tracker: RunResourceTracker) -> dict:
+    stages = StageTimes()
+    writer = new_writer()
+    tracer.drain()
+    queue = asyncio.Queue()
+    for run_id in range(runs):
+        queue.put_nowait(run_id)
+
+    async def worker():
+        while not queue.empty():
+            run_id = queue.get_nowait()
+            h3 = run_id % 2 == 0
+            with run_context(EXPERIMENT_ID, run_id), stages.time("run"):
+                try:
+                    results = await launch_browser_async(pw_instance, browser_type, h3, endpoint, False, False, False,
+                                                         EXPERIMENT_ID, run_id, pool, tracker)
+                except Exception as e:
+                    results = {"error": str(e)}
+                if results.get("error"):
+                    stages.fail(run_id, results["error"])
+                with span("record"):
+                    await writer.execute_group_async(result_statements(h3, browser_type, endpoint, run_id, results))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(throughput, runs))])
+    elapsed = time.perf_counter() - start
+    await pool.close()
+    close_writer(stages, writer)
+    stages.add_spans(tracer.drain())
+    return {"runs_per_sec": (runs - len(stages.failures)) / elapsed, "stages": stages}
+
+
+def summarize(result: dict) -> dict:
+    return {"runs_per_sec": result["runs_per_sec"],
+            "stages": {stage: distribution(times) for stage, times in result["stages"].times.items()},
+            "failed": len(result["stages"].failures),
+            "failures": result["stages"].failures}
+
+
+def run_benchmark(browsers: List[str], runs: int, throughputs: List[int], launches: List[str], payload: str, device: str,
+                  tc: bool) -> dict:
+    server = start_local_server()
+    endpoint = Endpoint(None, "local-ref", payload)
+    tracker = RunResourceTracker(device)
+    qdisc = QdiscManager(device) if tc else None
+    results = {}
+    try:
+        with sync_playwright() as pw_instance:
+            for launch in launches:
+                for browser_type in browsers:
+                    logger.info(f"sync-{launch} {browser_type}")
+                    result = run_sync(pw_instance, browser_type, endpoint, runs, BrowserPool(cold=launch == "cold"), tracker)
+                    results[f"sync-{launch}/{browser_type}"] = summarize(result)
+
+        async def run_all_async():
+            async with async_playwright() as pw_instance:
+                for launch in launches:
+                    for throughput in throughputs:
+                        for browser_type in browsers:
+                            logger.info(f"async-{throughput}-{launch} {browser_type}")
+                            result = await run_async(pw_instance, browser_type, endpoint, runs, throughput,
+                                                     AsyncBrowserPool(cold=launch == "cold"), tracker)
+                            results[f"async-{throughput}-{launch}/{browser_type}"] = summarize(result)
+        asyncio.run(run_all_async())
+
+        stages = StageTimes()
+        harness_stages(stages, runs, ProcessSampler(CLIENT_PROCS), qdisc)
+        results["harness"] = summarize({"runs_per_sec": 0, "stages": stages})
+    finally:
+        if qdisc:
+            qdisc.reset()
+        if server:
+            server.terminate()
+    return {
+        "meta": {
+            "time": time.time(),
+            "git": subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True).stdout.strip(),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "runs": runs,
+            "payload": payload,
+        },
+        "results": results,
+    }
+
+
+def print_results(benchmark: dict):
+    for mode, result in benchmark["results"].items():
+        print(f"{mode}: {result['runs_per_sec']:.2f} runs/sec, {result['failed']} failed")
+        for stage, dist in result["stages"].items():
+            percentiles = " ".join(f"p{p}={dist[f'p{p}']:.1f}" for p in PERCENTILES)
+            print(f"    {stage:<18} mean={dist['mean']:.1f} {percentiles} (ms)")
+
+
+"""
+Print the changes from the baseline to the current results. Return the regressions.
+"""
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    regressions = []
+    for mode, result in current["results"].items():
+        base = baseline["results"].get(mode)
+        if base is None:
+            continue
+        # the harness stages have no runs per second, and a baseline mode may have had no successful run
+        change = (result["runs_per_sec"] / base["runs_per_sec"] - 1) * 100 if base["runs_per_sec"] else 0
+        print(f"{mode}: {base['runs_per_sec']:.2f} -> {result['runs_per_sec']:.2f} runs/sec ({change:+.1f}%)")
+        if change < -threshold:
+            regressions.append(f"{mode} runs/sec")
+        if result["failed"] > base.get("failed", 0):
+            print(f"    failed runs: {base.get('failed', 0)} -> {result['failed']}")
+            regressions.append(f"{mode} failed runs")
+        for stage, dist in result["stages"].items():
+            if stage not in base["stages"]:
+                continue
+            before, after = base["stages"][stage]["p50"], dist["p50"]
+            change = (after / before - 1) * 100 if before else 0
+            print(f"    {stage:<18} p50 {before:.1f} -> {after:.1f} ms ({change:+.1f}%)")
+            if change > threshold:
+                regressions.append(f"{mode} {stage}")
+    return regressions
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = docopt(__doc__)
+    if args['run']:
+        benchmark = run_benchmark(args['--browsers'], int(args['--runs']), [int(t) for t in args['--throughputs']],
+                                  args['--launches'], args['--payload'], args['--device'], args['--tc'])
+        print_results(benchmark)
+        out = args['--out']
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(benchmark, f, indent=2)
+        logger.info(f"Saved to {out}")
+    elif args['compare']:
+        with open(args['BASELINE']) as f:
+            baseline = json.load(f)
+        with open(args['CURRENT']) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, float(args['--threshold']))
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
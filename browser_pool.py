@@ -0,0 +1,165 @@
+import asyncio, uuid
+from typing import Callable, Dict, Tuple, TYPE_CHECKING
+from playwright.sync_api import Browser
+from playwright.async_api import Browser as AsyncBrowser
+
+if TYPE_CHECKING:
+    from endpoint import Endpoint
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+A pool of warm browsers, one per launch configuration.
+
+Launching a browser dominates the wall-clock time of a run for small payloads,
+so by default the pool keeps one browser per configuration alive for the whole
+experiment and every run gets its own fresh context instead. Since the launch
+arguments depend on the browser, h3, qlog/pcap flags, the endpoint (h3 origin
+and port) and the experiment (qlog/keys directories), the configuration key is
+built from all of them by `pool_key`.
+
+Every browser is launched with a unique marker (see run_resources.browser_env), so that
+its processes can be told apart from the other browsers'; `marker_of` returns it.
+`launch_run_of` returns the run a browser was launched for, which names its key log.
+
+With `cold=True` the pool keeps the old behaviour of launching a new browser
+for every run and closing it afterwards, for studies that need cold starts.
+Note that browsers may keep connections alive across contexts, so warm runs
+after the first one of a configuration can skip connection setup.
+"""
+
+PoolKey = Tuple[str, bool, bool, bool, str, int]
+
+
+"""
+Return a new unique browser marker
+"""
+def new_marker() -> str:
+    return uuid.uuid4().hex
+
+"""
+Build the key identifying browsers that can be shared between runs
+"""
+def pool_key(
+    browser_type: str,
+    h3: bool,
+    qlog: bool,
+    pcap: bool,
+    endpoint: "Endpoint",
+    expnt_id: int,
+) -> PoolKey:
+    return (browser_type, h3, qlog, pcap, f"{endpoint.get_domain()}:{endpoint.get_port()}", expnt_id)
+
+
+class BrowserPool():
+    def __init__(self, cold: bool = False):
+        self.cold = cold
+        self.browsers: Dict[PoolKey, Browser] = {}
+        self.markers: Dict[int, str] = {}
+        self.launch_runs: Dict[int, int] = {}
+
+    """
+    Return a browser for the given key, calling `launch(marker)` for the given run only when
+    there is no connected browser for that key yet (or always, in cold mode).
+    `launch` returns None if the browser failed to launch.
+    """
+    def acquire(self, key: PoolKey, launch: Callable, run_id: int = None) -> Browser:
+        if self.cold:
+            return self.launch(launch, run_id)
+        browser = self.browsers.get(key)
+        if browser is None or not browser.is_connected():
+            browser = self.launch(launch, run_id)
+            if browser:
+                self.browsers[key] = browser
+        return browser
+
+    def launch(self, launch: Callable, run_id: int = None) -> Browser:
+        marker = new_marker()
+        browser = launch(marker)
+        if browser:
+            self.markers[id(browser)] = marker
+            self.launch_runs[id(browser)] = run_id
+        return browser
+
+    def marker_of(self, browser: Browser) -> str:
+        return self.markers.get(id(browser))
+
+    def launch_run_of(self, browser: Browser) -> int:
+        return self.launch_runs.get(id(browser))
+
+    """
+    Hand a browser back after a run. Only cold browsers are closed here,
+    warm ones stay open until `close`.
+    """
+    def release(self, browser: Browser) -> None:
+        if self.cold:
+            self.markers.pop(id(browser), None)
+            self.launch_runs.pop(id(browser), None)
+            browser.close()
+
+    """
+    Close all the warm browsers, e.g. at the end of an experiment
+    """
+    def close(self) -> None:
+        for browser in self.browsers.values():
+            try:
+                browser.close()
+            except Exception as e:
+                logger.error(str(e))
+        self.browsers = {}
+        self.markers = {}
+        self.launch_runs = {}
+
+
+class AsyncBrowserPool():
+    def __init__(self, cold: bool = False):
+        self.cold = cold
+        self.browsers: Dict[PoolKey, AsyncBrowser] = {}
+        self.markers: Dict[int, str] = {}
+        self.launch_runs: Dict[int, int] = {}
+        # concurrent runs with the same key must not launch the same browser twice
+        self.locks: Dict[PoolKey, asyncio.Lock] = {}
+
+    async def acquire(self, key: PoolKey, launch: Callable, run_id: int = None) -> AsyncBrowser:
+        if self.cold:
+            return await self.launch(launch, run_id)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            browser = self.browsers.get(key)
+            if browser is None or not browser.is_connected():
+                browser = await self.launch(launch, run_id)
+                if browser:
+                    self.browsers[key] = browser
+        return browser
+
+    async def launch(self, launch: Callable, run_id: int = None) -> AsyncBrowser:
+        marker = new_marker()
+        browser = await launch(marker)
+        if browser:
+            self.markers[id(browser)] = marker
+            self.launch_runs[id(browser)] = run_id
+        return browser
+
+    def marker_of(self, browser: AsyncBrowser) -> str:
+        return self.markers.get(id(browser))
+
+    def launch_run_of(self, browser: AsyncBrowser) -> int:
+        return self.launch_runs.get(id(browser))
+
+    async def release(self, browser: AsyncBrowser) -> None:
+        if self.cold:
+            self.markers.pop(id(browser), None)
+            self.launch_runs.pop(id(browser), None)
+            await browser.close()
+
+    async def close(self) -> None:
+        for browser in self.browsers.values():
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.error(str(e))
+        self.browsers = {}
+        self.markers = {}
+        self.launch_runs = {}
+        self.locks = {}
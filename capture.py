@@ -0,0 +1,158 @@
+import os, time, socket, struct, select, signal, subprocess
+from typing import BinaryIO, Dict, List, Tuple
+from urllib.parse import urlparse
+
+from endpoint import Endpoint
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Packet capture of an experiment.
+
+Starting a tshark process per run costs seconds per run and misses the first packets of
+the run while tshark starts up. Instead, one tshark process captures the whole
+experiment to a single file, with a BPF filter on the host and port of the endpoint so
+that only the experiment's traffic is kept. Every run records its wall-clock window with
+`mark`, and once the capture is stopped `split` writes the packets of each window to the
+run's own file, in a single pass over the capture. Only windows that got packets get a
+file, so the `pcap` column of a run is only set (with SET_PCAP) once its file is written.
+
+The capture is written as libpcap (not pcapng), whose fixed-size record headers make the
+split a plain read of timestamps. Runs in flight at the same time (async, multiprocess)
+have overlapping windows, and their files share the packets of the overlap.
+"""
+
+# seconds to wait for tshark to start capturing
+STARTUP_TIMEOUT = 10
+# seconds to wait for tshark to write out the capture once stopped
+STOP_TIMEOUT = 10
+PCAP_HEADER = struct.Struct("IHHiIII")
+RECORD_HEADER_SIZE = 16
+# magic numbers of the libpcap format: microsecond and nanosecond timestamps
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+# points the pcap column of a run at its capture file, once the file is written
+SET_PCAP = "UPDATE timings SET pcap = ? WHERE runID = ?"
+
+
+"""
+Return the BPF filter keeping the traffic of the given endpoint (TCP and QUIC). A name
+may resolve to several addresses (IPv4 and IPv6, or several CDN nodes) and the browser may
+use any of them, so the filter keeps all of them.
+"""
+def capture_filter(endpoint: Endpoint) -> str:
+    host = urlparse(endpoint.get_url()).hostname
+    port = endpoint.get_port() or 443
+    try:
+        addresses = sorted({info[4][0] for info in socket.getaddrinfo(host, port)})
+    except socket.gaierror as e:
+        logger.warning(f"Cannot resolve {host}, capturing by name: {e}")
+        addresses = [host]
+    hosts = " or ".join(f"host {address}" for address in addresses)
+    return f"({hosts}) and port {port}"
+
+
+class Capture():
+    def __init__(self, device: str, path: str, bpf_filter: str):
+        self.device = device
+        self.path = path
+        self.filter = bpf_filter
+        self.process = None
+        # output file: wall-clock windows of the runs written to it
+        self.windows: Dict[str, List[Tuple[float, float]]] = {}
+        # output file: the run it belongs to
+        self.runs: Dict[str, int] = {}
+
+    """
+    Start capturing, and return once tshark is capturing
+    """
+    def start(self) -> subprocess.Popen:
+        self.process = subprocess.Popen(["tshark", "-i", self.device, "-q", "-F", "pcap", "-f", self.filter, "-w", self.path],
+                                        stderr=subprocess.PIPE)
+        # tshark reports on stderr when it started capturing
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            ready, _, _ = select.select([self.process.stderr], [], [], deadline - time.monotonic())
+            line = self.process.stderr.readline() if ready else b""
+            if b"Capturing on" in line:
+                return self.process
+            if not line and self.process.poll() is not None:
+                break
+        logger.error(f"tshark did not start capturing on {self.device}")
+        return self.process
+
+    """
+    Attribute the packets captured between the given wall-clock times to the file of the given run
+    """
+    def mark(self, path: str, start: float, end: float, run_id: int):
+        self.windows.setdefault(path, []).append((start, end))
+        self.runs[path] = run_id
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        # tshark writes out what it buffered on SIGINT
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.error("tshark did not stop, killing it")
+            self.process.kill()
+            self.process.wait()
+
+    """
+    Write the packets of every marked window to its file, return the files written
+    """
+    def split(self) -> List[str]:
+        windows = sorted((start, end, path) for path, marks in self.windows.items() for start, end in marks)
+        if not windows or not os.path.exists(self.path):
+            return []
+        outputs: Dict[str, BinaryIO] = {}
+        with open(self.path, "rb") as capture:
+            header = capture.read(PCAP_HEADER.size)
+            if len(header) < PCAP_HEADER.size:
+                logger.error(f"Empty capture: {self.path}")
+                return []
+            for order in "<>":
+                magic = struct.unpack(order + "I", header[:4])[0]
+                if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                    break
+            else:
+                logger.error(f"Not a libpcap capture: {self.path}")
+                return []
+            record_header = struct.Struct(order + "IIII")
+            resolution = 1e9 if magic == PCAP_MAGIC_NS else 1e6
+            # packets of a single interface are in time order, so windows are opened and
+            # closed as the capture is read
+            following, active = 0, []
+            try:
+                while True:
+                    record = capture.read(RECORD_HEADER_SIZE)
+                    if len(record) < RECORD_HEADER_SIZE:
+                        break
+                    seconds, fraction, length, _ = record_header.unpack(record)
+                    data = capture.read(length)
+                    timestamp = seconds + fraction / resolution
+                    while following < len(windows) and windows[following][0] <= timestamp:
+                        active.append(windows[following])
+                        following += 1
+                    active = [window for window in active if window[1] >= timestamp]
+                    for _, _, path in active:
+                        if path not in outputs:
+                            outputs[path] = open(path, "wb")
+                            outputs[path].write(header)
+                        outputs[path].write(record + data)
+            finally:
+                for output in outputs.values():
+                    output.close()
+        logger.debug(f"Split {self.path} into {len(outputs)} files")
+        return list(outputs)
+
+    """
+    Stop capturing and split the capture. Return the value of the `pcap` column of every
+    run that got a file: its path relative to the working directory, without extension.
+    """
+    def finish(self) -> Dict[int, str]:
+        self.stop()
+        return {self.runs[path]: os.path.splitext(os.path.relpath(path))[0] for path in self.split()}
@@ -0,0 +1,327 @@
+"""Distributed Experiments
+
+Spreads the runs of one experiment plan over several client machines. The coordinator
+(`experiment.py --serve ADDRESS`) plans the sweep as usual, then hands the runs out over
+TCP to agents (`experiment.py --agent ADDRESS`), which do the page loads on their own
+machine (or network namespace) and send the results back. Only the coordinator writes to
+the results database, so a sweep spread over many clients ends up in a single database.
+
+The protocol is JSON lines, each request of an agent getting one reply:
+    {"type": "lease", "agent": NAME, "condition": CONDITION}
+        -> {"type": "run", "experimentID", "runID", "browser", "h3", "url", "endpoint",
+            "payload", "condition", "timeout"}
+        -> {"type": "wait", "seconds": S}   every run is leased, some may be re-issued
+        -> {"type": "done"}                 every run of the plan is completed
+    {"type": "result", "agent": NAME, "runID": ID, "results": {...}, "spans": [...]}
+        -> {"type": "ok", "recorded": BOOL} False if another agent already completed the run
+        -> {"type": "error", "error": E}    the message could not be read, the connection is closed
+    {"type": "captures", "agent": NAME, "captures": {runID: PCAP, ...}}
+        -> {"type": "ok"}                   sets the pcap column of runs whose capture file was written
+
+A lease lasts `lease_timeout` seconds; runs whose lease expired, or whose agent
+disconnected, are handed out again. Agents report the condition they currently have
+applied, and get a run of that condition if there is one, so that the qdiscs of an agent
+change as rarely as possible. Once the plan is done, the coordinator waits for the agents
+to disconnect, so that they can send the captures of their last experiment. The coordinator keeps the failure tracker of the sweep (see
+failures.py): it does not hand out the runs of combinations whose breaker is open, and
+gives every run the navigation timeout of its combination.
+
+Several agents can run on one machine in separate network namespaces, e.g. in the shards
+of shards.py, which reach the coordinator at the server namespace's address:
+    sudo ip netns exec harness-srv python3 experiment.py --serve 10.77.0.1:7420 ...
+    sudo ip netns exec harness-c0 python3 experiment.py --agent 10.77.0.1:7420 --device veth-c0
+"""
+
+import json, time, socket, asyncio, itertools
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from endpoint import Endpoint
+from plan import PlannedExperiment, PlannedRun
+from adaptive import AdaptiveSampler, SKIP_RUN
+from failures import FailureTracker
+from capture import SET_PCAP
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+DEFAULT_PORT = 7420
+# seconds an agent waits before asking again when every run is leased
+WAIT_SECONDS = 1
+# maximum seconds between two attempts of an agent to reach the coordinator
+MAX_RECONNECT_DELAY = 30
+# seconds after which an agent that cannot reach the coordinator gives up: the coordinator
+# stops serving once every run is completed
+CONNECT_TIMEOUT = 600
+# maximum seconds the coordinator waits for the agents to disconnect once the plan is done
+DRAIN_TIMEOUT = 60
+# maximum size of a message, in bytes: results carry every resource timing entry of the page
+MESSAGE_LIMIT = 64 * 1024 * 1024
+# times an agent sends a message before giving up on the coordinator
+REQUEST_ATTEMPTS = 5
+
+
+"""
+Return the host and port of a HOST:PORT address, the port defaulting to DEFAULT_PORT
+"""
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    if not host:
+        return port, DEFAULT_PORT
+    return host, int(port)
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message).encode() + b"\n"
+
+
+"""
+Return the endpoint of a run message
+"""
+def message_endpoint(message: dict) -> Endpoint:
+    if message["endpoint"].startswith("URL-"):
+        return Endpoint(message["url"], None, None)
+    return Endpoint(None, message["endpoint"], message["payload"])
+
+
+class Lease():
+    def __init__(self, experiment: PlannedExperiment, run: PlannedRun, agent: str, connection: int, deadline: float):
+        self.experiment = experiment
+        self.run = run
+        self.agent = agent
+        # an agent reconnecting keeps its name, its leases are tied to the connection
+        self.connection = connection
+        self.deadline = deadline
+
+
+class Coordinator():
+    """
+    `record(experiment, run, results, spans)` writes the results of a run, and `database`
+    is the writer the skipped runs are marked with. `samplers` are the adaptive samplers
+    of the experiments, if any.
+    """
+    def __init__(self, experiments: List[PlannedExperiment], record: Callable, database, lease_timeout: float,
+                 samplers: Dict[int, AdaptiveSampler] = None, failures: FailureTracker = None):
+        self.record = record
+        self.database = database
+        self.lease_timeout = lease_timeout
+        self.samplers = samplers or {}
+        self.failures = failures or FailureTracker()
+        # runs not leased yet, in the order of the plan
+        self.pending: Deque[Tuple[PlannedExperiment, PlannedRun]] = deque(
+            (experiment, run) for experiment in experiments for run in experiment.runs)
+        self.leases: Dict[int, Lease] = {}
+        self.completed = set()
+        self.total = len(self.pending)
+        self.finished = asyncio.Event()
+        self.connections = itertools.count()
+        self.open_connections = 0
+
+    """
+    Hand out again the runs whose lease expired, or that were leased over the given connection
+    """
+    def expire(self, connection: Optional[int] = None):
+        now = time.monotonic()
+        for run_id, lease in list(self.leases.items()):
+            if lease.deadline < now or lease.connection == connection:
+                logger.warning(f"Lease of run {run_id} by {lease.agent} expired, re-issuing it")
+                del self.leases[run_id]
+                self.pending.appendleft((lease.experiment, lease.run))
+
+    def lease(self, agent: str, connection: int, condition: Optional[str]) -> dict:
+        self.expire()
+        while self.pending:
+            index = next((i for i, (experiment, _) in enumerate(self.pending) if experiment.condition == condition), 0)
+            experiment, run = self.pending[index]
+            del self.pending[index]
+            sampler = self.samplers.get(experiment.experiment_id)
+            if sampler and sampler.converged(run.browser, run.h3):
+                self.database.execute(SKIP_RUN, (run.run_id,))
+                self.done(run.run_id)
+                continue
+            if not self.failures.allow(experiment.endpoint, run.browser, run.h3, experiment.condition):
+                # left uncompleted in the plan, for --resume
+                self.done(run.run_id)
+                continue
+            self.leases[run.run_id] = Lease(experiment, run, agent, connection, time.monotonic() + self.lease_timeout)
+            endpoint = experiment.endpoint
+            return {"type": "run", "experimentID": experiment.experiment_id, "runID": run.run_id,
+                    "browser": run.browser, "h3": run.h3, "url": endpoint.get_url(), "endpoint": endpoint.get_endpoint(),
+                    "payload": endpoint.get_payload(), "condition": experiment.condition,
+                    "timeout": self.failures.timeout(endpoint, run.browser, run.h3, experiment.condition)}
+        if self.leases:
+            return {"type": "wait", "seconds": WAIT_SECONDS}
+        return {"type": "done"}
+
+    """
+    Record the results of a run, unless it was already completed by another agent
+    """
+    def complete(self, agent: str, run_id: int, results: dict, spans: list) -> bool:
+        if run_id in self.completed:
+            logger.warning(f"Run {run_id} was already completed, dropping the results of {agent}")
+            return False
+        lease = self.leases.pop(run_id, None)
+        if lease is None:
+            # the lease expired, but the run was not completed by anyone else yet
+            index = next((i for i, (_, run) in enumerate(self.pending) if run.run_id == run_id), None)
+            if index is None:
+                logger.warning(f"Unknown run {run_id} from {agent}")
+                return False
+            experiment, run = self.pending[index]
+            del self.pending[index]
+        else:
+            experiment, run = lease.experiment, lease.run
+        self.record(experiment, run, results, spans)
+        sampler = self.samplers.get(experiment.experiment_id)
+        if sampler:
+            sampler.add(run.browser, run.h3, results)
+        self.failures.add(experiment.endpoint, run.browser, run.h3, experiment.condition, results)
+        self.done(run_id)
+        return True
+
+    """
+    Point the pcap column of runs recorded from an agent at the files its capture was split into
+    """
+    def captured(self, captures: Dict[str, str]):
+        for run_id, pcap in captures.items():
+            self.database.execute(SET_PCAP, (pcap, int(run_id)))
+
+    def done(self, run_id: int):
+        self.completed.add(run_id)
+        if not self.pending and not self.leases:
+            self.finished.set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        agent, connection = None, next(self.connections)
+        self.open_connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                except ValueError as e:
+                    # a line over the limit leaves the rest of it in the stream, so the
+                    # connection cannot be read any further
+                    logger.error(f"Agent {agent}: unreadable message: {e}")
+                    writer.write(encode({"type": "error", "error": f"unreadable message: {e}"}))
+                    await writer.drain()
+                    break
+                agent = message.get("agent", agent)
+                if message["type"] == "lease":
+                    reply = self.lease(agent, connection, message.get("condition"))
+                elif message["type"] == "result":
+                    recorded = self.complete(agent, message["runID"], message["results"], message.get("spans", []))
+                    reply = {"type": "ok", "recorded": recorded}
+                elif message["type"] == "captures":
+                    self.captured(message["captures"])
+                    reply = {"type": "ok"}
+                else:
+                    reply = {"type": "error", "error": f"unknown message type {message['type']}"}
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Agent {agent}: {e}")
+        finally:
+            self.open_connections -= 1
+            writer.close()
+            if agent:
+                logger.info(f"Agent {agent} disconnected")
+            self.expire(connection)
+
+    """
+    Serve the plan until every run is completed
+    """
+    async def serve(self, host: str, port: int):
+        if not self.pending:
+            return
+        server = await asyncio.start_server(self.handle, host, port, limit=MESSAGE_LIMIT)
+        logger.info(f"Serving {self.total} runs on {host}:{port}")
+        async with server:
+            await self.finished.wait()
+            # agents waiting for re-issued runs still get told that the plan is done
+            await asyncio.sleep(2 * WAIT_SECONDS)
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while self.open_connections and time.monotonic() < deadline:
+                await asyncio.sleep(WAIT_SECONDS)
+        logger.info("Every run of the plan is completed")
+
+
+class AgentClient():
+    def __init__(self, address: str, name: str, connect_timeout: float = CONNECT_TIMEOUT):
+        self.host, self.port = parse_address(address)
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.connection = None
+
+    """
+    Connect to the coordinator, raise ConnectionError if it cannot be reached within the timeout
+    """
+    def connect(self):
+        delay = 1
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                sock = socket.create_connection((self.host, self.port))
+                self.connection = sock.makefile("rwb")
+                logger.info(f"Connected to the coordinator at {self.host}:{self.port}")
+                return
+            except OSError as e:
+                logger.warning(f"Cannot reach the coordinator at {self.host}:{self.port}: {e}")
+                if time.monotonic() + delay > deadline:
+                    raise ConnectionError(f"Gave up on the coordinator at {self.host}:{self.port}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    """
+    Send a message and return the reply, reconnecting if the connection was lost;
+    raise ConnectionError once REQUEST_ATTEMPTS attempts got no reply
+    """
+    def request(self, message: dict) -> dict:
+        message["agent"] = self.name
+        data = encode(message)
+        for _ in range(REQUEST_ATTEMPTS):
+            if self.connection is None:
+                self.connect()
+            try:
+                self.connection.write(data)
+                self.connection.flush()
+                line = self.connection.readline()
+                if line:
+                    return json.loads(line)
+            except OSError as e:
+                logger.warning(f"Lost the coordinator: {e}")
+            self.close()
+        raise ConnectionError(f"No reply from the coordinator to a {message['type']} message")
+
+    def lease(self, condition: Optional[str]) -> dict:
+        return self.request({"type": "lease", "condition": condition})
+
+    """
+    Send the results of a run, return whether they were recorded. Results the coordinator
+    cannot take (e.g. over MESSAGE_LIMIT) are replaced by an error, so that the run fails
+    instead of being sent again and again.
+    """
+    def complete(self, run_id: int, results: dict, spans: list) -> bool:
+        message = {"type": "result", "runID": run_id, "results": results, "spans": spans}
+        size = len(encode(message))
+        if size >= MESSAGE_LIMIT:
+            reply = {"type": "error", "error": f"results of {size} bytes are over the limit"}
+        else:
+            reply = self.request(message)
+        if reply["type"] == "error":
+            logger.error(f"Run {run_id}: the coordinator did not take the results: {reply['error']}")
+            reply = self.request({"type": "result", "runID": run_id, "results": {"error": reply["error"]}, "spans": []})
+        return reply["recorded"]
+
+    def captures(self, captures: Dict[int, str]):
+        self.request({"type": "captures", "captures": captures})
+
+    def close(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+            self.connection = None
@@ -1,10 +1,2 @@
-shopt -s globstar
-for pcap in results/**/*.pcap; do
-    keys="${pcap%*.pcap}.keys"
-    out="${pcap%*.pcap}.pcapng"
-    echo $out;
-    if !(test -f $out); then
-        echo $out;
-        editcap --inject-secrets tls,$keys $pcap $out
-    fi
-done
+# Injects the TLS keys of the runs into their captures, see postprocess.py
+python3 postprocess.py "${1:-results/results.db}"
@@ -6,6 +6,7 @@ logger = logging.getLogger('__main__.' + __name__)
 
 # TODO move this function out of ssh_utils
 from ssh_utils import get_server_private_ip
+from local_server import LOCAL_REF_HOST, LOCAL_REF_PORT
 
 
 endpoint_to_port = {
@@ -15,6 +16,11 @@ endpoint_to_port = {
     "server-openlitespeed": "446"
 }
 
+# endpoints served by local_server.py on the client machine
+local_endpoint_to_port = {
+    "local-ref": LOCAL_REF_PORT
+}
+
 
 def get_domain(url: str) -> str: 
     res: ParseResult = urlparse(url)
@@ -38,6 +44,7 @@ class Endpoint():
     payload = "" 
     endpoint = ""
     on_server: bool = False
+    local: bool = False
     def __init__(self, url :str, endpoint :str, payload :str): 
         if url: 
             self.url = url 
@@ -63,6 +70,11 @@ class Endpoint():
             self.domain = get_server_private_ip()
             self.port = endpoint_to_port[endpoint]
             self.url = f"https://{self.domain}:{self.port}/{self.payload}"
+        elif endpoint in local_endpoint_to_port.keys():
+            self.local = True
+            self.domain = LOCAL_REF_HOST
+            self.port = local_endpoint_to_port[endpoint]
+            self.url = f"https://{self.domain}:{self.port}/{self.payload}"
         else:
             # Use json file to get url for public endpoints
             # If the particular endpoint/payload is not available, throw an exception 
@@ -85,6 +97,9 @@ class Endpoint():
     
     def is_on_server(self) -> bool: 
         return self.on_server
+
+    def is_local(self) -> bool:
+        return self.local
     
     def get_payload(self) -> str: 
         return self.payload
@@ -7,14 +7,30 @@ Arguments:
     --device DEVICE           Network device to modify [default: lo]
     --conditions CONDITIONS   List of network conditions [default: 4g-lte-good]
     --browsers BROWSERS       List of browsers to test [default: chromium edge firefox]
-    --throughput THROUGHPUT   Maximum number of request to send at a time when --async is set [default: 1]
+    --throughput THROUGHPUT   Number of page loads kept in flight at a time when --async is set [default: 1]
     --urls URLS               URL to access
     --runs RUNS               Number of runs in the experiment [default: 1]
     --out OUT                 File to output data to [default: results/results.db]
     --ports PORTS             List of ports to use (':443', ':444', ':445', ':446') [default: :443]
     --json JSON               JSON file of arguments
     --payloads PAYLOADS       List of sizes of the requesting payload (1kb, 10kb, 100kb) [default: 1kb 10kb 100kb]
-    --endpoints ENDPOINTS     Endpoint to hit. (server-nginx server-nginx-quiche server-caddy server-openlitespeed facebook google cloudflare)
+    --endpoints ENDPOINTS     Endpoint to hit. (server-nginx server-nginx-quiche server-caddy server-openlitespeed local-ref facebook google cloudflare)
+    --flush_size SIZE         Number of buffered result rows written to the database at once [default: 100]
+    --flush_interval SECONDS  Maximum number of seconds result rows stay buffered [default: 5]
+    --shards SHARDS           Run the conditions in parallel, each in one of this many network namespaces (see shards.py)
+    --sample_rate HZ          Samples per second of the browser processes' CPU, memory and I/O [default: 10]
+    --target_error ERROR      Relative half-width of the 95% confidence interval of --metric at which --adaptive stops a combination [default: 0.05]
+    --workers WORKERS         Do the page loads in this many processes, each with its own Playwright instance and browsers
+    --serve ADDRESS           Plan the sweep and hand its runs out to agents connecting to this HOST:PORT (see coordinator.py)
+    --agent ADDRESS           Do runs leased from the coordinator at this HOST:PORT instead of planning a sweep
+    --lease_timeout SECONDS   Seconds after which a run leased to an agent is handed out again [default: 300]
+    --min_runs MIN            Runs of every browser/h3 combination before --adaptive may stop it [default: 5]
+    --metric METRIC           Metric checked by --adaptive: a phase of analysis.py or two timing columns, END-START [default: responseEnd-requestStart]
+    --trace TRACE             Also export the spans of the stages of the runs to this Chrome trace-event JSON file
+    --preflight_timeout SECONDS  Seconds every step of the pre-flight probe of an endpoint may take [default: 5]
+    --max_failures FAILURES   Failed runs in a row after which the runs of an endpoint/browser/h3/condition are skipped for a while, 0 to never skip them [default: 3]
+    --server_dir DIR          Run the server commands (restart-all.sh, systemUtil.py) in this local checkout instead of over SSH on the server VM
+    --timeout_factor K        Navigation timeout, as a multiple of the 99th percentile of the load times under the condition [default: 3]
 
 Options:
     -h --help                 Show this screen 
@@ -23,9 +39,13 @@ Options:
     --async                   Run experiment asynchronously
     --qlog                    Turns on QLog logging
     --pcap                    Turns on packet capturing using TShark
+    --cold_launch             Launch a new browser for every run instead of reusing a warm one
+    --adaptive                Run the combinations in rounds, up to --runs, and stop each once --metric is precise enough
+    --resume                  Only do the runs left from the latest unfinished plan with the same endpoints, conditions, browsers and runs
+    --skip_preflight          Do not probe the endpoints before the sweep (see preflight.py)
 """
 
-import sys, os, time, random, subprocess, json, sqlite3, asyncio, itertools, glob
+import sys, os, time, random, subprocess, json, sqlite3, asyncio, itertools, glob, socket
 import cache_control
 from subprocess import Popen
 from typing import List, Dict, Tuple
@@ -39,11 +59,27 @@ import psutil
 import signal
 
 # separating our own imports
-from launchBrowserAsync import do_single_run_async
+from launchBrowserAsync import launch_browser_async
 from launchBrowserSync import do_single_experiment_sync
-from experiment_utils import apply_condition, reset_condition, setup_data_file_headers, write_big_table_data, write_timing_data
-from ssh_utils import start_server_monitoring, end_server_monitoring, on_server, get_server_private_ip
+from experiment_utils import reset_condition, ThreadedWriter, write_big_table_data, timing_row, \
+    run_resources_row, write_spans_data, insert_statement, write_preflight_data
+from ssh_utils import start_server_monitoring, end_server_monitoring, monitors_server, use_local_server, close_session
 from endpoint import Endpoint
+from browser_pool import BrowserPool, AsyncBrowserPool
+from run_resources import RunResourceTracker
+from shards import setup_shards, run_sharded, loopback_targets
+from qdisc import QdiscManager
+from performance_entries import entry_rows
+from local_server import start_local_server
+from tracing import tracer, span, run_context, export_chrome_trace
+from plan import PlannedExperiment, PlannedRun, COMPLETE_RUN, plan_key, create_plan, find_plan, load_plan, by_endpoint
+from adaptive import AdaptiveSampler, SKIP_RUN, parse_metric
+from worker_pool import WorkerPool, Task
+from coordinator import Coordinator, AgentClient, parse_address, message_endpoint
+from capture import Capture, capture_filter, SET_PCAP
+from quic_metrics import IngestPool
+from preflight import probe_all
+from failures import FailureTracker, DEFAULT_TIMEOUT
 
 # Thanks to https://stackoverflow.com/questions/38543506/change-logging-print-function-to-tqdm-write-so-logging-doesnt-interfere-wit
 import logging
@@ -66,28 +102,35 @@ class TqdmLoggingHandler(logging.Handler):
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
-
-# console handler logs WARNING, ERROR, and CRITICAL to console
-consoleHandler = TqdmLoggingHandler()
-consoleHandler.setLevel(logging.INFO)
-consoleHandler.setFormatter(formatter)
-# file handler logs DEBUG, INFO, and above to file
 log_time = time.time_ns()
 log_file = f"{log_time}.log"
-fileHandler = logging.FileHandler(log_file)
-fileHandler.setLevel(logging.DEBUG)
-fileHandler.setFormatter(formatter)
-# add handlers to logger
-logger.addHandler(consoleHandler)
-logger.addHandler(fileHandler)
+
+"""
+Add the console and log file handlers. Only main() does this: the page load workers are
+spawned and import this module again, they must not create log files of their own.
+"""
+def setup_logging():
+    # console handler logs WARNING, ERROR, and CRITICAL to console
+    consoleHandler = TqdmLoggingHandler()
+    consoleHandler.setLevel(logging.INFO)
+    consoleHandler.setFormatter(formatter)
+    # file handler logs DEBUG, INFO, and above to file
+    fileHandler = logging.FileHandler(log_file)
+    fileHandler.setLevel(logging.DEBUG)
+    fileHandler.setFormatter(formatter)
+    # add handlers to logger
+    logger.addHandler(consoleHandler)
+    logger.addHandler(fileHandler)
 
 # generated command line code
 CALL_FORMAT  = "sudo tc qdisc add dev {DEVICE} netem {OPTIONS}"
 RESET_FORMAT = "sudo tc qdisc del dev {DEVICE}"
 util_process = None
 pcap_process = None
+# seconds systemUtil gets to write its buffered rows once asked to stop
+MONITOR_STOP_TIMEOUT = 10
 
-schemaVer = "2.1"
+schemaVer = "2.3"
 serverVersion = "?"
 # TODO: disable caching in all servers.
 def pre_experiment_setup(
@@ -109,28 +152,40 @@ def post_experiment_cleanup(
         cache_control.add_server_caching("/usr/local/nginx/conf/nginx.conf", 23, 9)
 
 
+"""
+Stop the systemUtil of an experiment: SIGTERM lets it write the rows it still buffers,
+its process tree is only killed if it does not exit in time
+"""
+def stop_monitoring(process: subprocess.Popen, timeout: float = MONITOR_STOP_TIMEOUT):
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # Cleaning up system monitoring subprocess
+        parent = psutil.Process(process.pid)
+        for proc in parent.children(recursive=True):
+            proc.kill()
+        parent.kill()
+        process.wait()
+
+
 # Reset TC Params on exit
 class ResetTCOnExit:
     def __init__(self, dev: str):
         self.dev = dev
+        # buffered results are flushed before exiting
+        self.database = None
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, signum, frame):
         reset_condition(self.dev)
+        if self.database:
+            self.database.close()
         # TODO after logging PR is in, replace with log
         print(f"Exiting Program due to SIGNUM {signum}", flush=True)
-        global util_process, pcap_process
         if util_process:
-            try:
-                util_process.wait(timeout=3)
-            except subprocess.TimeoutExpired:
-                # Cleaning up system monitoring subprocess
-                proc_pid = util_process.pid
-                process = psutil.Process(proc_pid)
-                for proc in process.children(recursive=True):
-                    proc.kill()
-                process.kill()
+            stop_monitoring(util_process)
         if pcap_process:
             try:
                 pcap_process.wait(timeout=3)
@@ -145,6 +200,7 @@ class ResetTCOnExit:
 
 
 def main():   
+    setup_logging()
     logger.info(f"Logs at {log_file}")
 
     # Process args
@@ -155,6 +211,20 @@ def main():
         args.update(json_args)
     logger.info(args)
 
+    # With shards, this process only dispatches the conditions to experiment.py processes
+    # running inside the shards' namespaces
+    if args['--shards']:
+        loopback = loopback_targets(args)
+        if loopback:
+            logger.error(f"Loopback endpoints are not shaped inside shards: {loopback}. Aborting...")
+            sys.exit(1)
+        shards = setup_shards(int(args['--shards']))
+        failed = run_sharded(shards, args['--conditions'], args)
+        if failed:
+            logger.error(f"Failed conditions: {failed}")
+        logger.info(f"Finished! View logs at {log_file}")
+        return
+
     device = args['--device']
     killer = ResetTCOnExit(device)
     conditions = args['--conditions']
@@ -170,6 +240,19 @@ def main():
     run_async = args['--async']
     qlog = args['--qlog']
     pcap = args['--pcap']
+    cold_launch = args['--cold_launch']
+    flush_size = int(args['--flush_size'])
+    flush_interval = float(args['--flush_interval'])
+    sample_rate = float(args['--sample_rate'])
+
+    # An agent only does the runs the coordinator leases to it, which plans the sweep
+    if args['--agent']:
+        run_agent(args['--agent'], device, warmup_connection, qlog, pcap, cold_launch)
+        logger.info(f"Finished! View logs at {log_file}")
+        return
+    # the server commands of every experiment go through one session
+    if args['--server_dir']:
+        use_local_server(args['--server_dir'])
     # removes caching in nginx if necessary, starts up server
     # pre_experiment_setup(
     #    disable_caching=disable_caching,
@@ -207,25 +290,96 @@ def main():
         logger.error("There are no valid endpoints or urls. Aborting...")
         sys.exit()
     
+    # The local reference server is started here unless it is already running
+    local_server_process = None
+    if any(endpoint.is_local() for endpoint in endpts):
+        local_server_process = start_local_server()
+
+    # The whole sweep is planned (or the unfinished plan found) before anything runs
+    adaptive = args['--adaptive']
+    if adaptive:
+        # fail before planning anything if the metric is wrong
+        parse_metric(args['--metric'])
+    key = plan_key(endpts, conditions, browsers, runs, adaptive)
+    plan_id = find_plan(out, key) if args['--resume'] else None
+    if plan_id is None:
+        plan_id = create_plan(out, key, endpts, conditions, browsers, runs, rounds=adaptive)
+    else:
+        logger.info(f"Resuming plan {plan_id}")
+    experiments = load_plan(out, plan_id, endpts)
+    planned = list(experiments)
+    # with --adaptive, every experiment gets a sampler deciding which runs are still needed
+    sampling = None
+    if adaptive:
+        sampling = (args['--metric'], float(args['--target_error']), int(args['--min_runs']))
+
     # Setup data file headers  
-    database = setup_data_file_headers(out=out)
+    # results are written by a separate thread, so runs never wait on the disk
+    database = ThreadedWriter(out, flush_size, flush_interval)
+    killer.database = database
+    # dead endpoint/payload combinations are left out of this sweep; they stay in the plan,
+    # so that --resume does their runs once they are back
+    if not args['--skip_preflight']:
+        experiments = preflight(experiments, plan_id, database, float(args['--preflight_timeout']))
+        if not experiments:
+            logger.error("No endpoint passed the pre-flight probe. Aborting...")
+            database.close()
+            sys.exit()
+    # the qlogs and netlogs of every experiment are parsed in the background once it is done
+    ingest = IngestPool(database, out) if qlog else None
+    # circuit breakers and navigation timeouts of the whole sweep
+    failures = FailureTracker(int(args['--max_failures']), float(args['--timeout_factor']))
 
-    if not run_async:
+    if args['--serve']:
+        serve_experiment(
+            schema_version=  schemaVer,
+            git_hash=        git_hash,
+            server_version=  "0",
+            experiments=     experiments,
+            out=             out,
+            database=        database,
+            address=         args['--serve'],
+            lease_timeout=   float(args['--lease_timeout']),
+            sampling=        sampling,
+            failures=        failures,
+        )
+    elif args['--workers']:
+        run_multiprocess_experiment(
+            schema_version=  schemaVer,
+            git_hash=        git_hash,
+            server_version=  "0",
+            device=          device,
+            experiments=     experiments,
+            out=             out,
+            warmup=          warmup_connection,
+            database=        database,
+            qlog=            qlog,
+            pcap=            pcap,
+            workers=         int(args['--workers']),
+            cold_launch=     cold_launch,
+            sample_rate=     sample_rate,
+            sampling=        sampling,
+            ingest=          ingest,
+            failures=        failures,
+        )
+    elif not run_async:
         run_sync_experiment(
             schema_version=  schemaVer,
             git_hash=        git_hash,
             server_version=  "0",
             device=          device,
-            endpoints=       endpts,
-            conditions=      conditions,
-            browsers=        browsers,
-            runs=            runs,
+            experiments=     experiments,
             out=             out,
             disable_caching= disable_caching,
             warmup=          warmup_connection,
             database=        database,
             qlog=            qlog,
             pcap=            pcap,
+            cold_launch=     cold_launch,
+            sample_rate=     sample_rate,
+            sampling=        sampling,
+            ingest=          ingest,
+            failures=        failures,
         )
     else: # TODO this is broken
         asyncio.get_event_loop().run_until_complete(run_async_experiment(
@@ -233,10 +387,7 @@ def main():
             git_hash=        git_hash,
             server_version=  "0",
             device=          device,
-            endpoints=       endpts,
-            conditions=      conditions,
-            browsers=        browsers,
-            runs=            runs,
+            experiments=     experiments,
             out=             out,
             disable_caching= disable_caching,
             warmup=          warmup_connection,
@@ -244,8 +395,25 @@ def main():
             qlog=            qlog,
             pcap=            pcap,
             throughput=      throughput,
+            cold_launch=     cold_launch,
+            sample_rate=     sample_rate,
+            sampling=        sampling,
+            ingest=          ingest,
+            failures=        failures,
         ))
 
+    if ingest:
+        ingest.close()
+    write_spans_data(tracer.drain(), database)
+    database.close()
+    close_session()
+    if args['--trace']:
+        # only the spans of this plan, the database may hold earlier experiments; the spans of
+        # worker processes and agents have other pids, so they are found by experiment
+        export_chrome_trace(out, args['--trace'], [experiment.experiment_id for experiment in planned])
+    if local_server_process:
+        local_server_process.terminate()
+
     # post_experiment_cleanup(
     #     disable_caching=disable_caching,
     # )
@@ -253,31 +421,51 @@ def main():
     logger.info(f"Finished! View logs at {log_file}")
 
 
+"""
+Probe the endpoints of the given experiments at the same time, record the probes and
+return the experiments of the endpoints that passed
+"""
+def preflight(experiments: List[PlannedExperiment], plan_id: int, database, timeout: float) -> List[PlannedExperiment]:
+    endpoints = list({id(experiment.endpoint): experiment.endpoint for experiment in experiments}.values())
+    with span("preflight"):
+        probes = probe_all(endpoints, timeout)
+    write_preflight_data(probes, plan_id, database)
+    alive = {id(probe.endpoint) for probe in probes if probe.ok()}
+    return [experiment for experiment in experiments if id(experiment.endpoint) in alive]
+
+
 def run_sync_experiment(
     schema_version:  str,
     git_hash:        str, 
     server_version:  str, 
     device:          str, 
-    endpoints:       List[Endpoint],
-    conditions:      List[str], 
-    browsers:        List[str],
-    runs:            int, 
+    experiments:     List[PlannedExperiment],
     out:             str,
     disable_caching: bool,
     warmup:          bool,
     qlog:            bool,
     pcap:            bool,
     database, 
+    cold_launch:     bool = False,
+    sample_rate:     float = 10,
+    sampling:        Tuple[str, float, int] = None,
+    ingest:          IngestPool = None,
+    failures:        FailureTracker = None,
 ):
+    failures = failures or FailureTracker()
+    # the same condition stays applied for all the runs of an experiment
+    qdisc = QdiscManager(device)
     with sync_playwright() as p:
         # TODO randomize endpoint and condition. There is no reason to not randomize them.
-        for endpoint in tqdm(endpoints, desc="Endpoints"): 
+        for endpoint, endpoint_experiments in tqdm(by_endpoint(experiments), desc="Endpoints"): 
             logger.info(f"URL: {endpoint.get_url()}")
             url = endpoint.get_url()
-            for condition in tqdm(conditions, desc="Experiments"):
+            for experiment in tqdm(endpoint_experiments, desc="Experiments"):
+                condition = experiment.condition
                 logger.info(f"Condition: {condition}")
-                experiment_id = int(time.time()) # ensures no repeats
+                experiment_id = experiment.experiment_id
                 logger.debug(f"Experiment ID: {experiment_id}")
+                browsers = experiment.browsers()
                 for browser in browsers:
                     qlog_dir = f"{os.getcwd()}/results/qlogs/sync-{experiment_id}/{browser}"
                     os.makedirs(qlog_dir, exist_ok = True)
@@ -286,82 +474,97 @@ def run_sync_experiment(
 
                 # Start system monitoring
                 global util_process
-                util_process = subprocess.Popen(["python3", "systemUtil.py", str(experiment_id), 'client', str(out)])
-                tableData = (schema_version, experiment_id, url, server_version, git_hash, condition, log_file)
-                write_big_table_data(tableData, database)
+                util_process = subprocess.Popen(["python3", "systemUtil.py", str(experiment_id), 'client', str(out),
+                                                 str(database.flush_size), str(database.flush_interval), str(sample_rate)])
+                # a resumed experiment already has its row
+                if not experiment.started:
+                    tableData = (schema_version, experiment_id, url, server_version, git_hash, condition, log_file)
+                    write_big_table_data(tableData, database)
+                    database.flush()
 
-                # Start server monitoring if accessing our own server
+                # Start server monitoring if accessing our own server, or with --server_dir
                 ssh_client = None
-                if endpoint.is_on_server():
+                if monitors_server(endpoint):
                     ssh_client = start_server_monitoring(experiment_id, str(out))
 
-                params = [(h3, browser) 
-                    for browser in browsers 
-                    for h3 in [True, False]
-                ] * runs
-                random.shuffle(params)
+                # warm browsers are shared by the runs of this experiment
+                pool = BrowserPool(cold=cold_launch)
+                tracker = RunResourceTracker(device)
+                sampler = new_sampler(sampling, experiment, out)
+                # one capture for the whole experiment, split into the runs' files at the end
+                capture = None
+                if pcap:
+                    global pcap_process
+                    capture = Capture(device, f"{os.getcwd()}/results/packets/sync-{experiment_id}/capture.pcap", capture_filter(endpoint))
+                    pcap_process = capture.start()
 
-                # run the same experiment multiple times over h3/h2
-                for (useH3, browser) in tqdm(params, desc="Individual Runs"):
-                    run_id = int(time.time())
-                    if pcap:
-                        global pcap_process
+                # run the same experiment multiple times over h3/h2, in the order of the plan
+                for run in tqdm(experiment.runs, desc="Individual Runs"):
+                    useH3, browser, run_id = run.h3, run.browser, run.run_id
+                    if sampler and sampler.converged(browser, useH3):
+                        database.execute(SKIP_RUN, (run_id,))
+                        continue
+                    # left uncompleted in the plan, for --resume
+                    if not failures.allow(endpoint, browser, useH3, condition):
+                        continue
+                    with run_context(experiment_id, run_id), span("run"):
                         pcap_file = f"results/packets/sync-{experiment_id}/{browser}/{run_id}-{useH3}"
-                        pcap_process = subprocess.Popen(f"tshark -i {device} -Q -w {os.getcwd()}/{pcap_file}.pcap".split())
-
-                    results = do_single_experiment_sync(condition, device, p, browser, useH3, 
-                                                            endpoint, warmup, qlog, pcap,
-                                                            experiment_id, run_id)
-                    results["experimentID"] = experiment_id
-                    results["httpVersion"] = "h3" if useH3 else "h2" 
-                    results["warmup"] = warmup
-                    results["browser"] = browser 
-                    results["payloadSize"] = endpoint.get_payload() 
-                    results["netemParams"] = condition
-                    results["trafficLoad"] = "1"
-                    results["pcap"]  = pcap_file if pcap else "n/a"
-                    # TODO: currently missing server, add server
-                    write_timing_data(results, database)
-                    httpVersion = "HTTP/3" if useH3 else "HTTP/2"
-                    # Print info from latest run and then go back lines to prevent broken progress bars
-                    # if the request fails, we will print out the message in the console
-                    if 'server' in results.keys():
-                        logger.debug(f"{browser}: {results['server']} ({httpVersion})")
-                    else:
-                        logger.error(f"{browser}: {'error'}({httpVersion})")
-                    if pcap:
-                        try:
-                            pcap_process.wait(timeout=3)
-                        except subprocess.TimeoutExpired:
-                            # Cleaning up system monitoring subprocess
-                            proc_pid = pcap_process.pid
-                            process = psutil.Process(proc_pid)
-                            for proc in process.children(recursive=True):
-                                proc.kill()
-                            process.kill()
-                try:
-                    util_process.wait(timeout=3)
-                except subprocess.TimeoutExpired:
-                    # Cleaning up system monitoring subprocess
-                    proc_pid = util_process.pid
-                    process = psutil.Process(proc_pid)
-                    for proc in process.children(recursive=True):
-                        proc.kill()
-                    process.kill()
+                        run_start = time.time()
+                        results = do_single_experiment_sync(condition, device, p, browser, useH3, 
+                                                                endpoint, warmup, qlog, pcap,
+                                                                experiment_id, run_id, pool, tracker, qdisc,
+                                                                failures.timeout(endpoint, browser, useH3, condition))
+                        if capture:
+                            capture.mark(f"{os.getcwd()}/{pcap_file}.pcap", run_start, time.time(), run_id)
+                        if ingest:
+                            ingest.mark(experiment_id, browser, useH3, run_id, run_start, time.time())
+                            # the logs of the run are complete once its (cold) browser is closed
+                            ingest.submit_run(experiment_id, browser, run_id)
+                        resources = results.pop("resources", None)
+                        entries = results.pop("entries", [])
+                        results["experimentID"] = experiment_id
+                        results["runID"] = run_id
+                        results["httpVersion"] = "h3" if useH3 else "h2" 
+                        results["warmup"] = warmup
+                        results["browser"] = browser 
+                        results["payloadSize"] = endpoint.get_payload() 
+                        results["netemParams"] = condition
+                        results["trafficLoad"] = "1"
+                        # set once the capture is split, if the run got packets (see record_captures)
+                        results["pcap"]  = "n/a"
+                        # TODO: currently missing server, add server
+                        with span("record"):
+                            database.execute_group(result_statements(results, resources, entries, experiment_id, browser, run_id))
+                        if sampler:
+                            sampler.add(browser, useH3, results)
+                        failures.add(endpoint, browser, useH3, condition, results)
+                        httpVersion = "HTTP/3" if useH3 else "HTTP/2"
+                        # Print info from latest run and then go back lines to prevent broken progress bars
+                        # if the request fails, we will print out the message in the console
+                        if 'server' in results.keys():
+                            logger.debug(f"{browser}: {results['server']} ({httpVersion})")
+                        else:
+                            logger.error(f"{browser}: {'error'}({httpVersion})")
+                    write_spans_data(tracer.drain(), database)
+                pool.close()
+                qdisc.reset()
+                if capture:
+                    record_captures(capture, database)
+                # the netlogs are complete once the browsers are closed
+                if ingest:
+                    ingest.submit_experiment(experiment_id)
+                database.flush()
+                stop_monitoring(util_process)
                 
                 # end server monitoring 
-                if on_server(url=url):
-                    end_server_monitoring(ssh=ssh_client)
+                end_server_monitoring(ssh_client)
 
 async def run_async_experiment(
     schema_version:  str,
     git_hash:        str, 
     server_version:  str, 
     device:          str, 
-    endpoints:       List[Endpoint],
-    conditions:      List[str], 
-    browsers:        List[str],
-    runs:            int, 
+    experiments:     List[PlannedExperiment],
     out:             str,
     disable_caching: bool,
     warmup:          bool,
@@ -369,16 +572,25 @@ async def run_async_experiment(
     pcap:            bool,
     database, 
     throughput:      int,
+    cold_launch:     bool = False,
+    sample_rate:     float = 10,
+    sampling:        Tuple[str, float, int] = None,
+    ingest:          IngestPool = None,
+    failures:        FailureTracker = None,
 ):
+    failures = failures or FailureTracker()
+    qdisc = QdiscManager(device)
     async with async_playwright() as p:
         # TODO randomize endpoint and condition. There is no reason to not randomize them.
-        for endpoint in tqdm(endpoints, desc="Endpoints"): 
+        for endpoint, endpoint_experiments in tqdm(by_endpoint(experiments), desc="Endpoints"): 
             logger.info(f"URL: {endpoint.get_url()}")
             url = endpoint.get_url()
-            for condition in tqdm(conditions, desc="Experiments"):
+            for experiment in tqdm(endpoint_experiments, desc="Experiments"):
+                condition = experiment.condition
                 logger.info(f"Condition: {condition}")
-                experiment_id = int(time.time()) # ensures no repeats
+                experiment_id = experiment.experiment_id
                 logger.debug(f"Experiment ID: {experiment_id}")
+                browsers = experiment.browsers()
                 for browser in browsers:
                     qlog_dir = f"{os.getcwd()}/results/qlogs/async-{experiment_id}/{browser}"
                     os.makedirs(qlog_dir, exist_ok = True)
@@ -387,104 +599,486 @@ async def run_async_experiment(
 
                 # Start system monitoring
                 global util_process
-                util_process = subprocess.Popen(["python3", "systemUtil.py", str(experiment_id), 'client', str(out)])
-                tableData = (schema_version, experiment_id, url, server_version, git_hash, condition, log_file)
-                write_big_table_data(tableData, database)
+                util_process = subprocess.Popen(["python3", "systemUtil.py", str(experiment_id), 'client', str(out),
+                                                 str(database.flush_size), str(database.flush_interval), str(sample_rate)])
+                # a resumed experiment already has its row
+                if not experiment.started:
+                    tableData = (schema_version, experiment_id, url, server_version, git_hash, condition, log_file)
+                    write_big_table_data(tableData, database)
+                    database.flush()
 
-                # Start server monitoring if accessing our own server
+                # Start server monitoring if accessing our own server, or with --server_dir
                 ssh_client = None
-                if endpoint.is_on_server():
+                if monitors_server(endpoint):
                     ssh_client = start_server_monitoring(experiment_id, str(out))
 
-                params = [(h3, browser) 
-                    for browser in browsers 
-                    for h3 in [True, False]
-                ] * runs
-                random.shuffle(params)
-
-                apply_condition(device, condition)
+                qdisc.apply(condition)
+                # warm browsers are shared by the runs of this experiment
+                pool = AsyncBrowserPool(cold=cold_launch)
+                tracker = RunResourceTracker(device)
+                sampler = new_sampler(sampling, experiment, out)
+                # one capture for the whole experiment, split into the runs' files at the end
+                capture = None
                 if pcap:
                     global pcap_process
-                    pcap_file = f"results/packets/async-{experiment_id}/async.pcap"
-                    pcap_process = subprocess.Popen(f"tshark -i {device} -Q -w {os.getcwd()}/{pcap_file}".split())
-                # one run is a run of "througput" page visits TODO revist this after meeting
-                for (useH3, browser) in tqdm(params, desc="Individual Runs"):
-                    outstanding = []
-                    for _ in range(throughput):
-                        # Need more precision for async run ids since seconds might overlap
-                        run_id = int(time.time_ns())
-                        outstanding.append(
-                            do_single_run_async(condition, device, p, browser, useH3, 
-                                endpoint, warmup, qlog, pcap,
-                                experiment_id, run_id)
-                        )
-                    while outstanding:
-                        await clean_outstanding(
-                            outstanding=outstanding, 
-                            warmup=warmup, 
-                            database=database, 
-                            experiment_id=experiment_id,
-                            device=device,
-                            trafficLoad = throughput,
-                            pcap = pcap_file if pcap else "n/a",
-                        )
-                    if qlog and browser == "firefox":
-                        # change qlogś name so that it will be saved to results/qlogs/async-[experimentID]/firefox
-                        set_id = int(time.time())
-                        qlog_num = 0
-                        for qlog in glob.glob("/tmp/qlog_*/*.qlog", recursive=True):
-                            qlog_dir = f"{os.getcwd()}/results/qlogs/async-{experiment_id}/firefox/"
-                            os.rename(qlog, f"{qlog_dir}/{set_id}-{qlog_num}.qlog")
-                            qlog_num += 1
-                reset_condition(device) 
+                    capture = Capture(device, f"{os.getcwd()}/results/packets/async-{experiment_id}/capture.pcap", capture_filter(endpoint))
+                    pcap_process = capture.start()
+                # keep `throughput` page loads in flight over the runs of the plan,
+                # recording each result as soon as its page load finishes
+                queue = asyncio.Queue()
+                for run in experiment.runs:
+                    queue.put_nowait(run)
+                progress = tqdm(total=len(experiment.runs), desc="Individual Runs")
+                workers = [
+                    asyncio.create_task(run_worker(
+                        queue=         queue,
+                        pw_instance=   p,
+                        pool=          pool,
+                        tracker=       tracker,
+                        sampler=       sampler,
+                        condition=     condition,
+                        endpoint=      endpoint,
+                        warmup=        warmup,
+                        qlog=          qlog,
+                        pcap=          pcap,
+                        experiment_id= experiment_id,
+                        database=      database,
+                        trafficLoad=   throughput,
+                        capture=       capture,
+                        progress=      progress,
+                        failures=      failures,
+                        ingest=        ingest,
+                    ))
+                    for _ in range(min(throughput, len(experiment.runs)))
+                ]
+                await asyncio.gather(*workers)
+                progress.close()
+                if qlog and "firefox" in browsers:
+                    # change qlogś name so that it will be saved to results/qlogs/async-[experimentID]/firefox
+                    set_id = int(time.time())
+                    qlog_num = 0
+                    for qlog_file in glob.glob("/tmp/qlog_*/*.qlog", recursive=True):
+                        qlog_dir = f"{os.getcwd()}/results/qlogs/async-{experiment_id}/firefox/"
+                        os.rename(qlog_file, f"{qlog_dir}/{set_id}-{qlog_num}.qlog")
+                        qlog_num += 1
+                await pool.close()
+                database.flush()
+                qdisc.reset()
+                # the netlogs are complete once the browsers are closed
+                if ingest:
+                    ingest.submit_experiment(experiment_id)
+                if capture:
+                    record_captures(capture, database)
+            stop_monitoring(util_process)
+            # end server monitoring 
+            end_server_monitoring(ssh_client)
+
+"""
+Run the experiments in a pool of worker processes (see worker_pool.py). This process
+applies the condition and captures packets once per experiment, like the async mode,
+and writes the results the workers send back.
+"""
+def run_multiprocess_experiment(
+    schema_version:  str,
+    git_hash:        str, 
+    server_version:  str, 
+    device:          str, 
+    experiments:     List[PlannedExperiment],
+    out:             str,
+    warmup:          bool,
+    qlog:            bool,
+    pcap:            bool,
+    database, 
+    workers:         int,
+    cold_launch:     bool = False,
+    sample_rate:     float = 10,
+    sampling:        Tuple[str, float, int] = None,
+    ingest:          IngestPool = None,
+    failures:        FailureTracker = None,
+):
+    failures = failures or FailureTracker()
+    qdisc = QdiscManager(device)
+    worker_pool = WorkerPool(workers, device, cold_launch, log_file)
+    try:
+        for endpoint, endpoint_experiments in tqdm(by_endpoint(experiments), desc="Endpoints"): 
+            logger.info(f"URL: {endpoint.get_url()}")
+            url = endpoint.get_url()
+            for experiment in tqdm(endpoint_experiments, desc="Experiments"):
+                condition = experiment.condition
+                logger.info(f"Condition: {condition}")
+                experiment_id = experiment.experiment_id
+                logger.debug(f"Experiment ID: {experiment_id}")
+                # the workers launch browsers with the sync launchers, which use the sync- directories
+                for browser in experiment.browsers():
+                    os.makedirs(f"{os.getcwd()}/results/qlogs/sync-{experiment_id}/{browser}", exist_ok = True)
+                    os.makedirs(f"{os.getcwd()}/results/packets/sync-{experiment_id}/{browser}", exist_ok = True)
+
+                # Start system monitoring
+                global util_process
+                util_process = subprocess.Popen(["python3", "systemUtil.py", str(experiment_id), 'client', str(out),
+                                                 str(database.flush_size), str(database.flush_interval), str(sample_rate)])
+                # a resumed experiment already has its row
+                if not experiment.started:
+                    tableData = (schema_version, experiment_id, url, server_version, git_hash, condition, log_file)
+                    write_big_table_data(tableData, database)
+                    database.flush()
+
+                # Start server monitoring if accessing our own server, or with --server_dir
+                ssh_client = None
+                if monitors_server(endpoint):
+                    ssh_client = start_server_monitoring(experiment_id, str(out))
+
+                qdisc.apply(condition)
+                sampler = new_sampler(sampling, experiment, out)
+                # one capture for the whole experiment, split into the runs' files at the end
+                capture = None
                 if pcap:
+                    global pcap_process
+                    capture = Capture(device, f"{os.getcwd()}/results/packets/sync-{experiment_id}/capture.pcap", capture_filter(endpoint))
+                    pcap_process = capture.start()
+                progress = tqdm(total=len(experiment.runs), desc="Individual Runs")
+
+                # runs are handed out lazily, so that the sampler sees the results done so far
+                def tasks():
+                    for run in experiment.runs:
+                        if sampler and sampler.converged(run.browser, run.h3):
+                            database.execute(SKIP_RUN, (run.run_id,))
+                            progress.update()
+                            continue
+                        # left uncompleted in the plan, for --resume
+                        if not failures.allow(endpoint, run.browser, run.h3, condition):
+                            progress.update()
+                            continue
+                        yield Task(experiment_id, run.run_id, run.browser, run.h3, endpoint, warmup, qlog, pcap,
+                                   failures.timeout(endpoint, run.browser, run.h3, condition))
+
+                for task, results, spans, (run_start, run_end) in worker_pool.run(tasks()):
+                    pcap_file = f"results/packets/sync-{experiment_id}/{task.browser}/{task.run_id}-{task.h3}"
+                    if capture:
+                        capture.mark(f"{os.getcwd()}/{pcap_file}.pcap", run_start, run_end, task.run_id)
+                    if ingest:
+                        ingest.mark(experiment_id, task.browser, task.h3, task.run_id, run_start, run_end)
+                        ingest.submit_run(experiment_id, task.browser, task.run_id)
+                    resources = results.pop("resources", None)
+                    entries = results.pop("entries", [])
+                    results["experimentID"] = experiment_id
+                    results["runID"] = task.run_id
+                    results["httpVersion"] = "h3" if task.h3 else "h2" 
+                    results["warmup"] = warmup
+                    results["browser"] = task.browser 
+                    results["payloadSize"] = endpoint.get_payload() 
+                    results["netemParams"] = condition
+                    results["trafficLoad"] = workers
+                    # set once the capture is split, if the run got packets (see record_captures)
+                    results["pcap"] = "n/a"
+                    database.execute_group(result_statements(results, resources, entries, experiment_id, task.browser, task.run_id))
+                    write_spans_data(spans, database)
+                    if sampler:
+                        sampler.add(task.browser, task.h3, results)
+                    failures.add(endpoint, task.browser, task.h3, condition, results)
+                    httpVersion = "HTTP/3" if task.h3 else "HTTP/2"
+                    # if the request fails, we will print out the message in the console
+                    if 'server' in results.keys():
+                        logger.debug(f"{task.browser}: {results['server']} ({httpVersion})")
+                    else:
+                        logger.error(f"{task.browser}: {'error'}({httpVersion})")
+                    progress.update()
+                progress.close()
+                qdisc.reset()
+                database.flush()
+                if capture:
+                    record_captures(capture, database)
+                stop_monitoring(util_process)
+                # end server monitoring 
+                end_server_monitoring(ssh_client)
+    finally:
+        worker_pool.close()
+    # the workers close their browsers when they stop, which completes the netlogs
+    if ingest:
+        for experiment in experiments:
+            ingest.submit_experiment(experiment.experiment_id)
+
+"""
+Hand the runs of the experiments out to agents (see coordinator.py) and write the results
+they send back
+"""
+def serve_experiment(
+    schema_version:  str,
+    git_hash:        str, 
+    server_version:  str, 
+    experiments:     List[PlannedExperiment],
+    out:             str,
+    database, 
+    address:         str,
+    lease_timeout:   float,
+    sampling:        Tuple[str, float, int] = None,
+    failures:        FailureTracker = None,
+):
+    for experiment in experiments:
+        # a resumed experiment already has its row
+        if not experiment.started:
+            tableData = (schema_version, experiment.experiment_id, experiment.endpoint.get_url(), server_version,
+                         git_hash, experiment.condition, log_file)
+            write_big_table_data(tableData, database)
+    samplers = {experiment.experiment_id: new_sampler(sampling, experiment, out) for experiment in experiments} if sampling else {}
+
+    def record(experiment: PlannedExperiment, run: PlannedRun, results: dict, spans: list):
+        resources = results.pop("resources", None)
+        entries = results.pop("entries", [])
+        results["experimentID"] = experiment.experiment_id
+        results["runID"] = run.run_id
+        results["httpVersion"] = "h3" if run.h3 else "h2" 
+        results["browser"] = run.browser 
+        results["payloadSize"] = experiment.endpoint.get_payload() 
+        results["netemParams"] = experiment.condition
+        database.execute_group(result_statements(results, resources, entries, experiment.experiment_id, run.browser, run.run_id))
+        write_spans_data(spans, database)
+        if 'error' in results.keys():
+            logger.error(f"{run.browser}: {'error'}({'HTTP/3' if run.h3 else 'HTTP/2'})")
+
+    coordinator = Coordinator(experiments, record, database, lease_timeout, samplers, failures)
+    asyncio.get_event_loop().run_until_complete(coordinator.serve(*parse_address(address)))
+
+"""
+Do the runs leased from the coordinator at the given address until it has none left,
+sending their results back
+"""
+def run_agent(
+    address:     str,
+    device:      str,
+    warmup:      bool,
+    qlog:        bool,
+    pcap:        bool,
+    cold_launch: bool = False,
+):
+    client = AgentClient(address, f"{socket.gethostname()}-{os.getpid()}")
+    qdisc = QdiscManager(device)
+    tracker = RunResourceTracker(device)
+    pool, pool_experiment, condition = None, None, None
+    capture = None
+    # runs of the current capture whose results the coordinator recorded
+    recorded = set()
+    local_server_process, local_server_started = None, False
+    with sync_playwright() as p:
+        try:
+            while True:
+                try:
+                    message = client.lease(condition)
+                except ConnectionError as e:
+                    # the coordinator is gone, most likely because the plan is completed
+                    logger.error(str(e))
+                    break
+                if message["type"] == "done":
+                    break
+                if message["type"] == "wait":
+                    time.sleep(message["seconds"])
+                    continue
+                experiment_id, run_id = message["experimentID"], message["runID"]
+                browser, useH3, condition = message["browser"], message["h3"], message["condition"]
+                endpoint = message_endpoint(message)
+                if endpoint.is_local() and not local_server_started:
+                    local_server_process, local_server_started = start_local_server(), True
+                os.makedirs(f"{os.getcwd()}/results/qlogs/sync-{experiment_id}/{browser}", exist_ok = True)
+                os.makedirs(f"{os.getcwd()}/results/packets/sync-{experiment_id}/{browser}", exist_ok = True)
+                # warm browsers and the capture are shared by the runs of an experiment this agent gets
+                if experiment_id != pool_experiment:
+                    if pool:
+                        pool.close()
+                    pool, pool_experiment = BrowserPool(cold=cold_launch), experiment_id
+                    if capture:
+                        send_captures(client, capture, recorded)
+                    if pcap:
+                        global pcap_process
+                        capture = Capture(device, f"{os.getcwd()}/results/packets/sync-{experiment_id}/capture.pcap", capture_filter(endpoint))
+                        pcap_process = capture.start()
+                with run_context(experiment_id, run_id), span("run"):
+                    pcap_file = f"results/packets/sync-{experiment_id}/{browser}/{run_id}-{useH3}"
+                    run_start = time.time()
                     try:
-                        pcap_process.wait(timeout=3)
-                    except subprocess.TimeoutExpired:
-                        # Cleaning up system monitoring subprocess
-                        proc_pid = pcap_process.pid
-                        process = psutil.Process(proc_pid)
-                        for proc in process.children(recursive=True):
-                            proc.kill()
-                        process.kill()
+                        results = do_single_experiment_sync(condition, device, p, browser, useH3, endpoint, warmup, qlog, pcap,
+                                                            experiment_id, run_id, pool, tracker, qdisc,
+                                                            message.get("timeout", DEFAULT_TIMEOUT))
+                    except Exception as e:
+                        logger.error(str(e))
+                        results = {'error': str(e)}
+                    if capture:
+                        capture.mark(f"{os.getcwd()}/{pcap_file}.pcap", run_start, time.time(), run_id)
+                    results["warmup"] = warmup
+                    results["trafficLoad"] = "1"
+                    # set once the capture of the experiment is split, if the run got packets
+                    results["pcap"] = "n/a"
+                try:
+                    done = client.complete(run_id, results, tracer.drain())
+                except ConnectionError as e:
+                    # the run is leased again once its lease expires
+                    logger.error(str(e))
+                    break
+                if done:
+                    recorded.add(run_id)
+                else:
+                    logger.warning(f"Run {run_id} was done by another agent")
+        finally:
+            if pool:
+                pool.close()
+            if capture:
+                send_captures(client, capture, recorded)
+            qdisc.reset()
+            client.close()
+            if local_server_process:
+                local_server_process.terminate()
+
+"""
+Split the capture of an agent's experiment and send the files of its recorded runs to the
+coordinator, which sets their `pcap` column
+"""
+def send_captures(client: AgentClient, capture: Capture, recorded: set):
+    captures = {run_id: pcap_file for run_id, pcap_file in capture.finish().items() if run_id in recorded}
+    recorded.clear()
+    try:
+        client.captures(captures)
+    except ConnectionError as e:
+        logger.error(f"Could not send the captures: {e}")
+
+"""
+Worker of the async scheduler: take runs off the queue one at a time until it is empty,
+so that the number of workers is the number of page loads in flight
+"""
+async def run_worker(
+    queue:         asyncio.Queue,
+    pw_instance:   "AsyncPlaywrightContextManager",
+    pool:          AsyncBrowserPool,
+    tracker:       RunResourceTracker,
+    sampler:       AdaptiveSampler,
+    condition:     str,
+    endpoint:      Endpoint,
+    warmup:        bool,
+    qlog:          bool,
+    pcap:          bool,
+    experiment_id: int,
+    database,
+    trafficLoad:   int,
+    capture:       Capture,
+    progress:      tqdm,
+    failures:      FailureTracker,
+    ingest:        IngestPool = None,
+):
+    while True:
+        try:
+            run = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        useH3, browser, run_id = run.h3, run.browser, run.run_id
+        if sampler and sampler.converged(browser, useH3):
+            await database.execute_group_async([(SKIP_RUN, (run_id,))])
+            progress.update()
+            continue
+        # left uncompleted in the plan, for --resume
+        if not failures.allow(endpoint, browser, useH3, condition):
+            progress.update()
+            continue
+        with run_context(experiment_id, run_id), span("run"):
+            pcap_file = f"results/packets/async-{experiment_id}/{browser}/{run_id}-{useH3}"
+            run_start = time.time()
             try:
-                util_process.wait(timeout=3)
-            except subprocess.TimeoutExpired:
-                # Cleaning up system monitoring subprocess
-                proc_pid = util_process.pid
-                process = psutil.Process(proc_pid)
-                for proc in process.children(recursive=True):
-                    proc.kill()
-                process.kill()
-            # end server monitoring 
-            if on_server(url=url):
-                end_server_monitoring(ssh=ssh_client)
-
-async def clean_outstanding(outstanding: List, warmup: bool, database, experiment_id: str, device: str, trafficLoad: float, pcap: str): 
-    for item in outstanding:
-        (task, combo) = item
-        # TODO - server_port is unused. Is this bc we don't have a column for it?
-        condition, endpoint, browser, useH3 = combo
-        if task.done():
-            results = task.result()
-            results["experimentID"] = experiment_id
-            results["httpVersion"] = "h3" if useH3 else "h2" 
-            results["warmup"] = warmup
-            results["browser"] = browser 
-            results["payloadSize"] = endpoint.get_payload() 
-            results["netemParams"] = condition
-            results["trafficLoad"] = trafficLoad
-            results["pcap"] = pcap
-            write_timing_data(results, database)
-            httpVersion = "HTTP/3" if useH3 else "HTTP/2"
-            # Print info from latest run and then go back lines to prevent broken progress bars
-            # if the request fails, we will print out the message in the console
-            if 'server' in results.keys():
-                logger.debug(f"{browser}: {results['server']} ({httpVersion})")
-            else:
-                logger.error(f"{browser}: {'error'}({httpVersion})")
-            outstanding.remove(item)
-    await asyncio.sleep(1) 
+                results = await launch_browser_async(
+                    pw_instance, browser, useH3, endpoint, warmup,
+                    qlog, pcap, experiment_id, run_id, pool, tracker, failures.timeout(endpoint, browser, useH3, condition),
+                )
+            except Exception as e:
+                # a single failing page load must not take down the other workers
+                logger.error(str(e))
+                results = {'error': str(e)}
+            if capture:
+                capture.mark(f"{os.getcwd()}/{pcap_file}.pcap", run_start, time.time(), run_id)
+            if ingest:
+                ingest.mark(experiment_id, browser, useH3, run_id, run_start, time.time())
+                ingest.submit_run(experiment_id, browser, run_id)
+            with span("record"):
+                await record_result(results, condition, endpoint, browser, useH3, warmup, database, experiment_id, run_id, trafficLoad)
+            if sampler:
+                sampler.add(browser, useH3, results)
+            failures.add(endpoint, browser, useH3, condition, results)
+        # spans of the other workers' runs are drained too
+        for row in tracer.drain():
+            await database.insert_async("spans", row)
+        progress.update()
+
+"""
+Add the run parameters to the results of a single page load and queue them for the database
+"""
+async def record_result(
+    results:       dict,
+    condition:     str,
+    endpoint:      Endpoint,
+    browser:       str,
+    useH3:         bool,
+    warmup:        bool,
+    database,
+    experiment_id: int,
+    run_id:        int,
+    trafficLoad:   int,
+):
+    resources = results.pop("resources", None)
+    entries = results.pop("entries", [])
+    results["experimentID"] = experiment_id
+    results["runID"] = run_id
+    results["httpVersion"] = "h3" if useH3 else "h2" 
+    results["warmup"] = warmup
+    results["browser"] = browser 
+    results["payloadSize"] = endpoint.get_payload() 
+    results["netemParams"] = condition
+    results["trafficLoad"] = trafficLoad
+    # set once the capture is split, if the run got packets (see record_captures)
+    results["pcap"] = "n/a"
+    await database.execute_group_async(result_statements(results, resources, entries, experiment_id, browser, run_id))
+    httpVersion = "HTTP/3" if useH3 else "HTTP/2"
+    # if the request fails, we will print out the message in the console
+    if 'server' in results.keys():
+        logger.debug(f"{browser}: {results['server']} ({httpVersion})")
+    else:
+        logger.error(f"{browser}: {'error'}({httpVersion})")
+
+
+"""
+Return the adaptive sampler of the experiment, with the results it already has when it is
+resumed, or None without --adaptive
+"""
+def new_sampler(sampling: Tuple[str, float, int], experiment: PlannedExperiment, out: str) -> AdaptiveSampler:
+    if sampling is None:
+        return None
+    sampler = AdaptiveSampler(*sampling)
+    if experiment.started:
+        sampler.load(out, experiment.experiment_id)
+    return sampler
+
+
+"""
+Point the `pcap` column of the runs of a finished capture at their files. Runs whose
+window got no packets have no file, and keep "n/a".
+"""
+def record_captures(capture: Capture, database):
+    for run_id, pcap_file in capture.finish().items():
+        database.execute(SET_PCAP, (pcap_file, run_id))
+
+"""
+Return the statements writing the results of a run and marking the run as completed in
+the plan, which the writer commits in a single transaction
+"""
+def result_statements(
+    results:       dict,
+    resources:     dict,
+    entries:       list,
+    experiment_id: int,
+    browser:       str,
+    run_id:        int,
+) -> List[Tuple[str, tuple]]:
+    statements = [(insert_statement("timings"), timing_row(results))]
+    if resources:
+        resources.update(experimentID=experiment_id, browser=browser)
+        statements.append((insert_statement("run_resources"), run_resources_row(resources)))
+    statements += [(insert_statement("resource_timings"), row) for row in entry_rows(entries, run_id, experiment_id)]
+    statements.append((COMPLETE_RUN, (run_id,)))
+    return statements
 
 
 if __name__ == "__main__":
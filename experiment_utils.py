@@ -1,7 +1,10 @@
-import subprocess, json, csv, os
+import subprocess, json, csv, os, time, queue, threading, asyncio
 from sqlite3 import Connection, connect
 from datetime import datetime
+from typing import Dict, List, Tuple, Union
 from tqdm import tqdm
+from performance_entries import resource_timings_fmt
+from tracing import spans_fmt, span, traced
 
 import logging
 logger = logging.getLogger('__main__.' + __name__)
@@ -47,17 +50,27 @@ APPLY_BANDWIDTH  = "sudo tc qdisc add dev {DEVICE} parent 1:1 handle 10: tbf rat
 RESET_FORMAT = "sudo tc qdisc del dev {DEVICE} root"
 
 """
-Emulate the network condition using TC netem and TBF
+Return the (latency, packetloss, bandwidth) tuple of the given network condition,
+which is either a name in condition_to_params or the three numbers separated by spaces
 """
+def condition_params(condition: str) -> tuple:
+    try:
+        return condition_to_params[condition]
+    except KeyError:
+        # Basic attempt to add in custom tc condition
+        return tuple(map(int,condition.split(' ')))
+
+"""
+Emulate the network condition using TC netem and TBF,
+on a device of the given network namespace if there is one
+"""
+@traced("tc_apply")
 def apply_condition(
     device: str, 
     condition: str,
+    netns: str = None,
     ):
-    try:
-        latency, loss, bandwidth = condition_to_params[condition]
-    except KeyError:
-        # Basic attempt to add in custom tc condition
-        latency, loss, bandwidth = map(int,condition.split(' '))
+    latency, loss, bandwidth = condition_params(condition)
     logger.debug(f"{latency}, {loss}, {bandwidth}")
 
     # handeling tc errors
@@ -68,36 +81,41 @@ def apply_condition(
     else:
         command = APPLY_LATENCY_LOSS.format(DEVICE = device, LATENCY = latency, LOSS = loss)
 
-    command_status = run_tc_command(command)
+    command_status = run_tc_command(command, netns)
     # if we have had some trouble setting tc, remove all the previous TC settings, and try setting tc again
     if command_status == 1: # this means that we had some trouble running tc!
-        reset_condition(device) # the trouble should be able to be fixed with removing all the previous setting
+        reset_condition(device, netns) # the trouble should be able to be fixed with removing all the previous setting
         logger.debug("reseting condition")
-        retry_command_status = run_tc_command(command)
+        retry_command_status = run_tc_command(command, netns)
         if retry_command_status == 0:
             logger.debug("reset tc command!")
         else:
 
             logger.error("RESET TC COMMAND FAILED") # if resetting tc does not work, we will keep track of the error
     # applying the second tc command
-    run_tc_command(APPLY_BANDWIDTH.format(DEVICE = device, BANDWIDTH = bandwidth, BURST = bandwidth, LIMIT = 2*bandwidth))
+    run_tc_command(APPLY_BANDWIDTH.format(DEVICE = device, BANDWIDTH = bandwidth, BURST = bandwidth, LIMIT = 2*bandwidth), netns)
 
 """
 Removing the previous TC settings
 """
+@traced("tc_reset")
 def reset_condition(
     device: str, 
+    netns: str = None,
     ):
-    run_tc_command(RESET_FORMAT.format(DEVICE = device))
+    run_tc_command(RESET_FORMAT.format(DEVICE = device), netns)
 
 """
-Apply the given TC command using subprocess
+Apply the given TC command using subprocess, inside the given network namespace if any
 Return 1 if there is some issue running TC
 Return 0 if TC runs successfully
 """
 def run_tc_command(
     command: str,
+    netns: str = None,
 ):
+    if command and netns:
+        command = command.replace("sudo tc", f"sudo ip netns exec {netns} tc", 1)
     if command:
         logger.debug(f"commands are {command}")
         result = subprocess.run(command.split())
@@ -117,7 +135,7 @@ https://docs.google.com/spreadsheets/d/13Ao_zlXyoTtynbOXBAuh_GHTQAvVtB0YMq-Z6y5S
 """
 big_table_fmt = {
     "schemaVer" : "TEXT",
-    "experimentID" : "TEXT",
+    "experimentID" : "INTEGER",
     "webPage" : "TEXT",
     "serverVersion" : "TEXT",
     "gitHash" : "TEXT",
@@ -126,54 +144,59 @@ big_table_fmt = {
     }
 
 monitoring_fmt = {
-    "experimentID" : "TEXT",
+    "experimentID" : "INTEGER",
     "currentTime" : "TEXT",
-    "unixTime" : "INT",
+    "unixTime" : "INTEGER",
     "currentProcNames" : "TEXT",
     "cpuTime" : "TEXT",
-    "ioWait" : "INT",
-    "load_1": "Float",
-    "load_5": "Float",
-    "load_15": "Float",
+    "ioWait" : "INTEGER",
+    "load_1": "REAL",
+    "load_5": "REAL",
+    "load_15": "REAL",
     }
 
 timings_fmt = {
-    "experimentID" : "TEXT",
-    "trafficLoad":    "Float",
+    "experimentID" : "INTEGER",
+    "runID" : "INTEGER",
+    "trafficLoad":    "REAL",
     "pcap": "TEXT",
     "browser" : "TEXT",
     "server" : "TEXT",
     "httpVersion" : "TEXT",
     "payloadSize" : "TEXT",
-    "warmup" : "BOOL",
+    "warmup" : "INTEGER",
     "netemParams" : "TEXT",
-    "startTime" : "Float",
-    "fetchStart" : "Float",
-    "domainLookupStart" : "Float",
-    "domainLookupEnd" : "Float",
-    "connectStart" : "Float", 
-    "secureConnectionStart" : "Float",
-    "connectEnd" : "Float", 
-    "requestStart" : "Float", 
-    "responseStart" : "Float", 
-    "responseEnd" : "Float",
-    "domInteractive" : "Float",
-    "domContentLoadedEventStart" : "Float", 
-    "domContentLoadedEventEnd" : "Float", 
-    "domComplete" : "Float", 
-    "loadEventStart" : "Float",
-    "loadEventEnd" : "Float",
+    "startTime" : "REAL",
+    "fetchStart" : "REAL",
+    "domainLookupStart" : "REAL",
+    "domainLookupEnd" : "REAL",
+    "connectStart" : "REAL", 
+    "secureConnectionStart" : "REAL",
+    "connectEnd" : "REAL", 
+    "requestStart" : "REAL", 
+    "responseStart" : "REAL", 
+    "responseEnd" : "REAL",
+    "domInteractive" : "REAL",
+    "domContentLoadedEventStart" : "REAL", 
+    "domContentLoadedEventEnd" : "REAL", 
+    "domComplete" : "REAL", 
+    "loadEventStart" : "REAL",
+    "loadEventEnd" : "REAL",
     "error" : "TEXT",
+    "nextHopProtocol" : "TEXT",
+    "transferSize" : "INTEGER",
+    "keylog" : "TEXT",
+    "decrypted" : "TEXT",
 }
 
 processes_fmt = {
-    "unixTime" : "INT",
+    "unixTime" : "INTEGER",
     "user" : "TEXT",
-    "pid" : "INT",
-    "CPUPercent" : "Float",
-    "MemoryPercent" : "Float",
-    "VSZ" : "INT",
-    "RSS" : "INT",
+    "pid" : "INTEGER",
+    "CPUPercent" : "REAL",
+    "MemoryPercent" : "REAL",
+    "VSZ" : "INTEGER",
+    "RSS" : "INTEGER",
     "TTY" : "TEXT",
     "stat": "TEXT",
     "start": "TEXT",
@@ -181,94 +204,510 @@ processes_fmt = {
     "commmand": "TEXT"
     }
 
+process_samples_fmt = {
+    "experimentID" : "INTEGER",
+    "unixTime" : "REAL",
+    "pid" : "INTEGER",
+    "name" : "TEXT",
+    "userTime" : "REAL",
+    "systemTime" : "REAL",
+    "RSS" : "INTEGER",
+    "voluntaryCtxSwitches" : "INTEGER",
+    "involuntaryCtxSwitches" : "INTEGER",
+    "readBytes" : "INTEGER",
+    "writeBytes" : "INTEGER",
+    }
+
+run_resources_fmt = {
+    "runID" : "INTEGER",
+    "experimentID" : "INTEGER",
+    "browser" : "TEXT",
+    "rootPid" : "INTEGER",
+    "procs" : "INTEGER",
+    "userTime" : "REAL",
+    "systemTime" : "REAL",
+    "peakRSS" : "INTEGER",
+    "bytesSent" : "INTEGER",
+    "bytesRecv" : "INTEGER",
+    "concurrentRuns" : "INTEGER",
+    "duration" : "REAL",
+    }
+
+"""
+QUIC metrics of every connection of a run, extracted from the Firefox qlogs and the
+Chromium/Edge netlogs (see quic_metrics.py). Times are milliseconds. A warm browser
+writes a single netlog, named after the run it was launched for, so its connections
+are all attributed to that run.
+"""
+quic_metrics_fmt = {
+    "experimentID" : "INTEGER",
+    "runID" : "INTEGER",
+    "browser" : "TEXT",
+    "file" : "TEXT",
+    "connection" : "TEXT",
+    "handshakeRtt" : "REAL",
+    "smoothedRtt" : "REAL",
+    "minRtt" : "REAL",
+    "maxCwnd" : "INTEGER",
+    "packetsSent" : "INTEGER",
+    "packetsReceived" : "INTEGER",
+    "packetsLost" : "INTEGER",
+    "packetsRetransmitted" : "INTEGER",
+    "zeroRtt" : "INTEGER",
+    "streams" : "INTEGER",
+    }
+
+sampler_overhead_fmt = {
+    "experimentID" : "INTEGER",
+    "unixTime" : "REAL",
+    "samples" : "INTEGER",
+    "trackedProcs" : "INTEGER",
+    "wallTime" : "REAL",
+    "cpuTime" : "REAL",
+    }
+
+"""
+Experiment plans (see plan.py): one row per plan in `plans`, and one row per run of a plan
+in `plan`, with `completed` set to 1 in the same transaction as the run's results
+"""
+plans_fmt = {
+    "planID" : "INTEGER",
+    "planKey" : "TEXT",
+    "created" : "REAL",
+    "args" : "TEXT",
+    }
+
+plan_fmt = {
+    "planID" : "INTEGER",
+    "experimentID" : "INTEGER",
+    "runID" : "INTEGER",
+    "position" : "INTEGER",
+    "url" : "TEXT",
+    "endpoint" : "TEXT",
+    "payload" : "TEXT",
+    "condition" : "TEXT",
+    "browser" : "TEXT",
+    "h3" : "INTEGER",
+    "repetition" : "INTEGER",
+    "completed" : "INTEGER",
+    }
+
+"""
+Pre-flight probe of every endpoint/payload combination of a plan (see preflight.py), times
+in milliseconds. Combinations that are not ok are left out of the sweep.
+"""
+preflight_fmt = {
+    "planID" : "INTEGER",
+    "unixTime" : "REAL",
+    "endpoint" : "TEXT",
+    "payload" : "TEXT",
+    "url" : "TEXT",
+    "host" : "TEXT",
+    "port" : "INTEGER",
+    "addresses" : "TEXT",
+    "dnsTime" : "REAL",
+    "tcpTime" : "REAL",
+    "tlsTime" : "REAL",
+    "tlsVersion" : "TEXT",
+    "alpn" : "TEXT",
+    "altSvc" : "TEXT",
+    "quicVersions" : "TEXT",
+    "quicTime" : "REAL",
+    "h3" : "INTEGER",
+    "ok" : "INTEGER",
+    "error" : "TEXT",
+    }
+
+table_fmts = {
+    "big_table" : big_table_fmt,
+    "monitoring" : monitoring_fmt,
+    "timings" : timings_fmt,
+    "processes" : processes_fmt,
+    "process_samples" : process_samples_fmt,
+    "sampler_overhead" : sampler_overhead_fmt,
+    "run_resources" : run_resources_fmt,
+    "resource_timings" : resource_timings_fmt,
+    "spans" : spans_fmt,
+    "plans" : plans_fmt,
+    "plan" : plan_fmt,
+    "quic_metrics" : quic_metrics_fmt,
+    "preflight" : preflight_fmt,
+    }
+
 # the default output database
 out = "results/results.db"
+# by default, buffered rows are written once there are this many of them,
+# or once this many seconds have passed since the last write
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 5.0
+# rows waiting for the writer thread before writers are made to wait
+QUEUE_SIZE = 10000
+# failed writes are retried this many times, waiting twice as long each time
+FLUSH_RETRIES = 5
+RETRY_DELAY = 0.5
 
 """
-Set up the database in the output directory
+Indexes of the tables besides the ones on experimentID, which every table with that column
+gets: the grouping columns of analysis.py and the joins of the monitoring data on time
+"""
+table_indexes = {
+    "timings" : [("browser", "httpVersion", "netemParams", "payloadSize")],
+    "monitoring" : [("unixTime",)],
+    "process_samples" : [("unixTime",)],
+    # completing a run of a plan looks it up by ID
+    "plan" : [("runID",)],
+    "preflight" : [("planID",)],
+    }
+
+"""
+Primary key of every table: an `id` column that is the rowid, so that the cursors that
+follow the rowids of a table (analysis.py, export.py, postprocess.py) keep working,
+except for the tables with an ID of their own
+"""
+table_keys = {
+    "plans" : "planID",
+    }
+
+"""
+Return the CREATE TABLE statement of the given table
+"""
+def create_table_statement(table: str, name: str = None) -> str:
+    fmt = table_fmts[table]
+    key = table_keys.get(table, "id")
+    columns = [f"{column} {sql_type}" for column, sql_type in fmt.items() if column != key]
+    return f"CREATE TABLE IF NOT EXISTS {name or table} ({key} INTEGER PRIMARY KEY, {', '.join(columns)})"
+
+"""
+Migration to schema version 1: rebuild the tables of older databases, which had no primary
+key, experimentID as TEXT and Float/BOOL pseudo-types, with their current definition.
+Rows keep their rowid, and empty strings (the placeholders of missing timings) become NULL
+in the numeric columns.
+"""
+def rebuild_tables(database: Connection):
+    for table, fmt in table_fmts.items():
+        existing = [row[1] for row in database.execute(f"PRAGMA table_info({table})")]
+        if not existing:
+            continue
+        logger.info(f"Rebuilding table {table}")
+        database.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        database.execute(create_table_statement(table))
+        key = table_keys.get(table, "id")
+        columns = [column for column in fmt if column in existing and column != key]
+        values = [column if fmt[column] == "TEXT" else f"NULLIF({column}, '')" for column in columns]
+        source_key = key if key in existing else "rowid"
+        database.execute(f"INSERT INTO {table} ({key}, {', '.join(columns)}) "
+                         f"SELECT {source_key}, {', '.join(values)} FROM {table}_old")
+        # the indexes of the old table go with it, and are created again afterwards
+        database.execute(f"DROP TABLE {table}_old")
+
+"""
+Migrations of the schema, in order: the migration at index i upgrades a database of schema
+version i. The version of a database is its user_version, 0 for databases from before
+migrations.
+"""
+MIGRATIONS = [
+    rebuild_tables,
+    ]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+"""
+Set up the database in the output directory: upgrade its schema if it is older, and create
+the tables, columns and indexes that do not exist yet
 return the handle/reference of the database
 """
 def setup_data_file_headers(
     out: str
 ):
-    # If this database is an previous database, directly return the reference.
-    # However, if the existing database is set up with different headers,
-    # we will run into error when try to write to the database
-    if os.path.exists(out):
-        return connect(out)
-    
     # If directory doesn't exist, can't connect
-    # Create a new database
-    if out != ":memory:":
-        os.makedirs(os.path.dirname(out), exist_ok = True)
-
-    # Create headers for new database
-    # Generate statements that creates and populates database tables
-    big_table = ""
-    for key in big_table_fmt.keys():
-        big_table += f"{key} {big_table_fmt[key]}, "
-    monitoring = ""
-    for key in monitoring_fmt.keys():
-        monitoring += f"{key} {monitoring_fmt[key]}, "
-    timings = ""
-    for key in timings_fmt.keys():
-        timings += f"{key} {timings_fmt[key]}, "
-    processes = ""
-    for key in processes_fmt.keys():
-        processes += f"{key} {processes_fmt[key]}, "
-    create_big_db = f"CREATE TABLE big_table ({big_table[:-2]});"
-    create_monitoring_db = f"CREATE TABLE monitoring ({monitoring[:-2]});"
-    create_timing_db = f"CREATE TABLE timings ({timings[:-2]})"
-    create_processes_db = f"CREATE TABLE processes ({processes[:-2]})"
-
-    # Execute the statements generated above and set up headers for the tables
-    database = connect(out)  
-    database.execute(create_big_db)
-    database.execute(create_monitoring_db)
-    database.execute(create_timing_db)
-    database.execute(create_processes_db)
-    database.commit()
+    if out != ":memory:" and not os.path.exists(out):
+        os.makedirs(os.path.dirname(out) or ".", exist_ok = True)
+
+    database = connect_database(out)
+    # the harness and the monitoring processes set up the same database, the first one
+    # upgrades it while the others wait
+    database.execute("BEGIN IMMEDIATE")
+    try:
+        version = database.execute("PRAGMA user_version").fetchone()[0]
+        if not database.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]:
+            # new databases are created with the current schema
+            version = SCHEMA_VERSION
+        if version > SCHEMA_VERSION:
+            logger.warning(f"{out} has schema version {version}, newer than {SCHEMA_VERSION}")
+        for new_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info(f"Migrating {out} to schema version {new_version}")
+            migration(database)
+
+        # Create the tables and columns that do not exist yet, so that previous databases
+        # get the tables and columns added since they were created
+        for table, fmt in table_fmts.items():
+            database.execute(create_table_statement(table))
+            existing = [row[1] for row in database.execute(f"PRAGMA table_info({table})")]
+            for key in fmt.keys():
+                if key not in existing:
+                    database.execute(f"ALTER TABLE {table} ADD COLUMN {key} {fmt[key]}")
+            indexes = [("experimentID",)] if "experimentID" in fmt else []
+            for columns in indexes + table_indexes.get(table, []):
+                database.execute(f"CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)} ON {table} ({', '.join(columns)})")
+        if database.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            database.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        database.commit()
+    except Exception:
+        database.rollback()
+        database.close()
+        raise
     return database
 
+"""
+Connect to the database in WAL mode, so that the harness and the monitoring processes
+can write to the same file without blocking each other's readers
+"""
+def connect_database(out: str) -> Connection:
+    # the monitoring processes write to the same database, wait for their locks
+    database = connect(out, timeout=30)
+    database.execute("PRAGMA journal_mode=WAL")
+    database.execute("PRAGMA synchronous=NORMAL")
+    return database
+
+"""
+Return the INSERT statement for the given table
+"""
+def insert_statement(table: str) -> str:
+    # name the columns, since older databases may have them in a different order
+    columns = ", ".join(table_fmts[table].keys())
+    return f"INSERT INTO {table} ({columns}) VALUES ({ ('?,' * len(table_fmts[table]))[:-1]})"
+
+"""
+Buffers rows and writes them with executemany, all pending rows in a single transaction.
+Rows are written once `flush_size` rows are pending or `flush_interval` seconds have passed
+since the last write, and when the writer is flushed or closed.
+"""
+class BufferedWriter():
+    def __init__(self, out: str, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.db = setup_data_file_headers(out)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # statement -> rows waiting to be written with it
+        self.pending: Dict[str, List[tuple]] = {}
+        self.num_pending = 0
+        self.last_flush = time.monotonic()
+
+    def insert(self, table: str, row: tuple):
+        self.execute(insert_statement(table), row)
+
+    def execute(self, statement: str, row: tuple):
+        self.execute_group([(statement, row)])
+
+    """
+    Buffer the given (statement, row) pairs together: they are always written in the same
+    transaction, e.g. the results of a run and the statement marking it as completed
+    """
+    def execute_group(self, items: List[Tuple[str, tuple]]):
+        for statement, row in items:
+            self.pending.setdefault(statement, []).append(row)
+        self.num_pending += len(items)
+        if self.num_pending >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            # the connection context manager commits once, or rolls back on error
+            with span("db_flush"), self.db:
+                for statement, rows in self.pending.items():
+                    self.db.executemany(statement, rows)
+            logger.debug(f"Wrote {self.num_pending} rows")
+        self.pending = {}
+        self.num_pending = 0
+        self.last_flush = time.monotonic()
+
+    """
+    Write the rows of every statement in a transaction of their own, dropping only the
+    statements that still fail: the last resort once retrying the whole flush did not work
+    """
+    def flush_each(self):
+        for statement, rows in list(self.pending.items()):
+            try:
+                with self.db:
+                    self.db.executemany(statement, rows)
+            except Exception as e:
+                logger.error(f"Dropping {len(rows)} rows that could not be written with {statement}: {e}")
+            del self.pending[statement]
+            self.num_pending -= len(rows)
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+"""
+Writes rows on a dedicated thread that owns the database connection, so that callers
+(in particular the asyncio event loop of async experiments) never wait on disk I/O.
+Rows go through a bounded queue: when it is full `insert` blocks and `insert_async`
+waits without blocking the event loop. `close` drains the queue before returning.
+"""
+class ThreadedWriter():
+    # queue items asking the thread to flush, and to drain and stop
+    FLUSH = "flush"
+    CLOSE = "close"
+
+    def __init__(self, out: str, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 queue_size: int = QUEUE_SIZE):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        # create the tables here so that setup errors surface in the caller
+        setup_data_file_headers(out).close()
+        self.thread = threading.Thread(target=self.run, args=(out,), name="database-writer", daemon=True)
+        self.thread.start()
+
+    def run(self, out: str):
+        # sqlite connections can only be used by the thread that created them
+        writer = BufferedWriter(out, self.flush_size, self.flush_interval)
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = self.FLUSH
+            if item == self.CLOSE:
+                break
+            try:
+                if item == self.FLUSH:
+                    writer.flush()
+                else:
+                    writer.execute_group(item)
+            except Exception as e:
+                self.retry(writer, e)
+        try:
+            writer.flush()
+        except Exception as e:
+            self.retry(writer, e)
+        writer.close()
+
+    """
+    Retry writing the pending rows with backoff, which keeps them buffered (e.g. while the
+    database is locked by another process), then write them statement by statement
+    """
+    def retry(self, writer: BufferedWriter, error: Exception):
+        delay = RETRY_DELAY
+        for _ in range(FLUSH_RETRIES):
+            logger.warning(f"Writing {writer.num_pending} rows failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            delay *= 2
+            try:
+                writer.flush()
+                return
+            except Exception as e:
+                error = e
+        logger.error(f"Writing {writer.num_pending} rows failed {FLUSH_RETRIES + 1} times ({error})")
+        writer.flush_each()
+
+    def insert(self, table: str, row: tuple):
+        self.execute(insert_statement(table), row)
+
+    def execute(self, statement: str, row: tuple):
+        self.execute_group([(statement, row)])
+
+    def execute_group(self, items: List[Tuple[str, tuple]]):
+        self.queue.put(items)
+
+    async def insert_async(self, table: str, row: tuple):
+        await self.execute_group_async([(insert_statement(table), row)])
+
+    async def execute_group_async(self, items: List[Tuple[str, tuple]]):
+        item = items
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # backpressure: wait for room off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.queue.put, item)
+
+    def flush(self):
+        self.queue.put(self.FLUSH)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(self.CLOSE)
+            self.thread.join()
+
+Writer = Union[BufferedWriter, ThreadedWriter]
+
+"""
+Write the given data in json to the big_table table using the given writer
+"""
+def write_big_table_data(data: json, db: Writer):
+    db.insert("big_table", data)
+
+"""
+Write the given data in json to the timing table using the given writer
+"""
+def write_timing_data(data: json, db: Writer):
+    db.insert("timings", timing_row(data))
+
+"""
+Turn the given data in json into a row of the timing table.
+If data does not include a key from the timing table header, eg: data does not include "server"
+write an empty string to the key as a placeholder, eg: "server": "", or NULL for the numeric keys
+"""
+def timing_row(data: json) -> tuple:
+    return tuple([data[key] if key in data else ("" if sql_type == "TEXT" else None)
+                  for key, sql_type in timings_fmt.items()])
+
+"""
+Write the given data tuple to the monitoring table using the given writer
+"""
+def write_monitoring_data(data_tuple: tuple, db: Writer):
+    db.insert("monitoring", data_tuple)
+
+"""
+Write the given data tuple to the processes table using the given writer
+"""
+def write_processes_data(data_tuple: tuple, db: Writer):
+    db.insert("processes", data_tuple)
+
+"""
+Write the given data tuple to the process_samples table using the given writer
+"""
+def write_process_sample_data(data_tuple: tuple, db: Writer):
+    db.insert("process_samples", data_tuple)
+
+"""
+Write the given data tuple to the sampler_overhead table using the given writer
+"""
+def write_sampler_overhead_data(data_tuple: tuple, db: Writer):
+    db.insert("sampler_overhead", data_tuple)
+
+"""
+Write the resources used by a single run to the run_resources table using the given writer
+"""
+def write_run_resources_data(data: json, db: Writer):
+    db.insert("run_resources", run_resources_row(data))
 
 """
-Write the given data in json to the big_table table in the given database
+Turn the given data in json into a row of the run_resources table
 """
-def write_big_table_data(data: json, db: Connection):
-    insert = f"INSERT INTO big_table VALUES ({ ('?,' * len(big_table_fmt))[:-1]})"
-    db.execute(insert, data)
-    db.commit()
+def run_resources_row(data: json) -> tuple:
+    return tuple([data.get(key) for key in run_resources_fmt.keys()])
 
 """
-Write the given data in json to the timing table in the given database
+Write the given rows to the resource_timings table using the given writer
 """
-def write_timing_data(data: json, db: Connection):
-    insert = f"INSERT INTO timings VALUES ({ ('?,' * len(timings_fmt))[:-1]})"
-    # if data does not include a key from the timing table header, eg: data does not include "server"
-    # write an empty string to the key as a placeholder, eg: "server": "";
-    data_tuple = tuple([data[key] if key in data else "" for key in timings_fmt.keys()])
-    db.execute(insert, data_tuple)
-    db.commit()
+def write_resource_timings_data(rows: list, db: Writer):
+    for row in rows:
+        db.insert("resource_timings", row)
 
 """
-Given the name of the database, we first make an connection/reference to the database,
-then write the given data in json to the monitoring table of that database
+Write the given rows (see tracing.Tracer.drain) to the spans table using the given writer
 """
-def write_monitoring_data(data_tuple: tuple, output_database_name: str):
-    insert = f"INSERT INTO monitoring VALUES ({ ('?,' * len(monitoring_fmt))[:-1]})"
-    db = setup_data_file_headers(output_database_name)  
-    db.execute(insert, data_tuple)
-    db.commit()
+def write_spans_data(rows: list, db: Writer):
+    for row in rows:
+        db.insert("spans", row)
 
 """
-Given the name of the database, we first make an connection/reference to the database,
-then write the given data in json to the processes table of that database
+Write the given probes (see preflight.py) of the given plan to the preflight table using the given writer
 """
-def write_processes_data(data_tuple: tuple, output_database_name: str):
-    insert = f"INSERT INTO processes VALUES ({ ('?,' * len(processes_fmt))[:-1]})"
-    db = setup_data_file_headers(output_database_name)  
-    db.execute(insert, data_tuple)
-    db.commit()
+def write_preflight_data(probes: list, plan_id: int, db: Writer):
+    now = time.time()
+    for probe in probes:
+        db.insert("preflight", probe.row(plan_id, now))
 
 """
 Get the current time in terms of year/month/day hour:minute:second
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import argparse
+from typing import Dict, List
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+from analysis import PHASES
+from experiment_utils import timings_fmt, monitoring_fmt, big_table_fmt, run_resources_fmt, setup_data_file_headers
+
+"""
+Columnar export of a results database.
+
+The timings, monitoring, experiments (big_table) and runs (run_resources) tables are
+written as Parquet datasets, partitioned in hive style (e.g.
+timings/experimentID=.../netemParams=.../browser=.../part-*.parquet), so that analysis
+tools (pandas, polars, DuckDB, Arrow.jl) read only the columns and partitions they need.
+The phase durations of every run (the PHASES of analysis.py, and the connectTime,
+secureConnectTime, requestToResponse and responseTime of sqlite.jl) are computed once,
+column at a time with Arrow compute, and stored next to the timings.
+
+Exports are incremental: the last rowid exported from every table is kept in
+_export_state.json in the output directory, and each export only appends new part files
+with the rows added since, so earlier files are never rewritten.
+"""
+
+CHUNK_SIZE = 100000
+STATE_FILE = "_export_state.json"
+
+# duration columns of the timings: (end, start) columns
+DURATIONS = dict(PHASES, **{
+    "connectTime": ("connectEnd", "connectStart"),
+    "secureConnectTime": ("connectEnd", "secureConnectionStart"),
+    "requestToResponse": ("responseStart", "requestStart"),
+    "responseTime": ("responseEnd", "responseStart"),
+})
+
+# dataset: (table, columns with their type, partition columns)
+# monitoring rows only know their experiment, the condition comes from big_table
+EXPORTS = {
+    "timings": ("timings", timings_fmt, ["experimentID", "netemParams", "browser"]),
+    "monitoring": ("monitoring", dict(monitoring_fmt, condition="TEXT"), ["experimentID", "condition"]),
+    "experiments": ("big_table", big_table_fmt, ["experimentID"]),
+    "runs": ("run_resources", run_resources_fmt, ["experimentID", "browser"]),
+}
+
+
+def arrow_type(sql_type: str) -> "pa.DataType":
+    return {"TEXT": pa.string(), "INTEGER": pa.int64(), "REAL": pa.float64()}[sql_type.upper()]
+
+
+"""
+Return the value as the given type; SQLite columns are loosely typed, and missing values
+of the timings from before schema version 1 are empty strings
+"""
+def convert(value, sql_type: str):
+    if value is None or value == "":
+        return None
+    sql_type = sql_type.upper()
+    try:
+        if sql_type == "TEXT":
+            return str(value)
+        if sql_type == "INTEGER":
+            return int(value)
+        if sql_type == "REAL":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+def query(name: str) -> str:
+    table, fmt, _ = EXPORTS[name]
+    if name == "monitoring":
+        columns = ", ".join(f"monitoring.{column}" for column in monitoring_fmt)
+        return f"""SELECT monitoring.rowid, {columns}, big_table.condition FROM monitoring
+                   LEFT JOIN big_table ON big_table.experimentID = monitoring.experimentID
+                   WHERE monitoring.rowid > ? ORDER BY monitoring.rowid LIMIT ?"""
+    return f"SELECT rowid, {', '.join(fmt)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+
+
+"""
+Build the Arrow table of the given rows, with the durations for the timings
+"""
+def to_arrow(name: str, rows: List[tuple]) -> "pa.Table":
+    _, fmt, partitions = EXPORTS[name]
+    columns = {}
+    for i, (column, sql_type) in enumerate(fmt.items()):
+        if column in partitions:
+            # partition values name directories, as they are (e.g. the "benchmark" experimentID)
+            values = ["none" if row[i] in (None, "") else str(row[i]) for row in rows]
+            columns[column] = pa.array(values, pa.string())
+        else:
+            columns[column] = pa.array([convert(row[i], sql_type) for row in rows], arrow_type(sql_type))
+    table = pa.table(columns)
+    if name == "timings":
+        for duration, (end, start) in DURATIONS.items():
+            table = table.append_column(duration, pc.subtract(table[end], table[start]))
+    return table
+
+
+class ParquetExport():
+    def __init__(self, database: str, out: str):
+        if pa is None:
+            raise ImportError("The Parquet export needs pyarrow: pip3 install pyarrow")
+        self.database = database
+        self.out = out
+        self.state_path = os.path.join(out, STATE_FILE)
+        self.state: Dict[str, int] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        # replaced at once, so that an interrupted export never leaves a partial state
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    """
+    Append the rows added to the table since the last export, return how many there were
+    """
+    def export(self, name: str, chunk_size: int = CHUNK_SIZE) -> int:
+        _, _, partitions = EXPORTS[name]
+        # databases from before a table or column was added get it, empty
+        db = setup_data_file_headers(self.database)
+        exported = 0
+        try:
+            while True:
+                last = self.state.get(name, 0)
+                rows = db.execute(query(name), (last, chunk_size)).fetchall()
+                if not rows:
+                    break
+                table = to_arrow(name, [row[1:] for row in rows])
+                first_rowid, last_rowid = rows[0][0], rows[-1][0]
+                # part files are named after their rows, an export never overwrites another
+                ds.write_dataset(table, os.path.join(self.out, name), format="parquet",
+                                 partitioning=partitions, partitioning_flavor="hive",
+                                 basename_template=f"part-{first_rowid}-{last_rowid}-{{i}}.parquet",
+                                 existing_data_behavior="overwrite_or_ignore")
+                self.state[name] = last_rowid
+                self.save_state()
+                exported += len(rows)
+        finally:
+            db.close()
+        return exported
+
+    def export_all(self, names: List[str] = None) -> Dict[str, int]:
+        os.makedirs(self.out, exist_ok=True)
+        return {name: self.export(name) for name in (names or EXPORTS)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="incrementally export a results database to partitioned Parquet")
+    parser.add_argument("database", metavar="DB", help="results database")
+    parser.add_argument("out", metavar="DIR", help="directory of the Parquet datasets")
+    parser.add_argument("--tables", nargs="+", default=list(EXPORTS), choices=list(EXPORTS),
+                        help="datasets to export (default: all of them)")
+    args = parser.parse_args()
+
+    counts = ParquetExport(args.database, args.out).export_all(args.tables)
+    for name, count in counts.items():
+        print(f"{name}: {count} new rows", file=sys.stderr)
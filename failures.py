@@ -0,0 +1,133 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from analysis import QuantileSketch
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Failure tracking of the runs of a sweep.
+
+A combination that keeps failing (a dead endpoint, a browser that cannot do h3 with a
+server, a condition too lossy for a payload) used to cost a full navigation timeout on
+every one of its runs. Every (endpoint, browser, httpVersion, condition) combination now
+has a circuit breaker: after `max_failures` failed runs in a row it opens, and the runs of
+the combination are skipped for a cooldown. Once the cooldown is over, a single run is let
+through (half-open): if it succeeds the breaker closes, if it fails the breaker opens
+again for twice as long. Skipped runs are not marked in the plan, so `--resume` does them.
+
+The navigation timeout of a run also comes from the runs done so far: once its combination
+has `MIN_SAMPLES` page loads, the timeout is `factor` times the 99th percentile of their
+load times, within [MIN_TIMEOUT, MAX_TIMEOUT], instead of a fixed minute. Until then the
+load times of the other browsers and HTTP versions of the same endpoint/payload under the
+same condition are used, once they are enough; other payloads are never mixed in, a 5mb
+page must not get the timeout of a 1kb one.
+Page loads that timed out count at their timeout, so that a slow combination does not keep
+shrinking its own timeout by only counting the loads that made it. Page loads under a fast
+condition then fail in seconds, and slow endpoints, payloads and conditions get the time
+they need.
+"""
+
+# milliseconds, the navigation timeout before an endpoint/payload has enough samples under a condition
+DEFAULT_TIMEOUT = 60000
+MIN_TIMEOUT = 10000
+MAX_TIMEOUT = 180000
+MIN_SAMPLES = 10
+MAX_FAILURES = 3
+TIMEOUT_FACTOR = 3
+# seconds a breaker stays open the first time, doubled every time its trial run fails
+COOLDOWN = 60
+MAX_COOLDOWN = 900
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class Breaker():
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = COOLDOWN
+        self.reopen = 0.0
+
+
+"""
+Return the load time of a page load, in milliseconds: the timeout for page loads that timed
+out (see `timedOut` in launchBrowserSync.py), None for the other failed ones
+"""
+def load_time(results: dict) -> Optional[float]:
+    if results.get("error"):
+        return results.get("timedOut")
+    start = results.get("startTime") or 0
+    for end in (results.get("loadEventEnd"), results.get("responseEnd")):
+        if isinstance(end, (int, float)) and end > start:
+            return end - start
+    return None
+
+
+class FailureTracker():
+    def __init__(self, max_failures: int = MAX_FAILURES, factor: float = TIMEOUT_FACTOR):
+        # 0 turns the breakers off
+        self.max_failures = max_failures
+        self.factor = factor
+        # (endpoint URL, browser, httpVersion, condition): breaker
+        self.breakers: Dict[Tuple[str, str, str, str], Breaker] = {}
+        # (endpoint URL, browser, httpVersion, condition): load times of its page loads
+        self.load_times: Dict[Tuple[str, str, str, str], QuantileSketch] = {}
+        # (endpoint URL, condition): load times of the page loads of all its browsers and httpVersions
+        self.endpoint_load_times: Dict[Tuple[str, str], QuantileSketch] = {}
+
+    def key(self, endpoint, browser: str, h3: bool, condition: str) -> Tuple[str, str, str, str]:
+        return (endpoint.get_url(), browser, "h3" if h3 else "h2", condition)
+
+    """
+    Return True if the run of the combination should be done, False if it is skipped
+    """
+    def allow(self, endpoint, browser: str, h3: bool, condition: str) -> bool:
+        breaker = self.breakers.get(self.key(endpoint, browser, h3, condition))
+        if breaker is None or breaker.state == CLOSED:
+            return True
+        if breaker.state == OPEN and time.monotonic() >= breaker.reopen:
+            # let a single trial run through, the other runs wait for its result
+            breaker.state = HALF_OPEN
+            return True
+        return False
+
+    """
+    Add the results of a run of the combination
+    """
+    def add(self, endpoint, browser: str, h3: bool, condition: str, results: dict):
+        key = self.key(endpoint, browser, h3, condition)
+        duration = load_time(results)
+        if duration is not None:
+            self.load_times.setdefault(key, QuantileSketch()).add(duration)
+            self.endpoint_load_times.setdefault((endpoint.get_url(), condition), QuantileSketch()).add(duration)
+        if self.max_failures <= 0:
+            return
+        breaker = self.breakers.setdefault(key, Breaker())
+        if not results.get("error"):
+            if breaker.state != CLOSED:
+                logger.info(f"{' '.join(key)}: run succeeded, closing the breaker")
+            self.breakers[key] = Breaker()
+            return
+        breaker.failures += 1
+        if breaker.state == HALF_OPEN:
+            breaker.cooldown = min(breaker.cooldown * 2, MAX_COOLDOWN)
+        elif breaker.state == OPEN or breaker.failures < self.max_failures:
+            # results of runs that were already in flight when the breaker opened
+            return
+        breaker.state = OPEN
+        breaker.reopen = time.monotonic() + breaker.cooldown
+        logger.warning(f"{' '.join(key)}: {breaker.failures} failed runs in a row, skipping its runs for {breaker.cooldown} s")
+
+    """
+    Return the navigation timeout of a run of the combination, in milliseconds
+    """
+    def timeout(self, endpoint, browser: str, h3: bool, condition: str) -> float:
+        for sketch in (self.load_times.get(self.key(endpoint, browser, h3, condition)),
+                       self.endpoint_load_times.get((endpoint.get_url(), condition))):
+            if sketch is not None and sketch.count >= MIN_SAMPLES:
+                return min(max(self.factor * sketch.quantile(0.99), MIN_TIMEOUT), MAX_TIMEOUT)
+        return DEFAULT_TIMEOUT
@@ -1,46 +1,71 @@
 import json
 import sys
 from typing import List
+from playwright.async_api import Browser, TimeoutError as PlaywrightTimeoutError
 from tqdm import tqdm
 import re, os, time, glob, asyncio
 
 from experiment_utils import reset_condition, apply_condition
 from endpoint import Endpoint
+from browser_pool import AsyncBrowserPool, pool_key
+from run_resources import RunResourceTracker, browser_env
+from performance_entries import TIMING_FUNCTION, parse_timing
+from local_server import spki_hash
+from tracing import span, traced
+from quic_metrics import netlog_name
+from failures import DEFAULT_TIMEOUT
 
 import logging
 logger = logging.getLogger('__main__.' + __name__)
 
 """
-Sets up asynchronous execution of the run
-and returns the input parameters used so that
-they can be recorded.
+Invoke the specified browser launch functions, return the navigation timing data
 """
-def do_single_run_async(
-    condition: str, 
-    device: str, 
-    pw_instance: "SyncPlaywrightContextManager", 
-    browser_type: str, 
+async def launch_browser_async(
+    pw_instance: "AsyncPlaywrightContextManager", 
+    browser_type: str,
     h3: bool,
     endpoint: Endpoint,
     warmup: bool,
     qlog: bool,
     pcap: bool,
     expnt_id: int,
-    run_id: int
+    run_id: int,
+    pool: AsyncBrowserPool = None,
+    tracker: RunResourceTracker = None,
+    timeout: float = DEFAULT_TIMEOUT,
 ) -> json:
-    task = asyncio.create_task(
-            launch_browser_async(
-                pw_instance, browser_type, h3, endpoint, warmup,
-                qlog, pcap, expnt_id, run_id
-            )
-    )
-    combo = (condition, endpoint, browser_type, h3)
-    return (task, combo)
+    # without a pool, every run launches (and closes) its own browser
+    if pool is None:
+        pool = AsyncBrowserPool(cold=True)
+    key = pool_key(browser_type, h3, qlog, pcap, endpoint, expnt_id)
+    with span("acquire_browser"):
+        browser = await pool.acquire(key, lambda marker: launch_async(pw_instance, browser_type, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, not pool.cold), run_id)
+    # if browser fails to launch, stop this request and write to the database
+    if not browser: 
+        return {"error": "launch_browser_failed"}
+
+    # finding and polling the browser processes reads /proc, so keep it off the event loop
+    loop = asyncio.get_running_loop()
+    if tracker:
+        with span("track_start"):
+            await loop.run_in_executor(None, tracker.start, run_id, pool.marker_of(browser))
+    with span("get_results"):
+        result = await get_results_async(browser, h3, endpoint, warmup, timeout)
+    if tracker:
+        with span("track_stop"):
+            result["resources"] = await loop.run_in_executor(None, tracker.stop, run_id)
+    if pcap:
+        # a warm browser keeps writing to the key log of the run it was launched for
+        result["keylog"] = f"results/packets/async-{expnt_id}/{browser_type}/{pool.launch_run_of(browser)}-{h3}.keys"
+    with span("release_browser"):
+        await pool.release(browser)
+    return result
 
 """
-Invoke the specified browser launch functions, return the navigation timing data
+Launch the specified browser, return None if it fails to launch
 """
-async def launch_browser_async(
+async def launch_async(
     pw_instance: "AsyncPlaywrightContextManager", 
     browser_type: str,
     h3: bool,
@@ -50,24 +75,22 @@ async def launch_browser_async(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
     browser = None
     if browser_type  ==  "firefox":
-        browser = await launch_firefox_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
+        browser = await launch_firefox_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker)
     elif browser_type  ==  "chromium":
-        browser = await launch_chromium_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
+        browser = await launch_chromium_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, warm)
     elif browser_type  ==  "edge":
-        browser = await launch_edge_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
-    # if browser fails to launch, stop this request and write to the database
-    if not browser: 
-        return {"error": "launch_browser_failed"}
+        browser = await launch_edge_async(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, warm)
+    return browser
 
-    result = await get_results_async(browser, h3, endpoint, warmup)
-    asyncio.create_task(browser.close())
-    return result
 """
 Launch the firefox browser
 """
+@traced("launch_firefox")
 async def launch_firefox_async(
     pw_instance: "AsyncPlaywrightContextManager", 
     h3: bool,
@@ -77,7 +100,8 @@ async def launch_firefox_async(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+) -> Browser:
     # set up firefox preference
     firefox_prefs = {}
     firefox_prefs["privacy.reduceTimerPrecision"] = False
@@ -96,18 +120,12 @@ async def launch_firefox_async(
         firefox_prefs["network.http.http3.alt-svc-mapping-for-testing"] = f"{endpoint.port};h3-{h3_version}=:{port}"       
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/async-{expnt_id}/firefox/{run_id}-{h3}.keys"
-            return await pw_instance.firefox.launch(
-                headless=True,
-                firefox_user_prefs=firefox_prefs,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return await pw_instance.firefox.launch(
-                headless=True,
-                firefox_user_prefs=firefox_prefs,
-            )
+        keylog = f"{os.getcwd()}/results/packets/async-{expnt_id}/firefox/{run_id}-{h3}.keys" if pcap else None
+        return await pw_instance.firefox.launch(
+            headless=True,
+            firefox_user_prefs=firefox_prefs,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.exception(str(e))
         return None
@@ -115,6 +133,7 @@ async def launch_firefox_async(
 """
 Launch the chromium browser
 """
+@traced("launch_chromium")
 async def launch_chromium_async(
     pw_instance: "AsyncPlaywrightContextManager", 
     h3: bool,
@@ -124,7 +143,9 @@ async def launch_chromium_async(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
     chromium_args = []
     if h3:
         # set up chromium arguments for enabling h3, qlog, h3 version
@@ -135,21 +156,18 @@ async def launch_chromium_async(
         if qlog:
             # set up a directory results/qlogs/chromium/[experimentID] to save qlog
             qlog_dir = f"{os.getcwd()}/results/qlogs/async-{expnt_id}/chromium/"
-            chromium_args.append(f"--log-net-log={qlog_dir}/{run_id}.netlog")
+            chromium_args.append(f"--log-net-log={qlog_dir}/{netlog_name(run_id, warm)}.netlog")
+    if endpoint.is_local():
+        # trust the self-signed certificate of the local reference server
+        chromium_args.append(f"--ignore-certificate-errors-spki-list={spki_hash()}")
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/async-{expnt_id}/chromium/{run_id}-{h3}.keys"
-            return await pw_instance.chromium.launch(
-                headless=True,
-                args=chromium_args,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return await pw_instance.chromium.launch(
-                headless=True,
-                args=chromium_args,
-            )
+        keylog = f"{os.getcwd()}/results/packets/async-{expnt_id}/chromium/{run_id}-{h3}.keys" if pcap else None
+        return await pw_instance.chromium.launch(
+            headless=True,
+            args=chromium_args,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.error(str(e))
         return None
@@ -157,6 +175,7 @@ async def launch_chromium_async(
 """
 Launch the edge browser
 """
+@traced("launch_edge")
 async def launch_edge_async(
     pw_instance: "AsyncPlaywrightContextManager", 
     h3: bool,
@@ -166,7 +185,9 @@ async def launch_edge_async(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
     edge_args = []
     if (h3) :
         edge_args = ["--enable-quic", "--quic-version=h3-29", "--disable-http2"]
@@ -174,24 +195,19 @@ async def launch_edge_async(
         port = endpoint.get_port()
         edge_args.append(f"--origin-to-force-quic-on={domain}:{port}")
         if qlog:
-            qlog_dir = f"{os.getcwd()}/results/async-qlogs/{expnt_id}/edge/"
-            edge_args.append(f"--log-net-log={qlog_dir}/{run_id}.netlog")
+            qlog_dir = f"{os.getcwd()}/results/qlogs/async-{expnt_id}/edge/"
+            edge_args.append(f"--log-net-log={qlog_dir}/{netlog_name(run_id, warm)}.netlog")
+    if endpoint.is_local():
+        edge_args.append(f"--ignore-certificate-errors-spki-list={spki_hash()}")
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/async-{expnt_id}/edge/{run_id}-{h3}.keys"
-            return await pw_instance.chromium.launch(
-                headless=True,
-                executable_path='/opt/microsoft/msedge-dev/msedge',
-                args=edge_args,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return await pw_instance.chromium.launch(
-                headless=True,
-                executable_path='/opt/microsoft/msedge-dev/msedge',
-                args=edge_args,
-            )
+        keylog = f"{os.getcwd()}/results/packets/async-{expnt_id}/edge/{run_id}-{h3}.keys" if pcap else None
+        return await pw_instance.chromium.launch(
+            headless=True,
+            executable_path='/opt/microsoft/msedge-dev/msedge',
+            args=edge_args,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.error(str(e))
         return None
@@ -205,25 +221,29 @@ async def get_results_async(
     h3: bool,
     endpoint: Endpoint,
     warmup: bool,
+    timeout: float = DEFAULT_TIMEOUT,
 ) -> json:
     # set up the browser context and page
-    context = await browser.new_context()
-    page = await context.new_page()
+    with span("new_context"):
+        context = await browser.new_context(ignore_https_errors=endpoint.is_local())
+    with span("new_page"):
+        page = await context.new_page()
     url = endpoint.get_url()
     logger.debug(f"Navigating to url: {url}")
     
     # warm up the browser
-    await warmup_if_specified_async(page, url, warmup)
+    with span("warmup"):
+        await warmup_if_specified_async(page, url, warmup)
     # attempt to navigate to the url
     try:
-        # set the timeout to be 1 min, because under some bad network condition,
-        # connection and data transfer take longer
-        page.set_default_timeout(60000)
-        response = await page.goto(url)
-        # getting performance timing data
-        # if we don't stringify and parse, things break
-        timing_function = '''JSON.stringify(window.performance.getEntriesByType("navigation")[0])'''
-        performance_timing = json.loads(await page.evaluate(timing_function))
+        # 1 min by default, because under some bad network condition connection and data
+        # transfer take longer; the harness passes one based on the condition (see failures.py)
+        page.set_default_timeout(timeout)
+        with span("goto"):
+            response = await page.goto(url)
+        # getting navigation, resource, paint, LCP and layout shift timing data in one go
+        with span("evaluate"):
+            performance_timing = parse_timing(await page.evaluate(TIMING_FUNCTION))
         performance_timing['server'] = response.headers['server']
         if response.status == 404:
             logger.error("404 Response Code")
@@ -233,8 +253,12 @@ async def get_results_async(
         # if we run into error, write it in the database
         logger.error(str(e))
         performance_timing = {'error': str(e)}
+        if isinstance(e, PlaywrightTimeoutError):
+            # the page load took at least the timeout, which still counts as a load time (see failures.py)
+            performance_timing['timedOut'] = timeout
         pass
-    await browser.close()
+    with span("context_close"):
+        await context.close()
     return performance_timing
 
 """
@@ -1,11 +1,20 @@
 import json
 import sys
 from typing import List
+from playwright.sync_api import Browser, TimeoutError as PlaywrightTimeoutError
 from tqdm import tqdm
 import re, os, time, glob
 
 from experiment_utils import reset_condition, apply_condition
 from endpoint import Endpoint
+from browser_pool import BrowserPool, pool_key
+from run_resources import RunResourceTracker, browser_env
+from qdisc import QdiscManager
+from performance_entries import TIMING_FUNCTION, parse_timing
+from local_server import spki_hash
+from tracing import span, traced
+from quic_metrics import netlog_name
+from failures import DEFAULT_TIMEOUT
 
 import logging
 logger = logging.getLogger('__main__.' + __name__)
@@ -16,6 +25,8 @@ First emulate the desired network condition,
 then launch the desired broswer, go to the desired page,
 and get the timing result (or error),
 last, remove the TC setting.
+With a QdiscManager, the condition is only applied if it is not already,
+and is left in place for the next run; the caller resets it.
 Return the navigation timing data
 """
 def do_single_experiment_sync(
@@ -30,10 +41,19 @@ def do_single_experiment_sync(
     pcap: bool,
     expnt_id: int,
     run_id: int,
+    pool: BrowserPool = None,
+    tracker: RunResourceTracker = None,
+    qdisc: QdiscManager = None,
+    timeout: float = DEFAULT_TIMEOUT,
 ) -> json:
-    apply_condition(device, condition)
-    results = launch_browser_sync(pw_instance, browser_type, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
-    reset_condition(device)
+    if qdisc:
+        qdisc.apply(condition)
+    else:
+        apply_condition(device, condition)
+    results = launch_browser_sync(pw_instance, browser_type, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, pool, tracker,
+                                  timeout)
+    if not qdisc:
+        reset_condition(device)
 
     return results
 
@@ -50,28 +70,69 @@ def launch_browser_sync(
     pcap: bool,
     expnt_id: int,
     run_id: int,
+    pool: BrowserPool = None,
+    tracker: RunResourceTracker = None,
+    timeout: float = DEFAULT_TIMEOUT,
 ) -> json:
-    browser = None
-    if browser_type  ==  "firefox":
-        browser = launch_firefox_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
-    elif browser_type  ==  "chromium":
-        browser = launch_chromium_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
-    elif browser_type  ==  "edge":
-        browser = launch_edge_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id)
+    # without a pool, every run launches (and closes) its own browser
+    if pool is None:
+        pool = BrowserPool(cold=True)
+    key = pool_key(browser_type, h3, qlog, pcap, endpoint, expnt_id)
+    with span("acquire_browser"):
+        browser = pool.acquire(key, lambda marker: launch_sync(pw_instance, browser_type, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, not pool.cold), run_id)
     # if browser fails to launch, stop this request and write to the database
     if not browser: 
         return {"error": "launch_browser_failed"}
 
-    result = get_results_sync(browser, h3, endpoint, warmup)
+    if tracker:
+        with span("track_start"):
+            tracker.start(run_id, pool.marker_of(browser))
+    with span("get_results"):
+        result = get_results_sync(browser, h3, endpoint, warmup, timeout)
+    if tracker:
+        with span("track_stop"):
+            result["resources"] = tracker.stop(run_id)
+    if pcap:
+        # a warm browser keeps writing to the key log of the run it was launched for
+        result["keylog"] = f"results/packets/sync-{expnt_id}/{browser_type}/{pool.launch_run_of(browser)}-{h3}.keys"
+    with span("release_browser"):
+        pool.release(browser)
     if h3 and qlog and browser_type == "firefox":
         # change qlogś name so that it will be saved to results/qlogs/firefox/[experimentID]
         for qlog in glob.glob("/tmp/qlog_*/*.qlog", recursive=True):
             qlog_dir = f"{os.getcwd()}/results/qlogs/sync-{expnt_id}/firefox"
             os.rename(qlog, f"{qlog_dir}/{run_id}.qlog")
     return result
+
+"""
+Launch the specified browser, return None if it fails to launch
+"""
+def launch_sync(
+    pw_instance: "SyncPlaywrightContextManager", 
+    browser_type: str,
+    h3: bool,
+    endpoint: Endpoint,
+    warmup: bool,
+    qlog: bool,
+    pcap: bool,
+    expnt_id: int,
+    run_id: int,
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
+    browser = None
+    if browser_type  ==  "firefox":
+        browser = launch_firefox_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker)
+    elif browser_type  ==  "chromium":
+        browser = launch_chromium_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, warm)
+    elif browser_type  ==  "edge":
+        browser = launch_edge_sync(pw_instance, h3, endpoint, warmup, qlog, pcap, expnt_id, run_id, marker, warm)
+    return browser
+
 """
 Launch the firefox browser
 """
+@traced("launch_firefox")
 def launch_firefox_sync(
     pw_instance: "SyncPlaywrightContextManager", 
     h3: bool,
@@ -81,7 +142,8 @@ def launch_firefox_sync(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+) -> Browser:
     # set up firefox preference
     firefox_prefs = {}
     firefox_prefs["privacy.reduceTimerPrecision"] = False
@@ -100,18 +162,12 @@ def launch_firefox_sync(
         firefox_prefs["network.http.http3.alt-svc-mapping-for-testing"] = f"{endpoint.port};h3-{h3_version}=:{port}"       
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/sync-{expnt_id}/firefox/{run_id}-{h3}.keys"
-            return pw_instance.firefox.launch(
-                headless=True,
-                firefox_user_prefs=firefox_prefs,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return pw_instance.firefox.launch(
-                headless=True,
-                firefox_user_prefs=firefox_prefs,
-            )
+        keylog = f"{os.getcwd()}/results/packets/sync-{expnt_id}/firefox/{run_id}-{h3}.keys" if pcap else None
+        return pw_instance.firefox.launch(
+            headless=True,
+            firefox_user_prefs=firefox_prefs,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.exception(str(e))
         return None
@@ -119,6 +175,7 @@ def launch_firefox_sync(
 """
 Launch the chromium browser
 """
+@traced("launch_chromium")
 def launch_chromium_sync(
     pw_instance: "SyncPlaywrightContextManager", 
     h3: bool,
@@ -128,7 +185,9 @@ def launch_chromium_sync(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
     chromium_args = []
     if h3:
         # set up chromium arguments for enabling h3, qlog, h3 version
@@ -139,21 +198,18 @@ def launch_chromium_sync(
         if qlog:
             # set up a directory results/qlogs/chromium/[experimentID] to save qlog
             qlog_dir = f"{os.getcwd()}/results/qlogs/sync-{expnt_id}/chromium/"
-            chromium_args.append(f"--log-net-log={qlog_dir}/{run_id}.netlog")
+            chromium_args.append(f"--log-net-log={qlog_dir}/{netlog_name(run_id, warm)}.netlog")
+    if endpoint.is_local():
+        # trust the self-signed certificate of the local reference server
+        chromium_args.append(f"--ignore-certificate-errors-spki-list={spki_hash()}")
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/sync-{expnt_id}/chromium/{run_id}-{h3}.keys"
-            return pw_instance.chromium.launch(
-                headless=True,
-                args=chromium_args,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return pw_instance.chromium.launch(
-                headless=True,
-                args=chromium_args,
-            )
+        keylog = f"{os.getcwd()}/results/packets/sync-{expnt_id}/chromium/{run_id}-{h3}.keys" if pcap else None
+        return pw_instance.chromium.launch(
+            headless=True,
+            args=chromium_args,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.error(str(e))
         return None
@@ -161,6 +217,7 @@ def launch_chromium_sync(
 """
 Launch the edge browser
 """
+@traced("launch_edge")
 def launch_edge_sync(
     pw_instance: "SyncPlaywrightContextManager", 
     h3: bool,
@@ -170,7 +227,9 @@ def launch_edge_sync(
     pcap: bool,
     expnt_id: int,
     run_id: int,
-) -> json:
+    marker: str = None,
+    warm: bool = False,
+) -> Browser:
     edge_args = []
     if (h3) :
         edge_args = ["--enable-quic", "--disable_http2", "--quic-version=h3-29"]
@@ -179,23 +238,18 @@ def launch_edge_sync(
         edge_args.append(f"--origin-to-force-quic-on={domain}:{port}")
         if qlog:
             qlog_dir = f"{os.getcwd()}/results/qlogs/sync-{expnt_id}/edge/"
-            edge_args.append(f"--log-net-log={qlog_dir}/{run_id}.netlog")
+            edge_args.append(f"--log-net-log={qlog_dir}/{netlog_name(run_id, warm)}.netlog")
+    if endpoint.is_local():
+        edge_args.append(f"--ignore-certificate-errors-spki-list={spki_hash()}")
     # attempt to launch browser
     try:
-        if pcap:
-            pcap_file = f"{os.getcwd()}/results/packets/sync-{expnt_id}/edge/{run_id}-{h3}.keys"
-            return pw_instance.chromium.launch(
-                headless=True,
-                executable_path='/opt/microsoft/msedge-dev/msedge',
-                args=edge_args,
-                env={"SSLKEYLOGFILE": pcap_file}
-            )
-        else:
-            return pw_instance.chromium.launch(
-                headless=True,
-                executable_path='/opt/microsoft/msedge-dev/msedge',
-                args=edge_args,
-            )
+        keylog = f"{os.getcwd()}/results/packets/sync-{expnt_id}/edge/{run_id}-{h3}.keys" if pcap else None
+        return pw_instance.chromium.launch(
+            headless=True,
+            executable_path='/opt/microsoft/msedge-dev/msedge',
+            args=edge_args,
+            env=browser_env(marker, keylog),
+        )
     except Exception as e:  # if browser fails to launch, stop this request and write to the database
         logger.error(str(e))
         return None
@@ -209,25 +263,29 @@ def get_results_sync(
     h3: bool,
     endpoint: Endpoint,
     warmup: bool,
+    timeout: float = DEFAULT_TIMEOUT,
 ) -> json:
     # set up the browser context and page
-    context = browser.new_context()
-    page = context.new_page()
+    with span("new_context"):
+        context = browser.new_context(ignore_https_errors=endpoint.is_local())
+    with span("new_page"):
+        page = context.new_page()
     url = endpoint.get_url()
     logger.debug(f"Navigating to url: {url}")
     
     # warm up the browser
-    warmup_if_specified_sync(page, url, warmup)
+    with span("warmup"):
+        warmup_if_specified_sync(page, url, warmup)
     # attempt to navigate to the url
     try:
-        # set the timeout to be 1 min, because under some bad network condition,
-        # connection and data transfer take longer
-        page.set_default_timeout(60000)
-        response = page.goto(url)
-        # getting performance timing data
-        # if we don't stringify and parse, things break
-        timing_function = '''JSON.stringify(window.performance.getEntriesByType("navigation")[0])'''
-        performance_timing = json.loads(page.evaluate(timing_function))
+        # 1 min by default, because under some bad network condition connection and data
+        # transfer take longer; the harness passes one based on the condition (see failures.py)
+        page.set_default_timeout(timeout)
+        with span("goto"):
+            response = page.goto(url)
+        # getting navigation, resource, paint, LCP and layout shift timing data in one go
+        with span("evaluate"):
+            performance_timing = parse_timing(page.evaluate(TIMING_FUNCTION))
         performance_timing['server'] = response.headers['server']
         if response.status == 404:
             logger.error("404 Response Code")
@@ -236,8 +294,12 @@ def get_results_sync(
         # if we run into error, write it in the database
         logger.error(str(e))
         performance_timing = {'error': str(e)}
+        if isinstance(e, PlaywrightTimeoutError):
+            # the page load took at least the timeout, which still counts as a load time (see failures.py)
+            performance_timing['timedOut'] = timeout
         pass
-    browser.close()
+    with span("context_close"):
+        context.close()
     return performance_timing
 
 """
@@ -0,0 +1,301 @@
+"""Local Reference Server
+
+Serves the same payloads as the server VM (1kb ... 5mb, small/medium/large and their
+assets) over HTTP/2 (TCP) and HTTP/3 (UDP) on one port, so that the whole harness can be
+run and load-tested on one machine, without the server VM or public endpoints. Use it
+through the `local-ref` endpoint of experiment.py.
+
+Everything is deterministic: the payloads are generated from fixed seeds, and the TLS key
+is derived from a fixed seed, so the certificate's public key (and the SPKI hash that the
+browsers are told to trust) never changes. With --keylog, or when SSLKEYLOGFILE is set,
+the TLS secrets of both protocols are appended to that file for decrypting captures.
+
+Requires aioquic and h2 (`pip3 install aioquic h2`).
+
+Usage:
+    local_server.py [--host HOST] [--port PORT] [--keylog FILE] [--certs DIR]
+
+Options:
+    -h --help         Show this screen
+    --host HOST       Address to listen on [default: 0.0.0.0]
+    --port PORT       TCP (h2) and UDP (h3) port to listen on [default: 4443]
+    --keylog FILE     File to append TLS secrets to [default: $SSLKEYLOGFILE]
+    --certs DIR       Directory the certificate and key are written to [default: local-ref]
+"""
+
+import os, ssl, sys, time, socket, struct, base64, random, string, asyncio, hashlib, datetime, ipaddress, subprocess
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from docopt import docopt
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+    x509 = None
+
+try:
+    import h2.config, h2.connection, h2.events, h2.exceptions
+    from aioquic.asyncio import QuicConnectionProtocol, serve
+    from aioquic.h3.connection import H3_ALPN, H3Connection
+    from aioquic.h3.events import HeadersReceived
+    from aioquic.quic.configuration import QuicConfiguration
+except ImportError:
+    QuicConnectionProtocol = object
+
+LOCAL_REF_HOST = "127.0.0.1"
+LOCAL_REF_PORT = "4443"
+CERT_DIR = "local-ref"
+# the TLS key is derived from this seed, changing it changes the SPKI hash
+KEY_SEED = b"hmc-clinic-msft-2020 local reference server"
+# names the certificate is valid for: this machine and the shards' server address
+CERT_NAMES = ["localhost"]
+CERT_ADDRESSES = ["127.0.0.1", "10.77.0.1"]
+# order of the SECP256R1 group, the private key must be in [1, order)
+SECP256R1_ORDER = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+
+# same payloads as install/generate-server-payloads.sh
+SIZED_PAYLOADS = {
+    "1kb": 1000,
+    "5kb": 5000,
+    "10kb": 10000,
+    "50kb": 50000,
+    "100kb": 100000,
+    "500kb": 500000,
+    "1mb": 1000000,
+    "5mb": 5000000,
+}
+PAGE_PAYLOADS = {
+    "small": range(400, 429),
+    "medium": range(400, 454),
+    "large": range(430, 500),
+}
+
+
+"""
+Return the deterministic private key of the server
+"""
+def private_key() -> "ec.EllipticCurvePrivateKey":
+    if x509 is None:
+        raise ImportError("the local reference server needs the cryptography package")
+    seed = int.from_bytes(hashlib.sha256(KEY_SEED).digest(), "big")
+    return ec.derive_private_key(seed % (SECP256R1_ORDER - 1) + 1, ec.SECP256R1())
+
+
+"""
+Return the base64 SHA-256 hash of the server's public key, as expected by Chromium's
+--ignore-certificate-errors-spki-list
+"""
+def spki_hash() -> str:
+    spki = private_key().public_key().public_bytes(serialization.Encoding.DER,
+                                                   serialization.PublicFormat.SubjectPublicKeyInfo)
+    return base64.b64encode(hashlib.sha256(spki).digest()).decode()
+
+
+"""
+Write the self-signed certificate and the key of the server to the given directory,
+unless they are already there. Return their paths.
+"""
+def tls_material(directory: str = CERT_DIR) -> Tuple[str, str]:
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return cert_path, key_path
+    os.makedirs(directory, exist_ok=True)
+    key = private_key()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "local-ref")])
+    alt_names = [x509.DNSName(n) for n in CERT_NAMES] + [x509.IPAddress(ipaddress.ip_address(a)) for a in CERT_ADDRESSES]
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(1) \
+        .not_valid_before(datetime.datetime(2020, 1, 1)) \
+        .not_valid_after(datetime.datetime(2040, 1, 1)) \
+        .add_extension(x509.SubjectAlternativeName(alt_names), critical=False) \
+        .sign(key, hashes.SHA256())
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return cert_path, key_path
+
+
+"""
+Return a 24-bit BMP image of the given size, with a colour depending on `seed`.
+Browsers sniff the format, so it is served as the .jpg assets of the pages.
+"""
+def bmp_image(width: int, height: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    pixel = bytes([rng.randrange(256) for _ in range(3)])
+    row = pixel * width + b"\0" * (-3 * width % 4)
+    pixels = row * height
+    header = struct.pack("<2sIHHI", b"BM", 54 + len(pixels), 0, 0, 54)
+    info = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+
+"""
+Return the status, content type and body served for the given path
+"""
+@lru_cache(maxsize=None)
+def payload(path: str) -> Tuple[int, str, bytes]:
+    name = path.split("?")[0].strip("/")
+    if name.endswith(".html"):
+        name = name[:-len(".html")]
+    if name in SIZED_PAYLOADS:
+        rng = random.Random(name)
+        body = "".join(rng.choices(string.ascii_letters + string.digits, k=SIZED_PAYLOADS[name]))
+        return 200, "text/html", body.encode()
+    if name in PAGE_PAYLOADS:
+        body = "\n".join(f"<img src='assets/cats_{i}.jpg' width='{i}' height='{i}' alt=''>" for i in PAGE_PAYLOADS[name])
+        return 200, "text/html", body.encode()
+    if name.startswith("assets/cats_") and name.endswith(".jpg"):
+        try:
+            i = int(name[len("assets/cats_"):-len(".jpg")])
+        except ValueError:
+            i = 0
+        if 400 <= i < 500:
+            # about the size of the pictures on the server VM
+            return 200, "image/jpeg", bmp_image(i // 4, i // 4, i)
+    return 404, "text/plain", b"not found"
+
+
+def response_headers(status: int, content_type: str, length: int, port: str) -> List[Tuple[str, str]]:
+    return [
+        (":status", str(status)),
+        ("server", "local-ref"),
+        ("content-type", content_type),
+        ("content-length", str(length)),
+        ("cache-control", "no-store"),
+        ("alt-svc", f'h3=":{port}"; ma=86400, h3-29=":{port}"; ma=86400'),
+    ]
+
+
+class H2Protocol(asyncio.Protocol):
+    def __init__(self, port: str):
+        self.port = port
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        # stream id: body left to send, waiting for the flow control window
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data: bytes):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                status, content_type, body = payload(dict(event.headers)[":path"])
+                self.conn.send_headers(event.stream_id, response_headers(status, content_type, len(body), self.port))
+                self.pending[event.stream_id] = memoryview(body)
+            elif isinstance(event, h2.events.StreamReset):
+                self.pending.pop(event.stream_id, None)
+        self.send_pending()
+        self.transport.write(self.conn.data_to_send())
+
+    """
+    Send as much of the pending bodies as the flow control windows allow
+    """
+    def send_pending(self):
+        for stream_id, body in list(self.pending.items()):
+            while body:
+                size = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size, len(body))
+                if size <= 0:
+                    break
+                self.conn.send_data(stream_id, body[:size].tobytes())
+                body = body[size:]
+            if body:
+                self.pending[stream_id] = body
+            else:
+                del self.pending[stream_id]
+                self.conn.end_stream(stream_id)
+
+
+class H3Protocol(QuicConnectionProtocol):
+    def __init__(self, *args, port: str = LOCAL_REF_PORT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.port = port
+        self.http = H3Connection(self._quic)
+
+    def quic_event_received(self, event):
+        for http_event in self.http.handle_event(event):
+            if isinstance(http_event, HeadersReceived):
+                status, content_type, body = payload(dict(http_event.headers)[b":path"].decode())
+                headers = response_headers(status, content_type, len(body), self.port)
+                self.http.send_headers(http_event.stream_id, [(k.encode(), v.encode()) for k, v in headers])
+                self.http.send_data(http_event.stream_id, body, end_stream=True)
+        self.transmit()
+
+
+async def serve_forever(host: str, port: str, keylog: Optional[str], certs: str):
+    cert_path, key_path = tls_material(certs)
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(cert_path, key_path)
+    ssl_context.set_alpn_protocols(["h2"])
+    quic_config = QuicConfiguration(alpn_protocols=H3_ALPN + ["h3-29"], is_client=False)
+    quic_config.load_cert_chain(cert_path, key_path)
+    if keylog:
+        ssl_context.keylog_filename = keylog
+        quic_config.secrets_log_file = open(keylog, "a")
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: H2Protocol(port), host, int(port), ssl=ssl_context)
+    await serve(host, int(port), configuration=quic_config,
+                create_protocol=lambda *args, **kwargs: H3Protocol(*args, port=port, **kwargs))
+    logger.info(f"Serving h2 and h3 on {host}:{port}, SPKI hash {spki_hash()}")
+    async with server:
+        await server.serve_forever()
+
+
+"""
+Return True if something accepts TCP connections on the given port of the local server
+"""
+def is_running(host: str = LOCAL_REF_HOST, port: str = LOCAL_REF_PORT) -> bool:
+    try:
+        with socket.create_connection((host, int(port)), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+"""
+Start the local server in the background, unless it is already running.
+Return the server process if one was started, once it accepts connections.
+"""
+def start_local_server(port: str = LOCAL_REF_PORT, timeout: float = 10) -> Optional[subprocess.Popen]:
+    if is_running(port=port):
+        return None
+    process = subprocess.Popen(["python3", "local_server.py", "--port", str(port)])
+    deadline = time.time() + timeout
+    while not is_running(port=port):
+        if process.poll() is not None or time.time() > deadline:
+            logger.error("The local reference server did not start")
+            break
+        time.sleep(0.1)
+    return process
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = docopt(__doc__)
+    keylog = args['--keylog']
+    if keylog == "$SSLKEYLOGFILE":
+        keylog = os.environ.get("SSLKEYLOGFILE")
+    try:
+        asyncio.run(serve_forever(args['--host'], args['--port'], keylog, args['--certs']))
+    except KeyboardInterrupt:
+        sys.exit()
@@ -0,0 +1,91 @@
+import json
+from typing import List
+
+"""
+JavaScript evaluated in the page once it has loaded. In a single round-trip it returns,
+as a JSON string, the navigation timing entry and every resource timing, paint,
+largest-contentful-paint and layout-shift entry of the page.
+LCP and layout shifts are only available through a PerformanceObserver; buffered entries
+are delivered in a task after observe(), hence the setTimeout. Entry types the browser
+does not support (e.g. layout-shift in Firefox) are skipped.
+The result is stringified in the page and parsed here, since returning the entries
+themselves breaks things.
+"""
+TIMING_FUNCTION = '''() => new Promise(resolve => {
+    const entries = [];
+    const supported = PerformanceObserver.supportedEntryTypes || [];
+    const observed = ["largest-contentful-paint", "layout-shift"].filter(type => supported.includes(type));
+    const done = () => resolve(JSON.stringify({
+        navigation: performance.getEntriesByType("navigation")[0],
+        entries: entries.concat(performance.getEntriesByType("resource"), performance.getEntriesByType("paint")),
+    }));
+    if (observed.length === 0) {
+        done();
+        return;
+    }
+    const observer = new PerformanceObserver(list => entries.push(...list.getEntries()));
+    observed.forEach(type => observer.observe({type: type, buffered: true}));
+    setTimeout(() => {
+        entries.push(...observer.takeRecords());
+        observer.disconnect();
+        done();
+    }, 0);
+})'''
+
+"""
+Headers/columns of the resource_timings table, one row per entry other than navigation.
+Columns that do not apply to an entry type are left empty, e.g. `value` is only set for
+layout-shift entries (the cumulative layout shift is their sum) and `renderTime` only
+for largest-contentful-paint entries.
+"""
+resource_timings_fmt = {
+    "runID" : "INTEGER",
+    "experimentID" : "INTEGER",
+    "entryType" : "TEXT",
+    "name" : "TEXT",
+    "initiatorType" : "TEXT",
+    "nextHopProtocol" : "TEXT",
+    "startTime" : "REAL",
+    "duration" : "REAL",
+    "fetchStart" : "REAL",
+    "domainLookupStart" : "REAL",
+    "domainLookupEnd" : "REAL",
+    "connectStart" : "REAL",
+    "secureConnectionStart" : "REAL",
+    "connectEnd" : "REAL",
+    "requestStart" : "REAL",
+    "responseStart" : "REAL",
+    "responseEnd" : "REAL",
+    "transferSize" : "INTEGER",
+    "encodedBodySize" : "INTEGER",
+    "decodedBodySize" : "INTEGER",
+    "renderTime" : "REAL",
+    "loadTime" : "REAL",
+    "size" : "INTEGER",
+    "value" : "REAL",
+    }
+
+
+"""
+Parse the result of TIMING_FUNCTION into the navigation timing data,
+with the other entries under the "entries" key
+"""
+def parse_timing(timing: str) -> json:
+    parsed = json.loads(timing)
+    performance_timing = parsed["navigation"]
+    performance_timing["entries"] = parsed["entries"]
+    return performance_timing
+
+
+"""
+Turn the entries of a run into rows of the resource_timings table
+"""
+def entry_rows(entries: List[json], run_id: int, experiment_id) -> List[tuple]:
+    rows = []
+    for entry in entries:
+        entry = dict(entry, runID=run_id, experimentID=experiment_id)
+        # LCP entries name the element's resource in `url`
+        if entry.get("entryType") == "largest-contentful-paint":
+            entry["name"] = entry.get("url") or entry.get("id") or entry.get("name")
+        rows.append(tuple([entry.get(key) for key in resource_timings_fmt.keys()]))
+    return rows
@@ -0,0 +1,171 @@
+import time, json, random, hashlib, itertools
+from typing import Dict, List, Optional, Tuple
+
+from experiment_utils import setup_data_file_headers, insert_statement
+from endpoint import Endpoint
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Experiment plans.
+
+Before running anything, the whole sweep (every endpoint, condition, browser, h3/h2 and
+repetition) is written to the plan table of the results database, in the shuffled order
+the runs will be done in, with its experiment and run IDs. IDs are allocated in the same
+write transaction as the plan rows, so plans created at the same time by several
+harnesses sharing a database (e.g. shards) never get the same IDs; run IDs name the pcap,
+key and qlog files, so they must not collide.
+
+A run is marked as completed (1) in the same transaction as its results (see COMPLETE_RUN),
+or as skipped (2) when adaptive sampling decides it is not needed.
+A plan is identified by a key built from the arguments defining the sweep, so that
+`--resume` finds the latest unfinished plan with the same arguments and only does the
+runs that are not completed yet.
+"""
+
+# executed with the results of a run, in the same writer group
+COMPLETE_RUN = "UPDATE plan SET completed = 1 WHERE runID = ?"
+
+
+class PlannedRun():
+    def __init__(self, run_id: int, browser: str, h3: bool):
+        self.run_id = run_id
+        self.browser = browser
+        self.h3 = h3
+
+
+class PlannedExperiment():
+    def __init__(self, experiment_id: int, endpoint: Endpoint, condition: str, started: bool):
+        self.experiment_id = experiment_id
+        self.endpoint = endpoint
+        self.condition = condition
+        # whether some runs were already completed, i.e. the experiment is being resumed
+        self.started = started
+        # the runs left to do, in order
+        self.runs: List[PlannedRun] = []
+
+    def browsers(self) -> List[str]:
+        return sorted({run.browser for run in self.runs})
+
+
+"""
+Return the key of the plan of the given endpoints, conditions, browsers and number of runs
+"""
+def plan_key(endpoints: List[Endpoint], conditions: List[str], browsers: List[str], runs: int, rounds: bool = False) -> str:
+    definition = {
+        # named endpoints are resolved to URLs at run time, so key them by name
+        "endpoints": [(endpoint.get_endpoint(), endpoint.get_payload()) for endpoint in endpoints],
+        "conditions": conditions,
+        "browsers": browsers,
+        "runs": runs,
+        "rounds": rounds,
+    }
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+
+# every connection to :memory: opens a new database, so the plan of an in-memory
+# database is kept in a single connection for the whole process
+memory_database = None
+
+
+def open_database(out: str):
+    global memory_database
+    if out != ":memory:":
+        return setup_data_file_headers(out)
+    if memory_database is None:
+        memory_database = setup_data_file_headers(out)
+    return memory_database
+
+
+def close_database(db, out: str):
+    if out != ":memory:":
+        db.close()
+
+
+"""
+Write the plan of the given sweep to the database, return its ID.
+The runs of an experiment are shuffled; with `rounds`, only within each repetition, so that
+every combination is run once per round (see adaptive.py).
+"""
+def create_plan(out: str, key: str, endpoints: List[Endpoint], conditions: List[str], browsers: List[str], runs: int,
+                rounds: bool = False) -> int:
+    db = open_database(out)
+    try:
+        # take the write lock before reading the largest IDs
+        db.execute("BEGIN IMMEDIATE")
+        plan_id = (db.execute("SELECT max(planID) FROM plans").fetchone()[0] or 0) + 1
+        # experiment IDs stay unix times, as before plans, unless that time was already given out
+        last_experiment = max(db.execute("SELECT max(experimentID) FROM plan").fetchone()[0] or 0,
+                              db.execute("SELECT max(CAST(experimentID AS INTEGER)) FROM big_table").fetchone()[0] or 0)
+        experiment_id = max(last_experiment + 1, int(time.time()))
+        run_id = max((db.execute("SELECT max(runID) FROM plan").fetchone()[0] or 0) + 1, time.time_ns())
+        rows = []
+        for endpoint, condition in itertools.product(endpoints, conditions):
+            params = []
+            for repetition in range(runs):
+                params += [(browser, h3, repetition) for browser in browsers for h3 in [True, False]]
+                if rounds:
+                    round_start = len(params) - 2 * len(browsers)
+                    params[round_start:] = random.sample(params[round_start:], 2 * len(browsers))
+            if not rounds:
+                random.shuffle(params)
+            for position, (browser, h3, repetition) in enumerate(params):
+                rows.append((plan_id, experiment_id, run_id, position, endpoint.get_url(), endpoint.get_endpoint(),
+                             endpoint.get_payload(), condition, browser, h3, repetition, 0))
+                run_id += 1
+            experiment_id += 1
+        args = {"conditions": conditions, "browsers": browsers, "runs": runs, "rounds": rounds,
+                "endpoints": [(endpoint.get_endpoint(), endpoint.get_payload()) for endpoint in endpoints]}
+        db.execute(insert_statement("plans"), (plan_id, key, time.time(), json.dumps(args)))
+        db.executemany(insert_statement("plan"), rows)
+        db.commit()
+    finally:
+        close_database(db, out)
+    logger.info(f"Plan {plan_id}: {len(rows)} runs")
+    return plan_id
+
+
+"""
+Return the ID of the latest plan with the given key that has runs left to do, if any
+"""
+def find_plan(out: str, key: str) -> Optional[int]:
+    db = open_database(out)
+    try:
+        row = db.execute("""SELECT planID FROM plans WHERE planKey = ?
+                            AND EXISTS (SELECT 1 FROM plan WHERE plan.planID = plans.planID AND completed = 0)
+                            ORDER BY planID DESC LIMIT 1""", (key,)).fetchone()
+    finally:
+        close_database(db, out)
+    return row[0] if row else None
+
+
+"""
+Return the experiments of the given plan that have runs left to do, with only those runs.
+`endpoints` are the endpoints of the plan, which are matched to its rows.
+"""
+def load_plan(out: str, plan_id: int, endpoints: List[Endpoint]) -> List[PlannedExperiment]:
+    by_key = {(endpoint.get_endpoint(), endpoint.get_payload()): endpoint for endpoint in endpoints}
+    db = open_database(out)
+    try:
+        rows = db.execute("""SELECT experimentID, runID, endpoint, payload, condition, browser, h3, completed
+                             FROM plan WHERE planID = ? ORDER BY experimentID, position""", (plan_id,)).fetchall()
+    finally:
+        close_database(db, out)
+    experiments: Dict[int, PlannedExperiment] = {}
+    for experiment_id, run_id, endpoint, payload, condition, browser, h3, completed in rows:
+        experiment = experiments.get(experiment_id)
+        if experiment is None:
+            experiment = experiments[experiment_id] = PlannedExperiment(experiment_id, by_key[(endpoint, payload)], condition, False)
+        if completed:
+            experiment.started = True
+        else:
+            experiment.runs.append(PlannedRun(run_id, browser, bool(h3)))
+    return [experiment for experiment in experiments.values() if experiment.runs]
+
+
+"""
+Group consecutive experiments of the same endpoint
+"""
+def by_endpoint(experiments: List[PlannedExperiment]) -> List[Tuple[Endpoint, List[PlannedExperiment]]]:
+    return [(endpoint, list(group)) for endpoint, group in itertools.groupby(experiments, key=lambda e: e.endpoint)]
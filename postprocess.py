@@ -0,0 +1,159 @@
+"""Packet Capture Post-processing
+
+Injects the TLS secrets of the runs into their packet captures, so that Wireshark can
+decrypt them without the key logs. The captures and key logs are found in the results
+database rather than by file names: the `pcap` column of every run points at its capture,
+and the `keylog` column at the key log of the browser that did the run (a warm browser
+keeps writing to the key log of the run it was launched for). All the key logs of the
+runs of a capture are merged, so a capture shared by several runs (e.g. the single
+capture of an async experiment, before captures were split per run) gets every key.
+
+Every capture is written next to it as `.pcapng` by `editcap --inject-secrets`, on a pool
+of processes. Outputs newer than their capture and key logs are up to date and skipped,
+so the script can be run again after more experiments. The output of every run is
+recorded in its `decrypted` column.
+
+Usage:
+    postprocess.py [DB] [--workers WORKERS] [--force]
+
+Options:
+    -h --help             Show this screen
+    --workers WORKERS     Number of editcap processes at a time [default: 4]
+    --force               Rewrite the outputs that are up to date
+"""
+
+import os, tempfile, subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from docopt import docopt
+
+from experiment_utils import setup_data_file_headers
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+DEFAULT_DATABASE = "results/results.db"
+
+
+class Job():
+    def __init__(self, pcap: str):
+        self.pcap = pcap
+        self.output = os.path.splitext(pcap)[0] + ".pcapng"
+        # key logs in the order they are merged, without duplicates
+        self.keylogs: List[str] = []
+        self.rowids: List[int] = []
+
+    def add(self, rowid: int, keylog: Optional[str]):
+        self.rowids.append(rowid)
+        if keylog and keylog not in self.keylogs:
+            self.keylogs.append(keylog)
+
+    def up_to_date(self) -> bool:
+        if not os.path.exists(self.output):
+            return False
+        inputs = [self.pcap] + [keylog for keylog in self.keylogs if os.path.exists(keylog)]
+        return os.path.getmtime(self.output) >= max(os.path.getmtime(path) for path in inputs)
+
+
+"""
+Return the capture file of a `pcap` column: a path without extension for per-run captures,
+the file itself for older shared captures
+"""
+def capture_path(pcap: str) -> str:
+    return pcap if pcap.endswith(".pcap") else pcap + ".pcap"
+
+
+"""
+Return the jobs of the runs of the database with a capture, by capture file
+"""
+def find_jobs(database: str) -> List[Job]:
+    db = setup_data_file_headers(database)
+    rows = db.execute("""SELECT rowid, pcap, keylog FROM timings
+                         WHERE pcap IS NOT NULL AND pcap NOT IN ('', 'n/a')""").fetchall()
+    db.close()
+    jobs: Dict[str, Job] = {}
+    for rowid, pcap, keylog in rows:
+        path = capture_path(pcap)
+        job = jobs.setdefault(path, Job(path))
+        # runs from before the keylog column have their key log next to the capture
+        job.add(rowid, keylog or os.path.splitext(path)[0] + ".keys")
+    return list(jobs.values())
+
+
+"""
+Write the capture with the merged secrets of its key logs injected, return the error if any
+"""
+def inject_secrets(pcap: str, keylogs: List[str], output: str) -> Optional[str]:
+    lines, seen = [], set()
+    for keylog in keylogs:
+        with open(keylog) as f:
+            for line in f:
+                if line.strip() and line not in seen:
+                    seen.add(line)
+                    lines.append(line if line.endswith("\n") else line + "\n")
+    directory = os.path.dirname(output) or "."
+    with tempfile.NamedTemporaryFile("w", suffix=".keys", dir=directory, delete=False) as merged:
+        merged.writelines(lines)
+    partial = output + ".partial"
+    try:
+        result = subprocess.run(["editcap", "--inject-secrets", f"tls,{merged.name}", pcap, partial],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return result.stderr.strip() or f"editcap exited with {result.returncode}"
+        # readers never see a half-written output
+        os.replace(partial, output)
+        return None
+    finally:
+        os.remove(merged.name)
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+"""
+Post-process the captures of the database. Return the number of outputs written and failed.
+"""
+def postprocess(database: str, workers: int, force: bool = False) -> Tuple[int, int]:
+    jobs, done = [], []
+    for job in find_jobs(database):
+        if not os.path.exists(job.pcap):
+            logger.warning(f"Missing capture: {job.pcap}")
+            continue
+        job.keylogs = [keylog for keylog in job.keylogs if os.path.exists(keylog)]
+        if not job.keylogs:
+            logger.warning(f"No key log for {job.pcap}")
+            continue
+        if not force and job.up_to_date():
+            done.append(job)
+        else:
+            jobs.append(job)
+    logger.info(f"{len(jobs)} captures to process, {len(done)} up to date")
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(inject_secrets, job.pcap, job.keylogs, job.output): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                error = future.result()
+            except Exception as e:
+                error = str(e)
+            if error:
+                logger.error(f"{job.pcap}: {error}")
+                failed += 1
+            else:
+                logger.debug(f"Wrote {job.output}")
+                done.append(job)
+
+    db = setup_data_file_headers(database)
+    db.executemany("UPDATE timings SET decrypted = ? WHERE rowid = ?",
+                   [(job.output, rowid) for job in done for rowid in job.rowids])
+    db.commit()
+    db.close()
+    return len(jobs) - failed, failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = docopt(__doc__)
+    written, failed = postprocess(args['DB'] or DEFAULT_DATABASE, int(args['--workers']), args['--force'])
+    logger.info(f"Wrote {written} outputs, {failed} failed")
@@ -0,0 +1,212 @@
+import os, ssl, time, socket, struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+from endpoint import Endpoint
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Pre-flight probing of the endpoints of a sweep.
+
+An unreachable endpoint, or an h3 port that nothing answers on, is only found out by the
+page loads, each of which waits for the 60 s default timeout of the page, on every run,
+browser and condition. Before the sweep, every endpoint/payload combination is probed
+once, all of them at the same time, in the order a page load would fail:
+
+- DNS: the host resolves;
+- TCP: a connection to the port is accepted;
+- TLS: a handshake completes (certificates are not checked, the browsers are told to
+  trust the ones of our servers), and which protocol ALPN picks;
+- h3: either the server advertises h3 in the Alt-Svc header of a HEAD request over
+  HTTP/1.1, or a QUIC server answers on the UDP port the browsers force QUIC on. The
+  latter sends an Initial packet of a reserved version, which any QUIC server must answer
+  with a Version Negotiation packet listing its versions, so no QUIC stack is needed.
+
+Every run does both h2 and h3, so a combination failing any of these is dropped from the
+sweep. The results of every probe are written to the preflight table.
+"""
+
+# seconds every step of a probe may take
+PROBE_TIMEOUT = 5
+MAX_PROBES = 32
+# reserved version of the form 0x?a?a?a?a, which servers must answer with a Version Negotiation
+QUIC_PROBE_VERSION = 0x1a2a3a4a
+# clients pad their Initial packets to this size, servers ignore smaller ones
+QUIC_MIN_INITIAL_SIZE = 1200
+
+
+class Probe():
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        parsed = urlparse(endpoint.get_url())
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = int(parsed.port or endpoint.get_port() or (443 if parsed.scheme == "https" else 80))
+        self.path = parsed.path or "/"
+        self.addresses: List[str] = []
+        self.dns_time: Optional[float] = None
+        self.tcp_time: Optional[float] = None
+        self.tls_time: Optional[float] = None
+        self.tls_version: Optional[str] = None
+        self.alpn: Optional[str] = None
+        self.alt_svc: Optional[str] = None
+        self.quic_versions: List[int] = []
+        self.quic_time: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def h3(self) -> bool:
+        return bool(self.quic_versions) or (self.alt_svc is not None and "h3" in self.alt_svc)
+
+    def ok(self) -> bool:
+        return self.error is None
+
+    """
+    Return the row of the preflight table of the probe, for the given plan
+    """
+    def row(self, plan_id: int, unix_time: float) -> tuple:
+        return (plan_id, unix_time, self.endpoint.get_endpoint(), self.endpoint.get_payload(), self.endpoint.get_url(),
+                self.host, self.port, " ".join(self.addresses), self.dns_time, self.tcp_time, self.tls_time,
+                self.tls_version, self.alpn, self.alt_svc, " ".join(f"0x{version:08x}" for version in self.quic_versions),
+                self.quic_time, self.h3(), self.ok(), self.error)
+
+
+"""
+Return the milliseconds since the given perf_counter time
+"""
+def elapsed(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+"""
+Return the TLS version and ALPN protocol of a handshake with the server
+"""
+def tls_handshake(address: str, host: str, port: int, protocols: List[str], timeout: float) -> Tuple[str, Optional[str]]:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.set_alpn_protocols(protocols)
+    with socket.create_connection((address, port), timeout=timeout) as sock:
+        with context.wrap_socket(sock, server_hostname=host) as tls:
+            return tls.version(), tls.selected_alpn_protocol()
+
+
+"""
+Return the Alt-Svc header of a HEAD request to the path, None if there is none
+"""
+def fetch_alt_svc(address: str, host: str, port: int, path: str, timeout: float) -> Optional[str]:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    # HTTP/1.1 only, the request is written by hand
+    context.set_alpn_protocols(["http/1.1"])
+    with socket.create_connection((address, port), timeout=timeout) as sock:
+        with context.wrap_socket(sock, server_hostname=host) as tls:
+            authority = host if port == 443 else f"{host}:{port}"
+            tls.sendall(f"HEAD {path} HTTP/1.1\r\nHost: {authority}\r\nConnection: close\r\n\r\n".encode())
+            response = b""
+            while b"\r\n\r\n" not in response and len(response) < 65536:
+                data = tls.recv(4096)
+                if not data:
+                    break
+                response += data
+    for line in response.split(b"\r\n\r\n")[0].decode(errors="replace").split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "alt-svc":
+            return value.strip()
+    return None
+
+
+"""
+Return the versions a QUIC server on the UDP port lists in its Version Negotiation packet,
+an empty list if nothing answers
+"""
+def quic_versions(address: str, port: int, timeout: float) -> List[int]:
+    destination, source = os.urandom(8), os.urandom(8)
+    # long header, then the version and the connection IDs; the rest is padding
+    packet = bytes([0xc0]) + struct.pack("!I", QUIC_PROBE_VERSION) + bytes([8]) + destination + bytes([8]) + source
+    packet += bytes(QUIC_MIN_INITIAL_SIZE - len(packet))
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(packet, (address, port))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            try:
+                data, _ = sock.recvfrom(65536)
+            except (socket.timeout, ConnectionRefusedError):
+                # an ICMP port unreachable shows as a refused connection
+                return []
+            # Version Negotiation: long header, version 0, our connection IDs swapped
+            if len(data) < 7 or not data[0] & 0x80 or struct.unpack("!I", data[1:5])[0] != 0:
+                continue
+            offset = 5
+            destination_length = data[offset]
+            offset += 1 + destination_length
+            if offset >= len(data):
+                continue
+            offset += 1 + data[offset]
+            return [struct.unpack("!I", data[i:i + 4])[0] for i in range(offset, len(data) - 3, 4)]
+    return []
+
+
+"""
+Probe the given endpoint, stopping at the first step that fails
+"""
+def probe(endpoint: Endpoint, timeout: float = PROBE_TIMEOUT) -> Probe:
+    result = Probe(endpoint)
+    step = "dns"
+    try:
+        start = time.perf_counter()
+        infos = socket.getaddrinfo(result.host, result.port, type=socket.SOCK_STREAM)
+        result.dns_time = elapsed(start)
+        result.addresses = sorted({info[4][0] for info in infos})
+        address = infos[0][4][0]
+
+        step = "tcp"
+        start = time.perf_counter()
+        socket.create_connection((address, result.port), timeout=timeout).close()
+        result.tcp_time = elapsed(start)
+        if result.scheme != "https":
+            # no TLS, and so no h3, on plain http
+            return result
+
+        step = "tls"
+        start = time.perf_counter()
+        result.tls_version, result.alpn = tls_handshake(address, result.host, result.port, ["h2", "http/1.1"], timeout)
+        result.tls_time = elapsed(start)
+
+        step = "h3"
+        try:
+            result.alt_svc = fetch_alt_svc(address, result.host, result.port, result.path, timeout)
+        except (OSError, ssl.SSLError) as e:
+            # servers only speaking h2 refuse HTTP/1.1
+            logger.debug(f"No Alt-Svc from {endpoint.get_url()}: {e}")
+        start = time.perf_counter()
+        result.quic_versions = quic_versions(address, result.port, timeout)
+        if result.quic_versions:
+            result.quic_time = elapsed(start)
+        if not result.h3():
+            result.error = f"h3: no Alt-Svc for h3 and no QUIC answer on UDP port {result.port}"
+    except Exception as e:
+        result.error = f"{step}: {str(e) or type(e).__name__}"
+    return result
+
+
+"""
+Probe the given endpoints at the same time, return their probes in the same order
+"""
+def probe_all(endpoints: List[Endpoint], timeout: float = PROBE_TIMEOUT) -> List[Probe]:
+    if not endpoints:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(endpoints), MAX_PROBES), thread_name_prefix="preflight") as executor:
+        probes = list(executor.map(lambda endpoint: probe(endpoint, timeout), endpoints))
+    for result in probes:
+        if result.ok():
+            logger.info(f"Pre-flight {result.endpoint.get_url()}: ok ({result.alpn}, h3 {result.h3()})")
+        else:
+            logger.error(f"Pre-flight {result.endpoint.get_url()}: {result.error}, skipping it")
+    return probes
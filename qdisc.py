@@ -0,0 +1,172 @@
+import os, json, subprocess
+from typing import Optional, Tuple
+
+from experiment_utils import condition_params
+from tracing import traced
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Idempotent management of the netem/TBF qdiscs emulating a network condition on a device.
+
+The manager remembers which condition is applied and only talks to the kernel when the
+requested condition differs: the first condition is installed with `replace` (which also
+takes over whatever was left on the device), later ones are switched to in place with
+`change`, so the link is never left unshaped between two conditions. After every change
+the qdiscs on the device are read back and compared with the requested ones; if they
+differ, the qdiscs are deleted and installed again. If the reinstalled qdiscs still cannot
+be verified (e.g. an old `tc` without `-j`), verification is turned off for the device
+instead of reinstalling them on every run.
+
+When pyroute2 is installed and we run as root (e.g. inside a namespace with
+`sudo ip netns exec`), the qdiscs are managed with netlink calls. Otherwise `sudo tc` is
+used, which still only forks when the condition changes.
+"""
+
+Params = Tuple[int, int, int]
+
+# same qdiscs as APPLY_LATENCY_LOSS/APPLY_BANDWIDTH in experiment_utils
+NETEM_HANDLE = "1:0"
+TBF_PARENT = "1:1"
+TBF_HANDLE = "10:"
+TC_NETEM = "sudo tc qdisc {ACTION} dev {DEVICE} root handle 1:0 netem delay {LATENCY}ms loss {LOSS}%"
+TC_TBF = "sudo tc qdisc {ACTION} dev {DEVICE} parent 1:1 handle 10: tbf rate {BANDWIDTH}kbps burst {BURST}b limit {LIMIT}b"
+TC_DELETE = "sudo tc qdisc del dev {DEVICE} root"
+TC_SHOW = "tc -j qdisc show dev {DEVICE}"
+
+try:
+    from pyroute2 import IPRoute, NetNS
+except ImportError:
+    IPRoute = None
+
+
+class TcBackend():
+    def __init__(self, device: str, netns: Optional[str] = None):
+        self.device = device
+        self.netns = netns
+
+    def run(self, command: str) -> subprocess.CompletedProcess:
+        if self.netns:
+            command = command.replace("sudo tc", f"sudo ip netns exec {self.netns} tc", 1)
+            if command.startswith("tc "):
+                command = f"sudo ip netns exec {self.netns} " + command
+        logger.debug(f"commands are {command}")
+        return subprocess.run(command.split(), capture_output=True, text=True)
+
+    def set(self, action: str, params: Params) -> bool:
+        latency, loss, bandwidth = params
+        netem = self.run(TC_NETEM.format(ACTION = action, DEVICE = self.device, LATENCY = latency, LOSS = loss))
+        tbf = self.run(TC_TBF.format(ACTION = action, DEVICE = self.device, BANDWIDTH = bandwidth,
+                                     BURST = bandwidth, LIMIT = 2*bandwidth))
+        for result in (netem, tbf):
+            if result.returncode > 0:
+                logger.debug(f"Issue running TC! {result.args}: {result.stderr}")
+                return False
+        return True
+
+    def delete(self):
+        self.run(TC_DELETE.format(DEVICE = self.device))
+
+    """
+    Return True if the device has our netem qdisc at the root with the given delay,
+    and our TBF qdisc under it
+    """
+    def verify(self, params: Params) -> bool:
+        result = self.run(TC_SHOW.format(DEVICE = self.device))
+        try:
+            qdiscs = json.loads(result.stdout)
+        except ValueError:
+            return False
+        netem = [q for q in qdiscs if q.get("kind") == "netem" and q.get("root")]
+        tbf = [q for q in qdiscs if q.get("kind") == "tbf" and q.get("parent") == TBF_PARENT]
+        if not netem or not tbf:
+            return False
+        # tc reports the delay in seconds
+        delay = netem[0].get("options", {}).get("delay", {}).get("delay")
+        return delay is None or abs(delay * 1000 - params[0]) < 1
+
+
+class NetlinkBackend():
+    def __init__(self, device: str, netns: Optional[str] = None):
+        self.device = device
+        self.ipr = NetNS(netns) if netns else IPRoute()
+        self.index = self.ipr.link_lookup(ifname=device)[0]
+
+    def set(self, action: str, params: Params) -> bool:
+        latency, loss, bandwidth = params
+        try:
+            # netem takes the delay in microseconds; TBF takes bytes per second like tc's kbps
+            self.ipr.tc(action, "netem", self.index, handle=NETEM_HANDLE, delay=latency * 1000, loss=loss)
+            self.ipr.tc(action, "tbf", self.index, handle=TBF_HANDLE, parent=TBF_PARENT,
+                        rate=bandwidth * 1000, burst=bandwidth, limit=2*bandwidth)
+            return True
+        except Exception as e:
+            logger.debug(f"Issue setting qdiscs with netlink: {e}")
+            return False
+
+    def delete(self):
+        try:
+            self.ipr.tc("del", index=self.index, handle=NETEM_HANDLE)
+        except Exception:
+            pass
+
+    def verify(self, params: Params) -> bool:
+        kinds = [qdisc.get_attr("TCA_KIND") for qdisc in self.ipr.get_qdiscs(index=self.index)]
+        return "netem" in kinds and "tbf" in kinds
+
+
+class QdiscManager():
+    def __init__(self, device: str, netns: Optional[str] = None):
+        self.device = device
+        self.netns = netns
+        # the (latency, loss, bandwidth) currently applied, None when the device is unshaped
+        self.current: Optional[Params] = None
+        # False once the qdiscs of the device could not be read back after installing them
+        self.verifying = True
+        self.backend = None
+        if IPRoute is not None and os.geteuid() == 0:
+            try:
+                self.backend = NetlinkBackend(device, netns)
+            except Exception as e:
+                logger.debug(f"Falling back to tc: {e}")
+        if self.backend is None:
+            self.backend = TcBackend(device, netns)
+
+    """
+    Emulate the given network condition, doing nothing if it is already applied
+    """
+    @traced("tc_apply")
+    def apply(self, condition: str):
+        params = tuple(condition_params(condition))
+        if params == self.current:
+            return
+        logger.debug(f"{self.device}: {self.current} -> {params}")
+        action = "replace" if self.current is None else "change"
+        if not (self.backend.set(action, params) and self.verify(params)):
+            # the qdiscs were not in the state we expected, start from scratch
+            logger.debug("reseting condition")
+            self.backend.delete()
+            if not self.backend.set("add", params):
+                # if resetting tc does not work, we will keep track of the error and retry next time
+                logger.error("RESET TC COMMAND FAILED")
+                return
+            if not self.verify(params):
+                # freshly installed qdiscs that do not read back are a verification problem,
+                # reinstalling them on every run would not fix it
+                logger.warning(f"{self.device}: cannot verify the qdiscs, no longer verifying them")
+                self.verifying = False
+        self.current = params
+
+    def verify(self, params: Params) -> bool:
+        return not self.verifying or self.backend.verify(params)
+
+    """
+    Remove the network condition, doing nothing if the device is not shaped
+    """
+    @traced("tc_reset")
+    def reset(self):
+        if self.current is None:
+            return
+        self.backend.delete()
+        self.current = None
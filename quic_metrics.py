@@ -0,0 +1,497 @@
+"""QUIC Metrics Ingestion
+
+Reads the Firefox qlogs and the Chromium/Edge netlogs of the experiments and writes the
+QUIC metrics of every connection to the quic_metrics table: handshake RTT (first packet
+sent to first packet received), smoothed and minimum RTT, peak congestion window, packets
+sent, received, lost and retransmitted, 0-RTT use and number of streams.
+
+Netlogs of large payloads are hundreds of megabytes of JSON, so the logs are never loaded
+whole: `JsonStream` decodes the events array one event at a time from a fixed-size buffer.
+The experiment writes the logs to results/qlogs/<mode>-<experimentID>/<browser>/, named
+after the run. A warm browser keeps a single netlog for all the runs it does (named
+`warm-<runID>` after the run it was launched for), and async Firefox qlogs are not named
+after a run either. The connections of those logs are attributed to runs by their start
+time instead: the harness marks the wall-clock window of every h3 run (`IngestPool.mark`),
+like the pcap windows of capture.py, and a connection belongs to the run whose window it
+started in (the one that started last, when windows overlap). Files that are already in
+the table are skipped.
+
+With --qlog, experiment.py parses the logs in a pool of background processes
+(`IngestPool`), so that the runs do not wait for them: the logs of a run as soon as it is
+done (cold netlogs, sync Firefox qlogs), the logs shared by runs once the experiment's
+browsers are closed (a netlog is only complete once its browser exits). Run on its own,
+this script has no run windows, and the connections of shared logs get no run ID.
+
+Usage:
+    quic_metrics.py DB [DIRS ...] [--workers WORKERS]
+
+Options:
+    -h --help             Show this screen
+    --workers WORKERS     Number of logs parsed at a time [default: 4]
+"""
+
+import os, re, json, glob
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
+from docopt import docopt
+
+from experiment_utils import insert_statement, setup_data_file_headers
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+QLOG_ROOT = "results/qlogs"
+CHUNK_SIZE = 1 << 16
+# results/qlogs/<mode>-<experimentID>/<browser>/<file>
+LOG_PATH = re.compile(r"(?:^|/)(?:sync|async)-(?P<experiment>\d+)/(?P<browser>[^/]+)/(?P<name>[^/]+)\.(?P<kind>qlog|netlog)$")
+WARM_PREFIX = "warm-"
+
+
+"""
+Return the name of the netlog of a browser launched for the given run
+"""
+def netlog_name(run_id: int, warm: bool) -> str:
+    return f"{WARM_PREFIX}{run_id}" if warm else str(run_id)
+
+# (start, end, run ID): wall-clock window of a run, in seconds
+Window = Tuple[float, float, int]
+
+
+"""
+Return the run whose window contains the given wall-clock time, None if there is none.
+With overlapping windows (async, warm browsers shared by concurrent runs), the run that
+started last: a connection is opened when its page load starts.
+"""
+def run_at(windows: List[Window], time: Optional[float]) -> Optional[int]:
+    if time is None:
+        return None
+    best = None
+    for start, end, run_id in windows:
+        if start <= time <= end and (best is None or start > best[0]):
+            best = (start, run_id)
+    return best[1] if best else None
+
+
+class JsonStream():
+    """
+    Incremental decoding of a JSON document: `find` skips to the value of a key, wherever
+    it is, `value` decodes the value at the current position and `array` yields the
+    elements of the array at the current position. Only the element being decoded is
+    kept in memory.
+    """
+    def __init__(self, f: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size: int = None) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what was consumed already
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self) -> Optional[str]:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    """
+    Move to the value of the next occurrence of one of the given keys, return the key
+    (None if there is none)
+    """
+    def find(self, *keys: str) -> Optional[str]:
+        pattern = re.compile(r'"(%s)"\s*:' % "|".join(re.escape(key) for key in keys))
+        longest = max(len(key) for key in keys)
+        while True:
+            match = pattern.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.end()
+                return match.group(1)
+            # keep the end of the buffer, a key may be split between two chunks
+            self.pos = max(self.pos, len(self.buffer) - longest - 16)
+            if not self.fill():
+                return None
+
+    def value(self):
+        self.skip_whitespace()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # a large value: read bigger and bigger chunks until it is whole
+            self.fill(size)
+            size *= 2
+
+    def array(self) -> Iterator:
+        if self.skip_whitespace() != "[":
+            raise ValueError("Expected an array")
+        self.pos += 1
+        while True:
+            c = self.skip_whitespace()
+            if c is None:
+                raise ValueError("Truncated array")
+            if c == "]":
+                self.pos += 1
+                return
+            if c == ",":
+                self.pos += 1
+                continue
+            yield self.value()
+
+
+class ConnectionMetrics():
+    def __init__(self, connection: str):
+        self.connection = connection
+        self.first_sent = None
+        self.first_received = None
+        self.smoothed_rtt = None
+        self.min_rtt = None
+        self.max_cwnd = None
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.retransmitted = 0
+        self.zero_rtt = False
+        self.streams = set()
+        # time of the first event, in the log's time base (milliseconds)
+        self.first_event = None
+        # milliseconds since the epoch of the log's time 0, if the log has it
+        self.time_origin = None
+
+    def event(self, time: float):
+        if self.first_event is None:
+            self.first_event = time
+
+    """
+    Wall-clock time the connection started at, in seconds, None if the log has no time origin
+    """
+    def start_time(self) -> Optional[float]:
+        if self.time_origin is None or self.first_event is None:
+            return None
+        return (self.time_origin + self.first_event) / 1000
+
+    def packet_sent(self, time: float, zero_rtt: bool = False):
+        self.sent += 1
+        if self.first_sent is None:
+            self.first_sent = time
+        self.zero_rtt = self.zero_rtt or zero_rtt
+
+    def packet_received(self, time: float):
+        self.received += 1
+        if self.first_received is None:
+            self.first_received = time
+
+    def rtt(self, smoothed: Optional[float], minimum: Optional[float]):
+        if smoothed is not None:
+            self.smoothed_rtt = smoothed
+        if minimum is not None:
+            self.min_rtt = minimum if self.min_rtt is None else min(self.min_rtt, minimum)
+
+    def cwnd(self, value: Optional[int]):
+        if value is not None:
+            self.max_cwnd = value if self.max_cwnd is None else max(self.max_cwnd, value)
+
+    def row(self, experiment_id: str, run_id: Optional[int], browser: str, path: str) -> tuple:
+        handshake_rtt = None
+        if self.first_sent is not None and self.first_received is not None and self.first_received >= self.first_sent:
+            handshake_rtt = self.first_received - self.first_sent
+        return (experiment_id, run_id, browser, path, self.connection, handshake_rtt, self.smoothed_rtt,
+                self.min_rtt, self.max_cwnd, self.sent, self.received, self.lost, self.retransmitted,
+                self.zero_rtt, len(self.streams))
+
+
+def number(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def milliseconds(microseconds) -> Optional[float]:
+    value = number(microseconds)
+    return value / 1000 if value is not None else None
+
+
+"""
+Parse a qlog (draft-01 as written by neqo, with `event_fields`, or later drafts with named
+event objects). Every trace is a connection.
+"""
+def parse_qlog(f: TextIO) -> List[ConnectionMetrics]:
+    stream = JsonStream(f)
+    connections = []
+    fields = ["relative_time", "category", "event", "data"]
+    scale = 1.0
+    reference = None
+    try:
+        # the configuration, common fields and event fields of a trace come before its events
+        while True:
+            key = stream.find("time_units", "event_fields", "reference_time", "events")
+            if key is None:
+                break
+            if key == "time_units":
+                scale = 1e-3 if stream.value() == "us" else 1.0
+            elif key == "event_fields":
+                fields = stream.value()
+            elif key == "reference_time":
+                # milliseconds since the epoch
+                reference = number(stream.value())
+            else:
+                connection = ConnectionMetrics(str(len(connections)))
+                connection.time_origin = reference
+                connections.append(connection)
+                for event in stream.array():
+                    if isinstance(event, list):
+                        event = dict(zip(fields, event))
+                    name = event.get("name") or f"{event.get('category')}:{event.get('event')}"
+                    time = (number(event.get("relative_time", event.get("time"))) or 0) * scale
+                    connection.event(time)
+                    qlog_event(connection, name.split(":")[-1], time, event.get("data") or {})
+    except ValueError as e:
+        # a browser that did not exit cleanly leaves the log unterminated
+        logger.warning(f"Truncated qlog: {e}")
+    return connections
+
+
+def stream_ids(data: dict) -> List:
+    return [frame.get("stream_id") for frame in data.get("frames") or []
+            if isinstance(frame, dict) and frame.get("frame_type") == "stream"]
+
+
+def qlog_event(connection: ConnectionMetrics, name: str, time: float, data: dict):
+    if name == "packet_sent":
+        packet_type = str(data.get("packet_type", data.get("header", {}).get("packet_type", ""))).lower()
+        connection.packet_sent(time, packet_type in ("0rtt", "zerortt", "0-rtt"))
+        connection.streams.update(stream_ids(data))
+        if data.get("is_retransmission"):
+            connection.retransmitted += 1
+    elif name == "packet_received":
+        connection.packet_received(time)
+        connection.streams.update(stream_ids(data))
+    elif name == "packet_lost":
+        connection.lost += 1
+    elif name == "metrics_updated":
+        connection.rtt(number(data.get("smoothed_rtt")), number(data.get("min_rtt")))
+        cwnd = number(data.get("congestion_window", data.get("cwnd")))
+        connection.cwnd(int(cwnd) if cwnd is not None else None)
+
+
+"""
+Parse a Chromium netlog. Every QUIC session (netlog source) is a connection.
+"""
+def parse_netlog(f: TextIO) -> List[ConnectionMetrics]:
+    stream = JsonStream(f)
+    if not stream.find("constants"):
+        return []
+    constants = stream.value()
+    event_types = {value: name for name, value in constants.get("logEventTypes", {}).items()}
+    # event times are milliseconds since this offset from the epoch
+    time_origin = number(constants.get("timeTickOffset"))
+    if not stream.find("events"):
+        return []
+    connections: Dict[int, ConnectionMetrics] = {}
+    try:
+        for event in stream.array():
+            name = event_types.get(event.get("type"), "")
+            if not name.startswith("QUIC_SESSION"):
+                continue
+            source = event.get("source", {}).get("id")
+            connection = connections.get(source)
+            if connection is None:
+                connection = connections[source] = ConnectionMetrics(str(source))
+                connection.time_origin = time_origin
+            time = number(event.get("time")) or 0
+            connection.event(time)
+            netlog_event(connection, name, time, event.get("params") or {})
+    except ValueError as e:
+        # a browser that did not exit cleanly leaves the events array unterminated
+        logger.warning(f"Truncated netlog: {e}")
+    return list(connections.values())
+
+
+def netlog_event(connection: ConnectionMetrics, name: str, time: float, params: dict):
+    if name == "QUIC_SESSION_PACKET_SENT":
+        level = str(params.get("encryption_level", ""))
+        connection.packet_sent(time, "ZERO_RTT" in level)
+        if params.get("transmission_type", "NOT_RETRANSMISSION") != "NOT_RETRANSMISSION":
+            connection.retransmitted += 1
+    elif name == "QUIC_SESSION_PACKET_RETRANSMITTED":
+        connection.retransmitted += 1
+    elif name == "QUIC_SESSION_PACKET_RECEIVED":
+        connection.packet_received(time)
+    elif name == "QUIC_SESSION_PACKET_LOST":
+        connection.lost += 1
+    elif name in ("QUIC_SESSION_STREAM_FRAME_SENT", "QUIC_SESSION_STREAM_FRAME_RECEIVED"):
+        connection.streams.add(params.get("stream_id"))
+    elif name == "QUIC_SESSION_ZERO_RTT_STATE_CHANGED":
+        connection.zero_rtt = connection.zero_rtt or "accept" in str(params).lower()
+    # RTT and congestion window, when the session logs them (e.g. with its close stats)
+    connection.rtt(milliseconds(params.get("smoothed_rtt_us", params.get("srtt_us"))), milliseconds(params.get("min_rtt_us")))
+    cwnd = number(params.get("congestion_window"))
+    connection.cwnd(int(cwnd) if cwnd is not None else None)
+
+
+"""
+Return the experiment ID, browser and run ID of a log path, None if it is not a log of an experiment
+"""
+def log_info(path: str) -> Optional[Tuple[str, str, Optional[int]]]:
+    match = LOG_PATH.search(path.replace(os.sep, "/"))
+    if not match:
+        return None
+    name = match.group("name")
+    # async Firefox qlogs are not named after a run, and the netlogs of warm browsers
+    # (warm-<runID>) hold the connections of several runs
+    run_id = int(name) if name.isdigit() else None
+    return match.group("experiment"), match.group("browser"), run_id
+
+
+"""
+Return the rows of the quic_metrics table of the given log. The connections of a log that
+is not named after a run are attributed to runs with the given windows.
+"""
+def ingest_file(path: str, windows: List[Window] = None) -> List[tuple]:
+    info = log_info(path)
+    if info is None:
+        return []
+    experiment_id, browser, run_id = info
+    parse = parse_netlog if path.endswith(".netlog") else parse_qlog
+    with open(path) as f:
+        connections = parse(f)
+    # the same file has the same name whether it was found by the experiment or the script
+    path = os.path.relpath(path)
+    return [connection.row(experiment_id, run_id if run_id is not None else run_at(windows or [], connection.start_time()),
+                           browser, path)
+            for connection in connections if connection.sent or connection.received]
+
+
+"""
+Return the logs under the given directories
+"""
+def find_logs(directories: List[str]) -> List[str]:
+    paths = []
+    for directory in directories:
+        for kind in ("qlog", "netlog"):
+            paths += glob.glob(os.path.join(directory, "**", f"*.{kind}"), recursive=True)
+    return sorted(path for path in paths if log_info(path))
+
+
+class IngestPool():
+    """
+    Parses logs in background processes and hands their rows to the given writer
+    """
+    def __init__(self, database, out: str, workers: int = 2):
+        self.database = database
+        # a resumed experiment has logs that were already ingested; submitted logs are added
+        self.ingested = ingested_files(out)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        # (experiment ID, browser): windows of its h3 runs
+        self.windows: Dict[Tuple[str, str], List[Window]] = {}
+
+    """
+    Record the wall-clock window of a run, for the logs shared by several runs
+    """
+    def mark(self, experiment_id: int, browser: str, h3: bool, run_id: int, start: float, end: float):
+        # only h3 runs have QUIC connections, h2 windows would only make attribution ambiguous
+        if h3:
+            self.windows.setdefault((str(experiment_id), browser), []).append((start, end, run_id))
+
+    """
+    Parse the logs named after the given run, once the run is done and they are complete
+    """
+    def submit_run(self, experiment_id: int, browser: str, run_id: int):
+        for kind in ("qlog", "netlog"):
+            for path in glob.glob(os.path.join(QLOG_ROOT, f"*-{experiment_id}", browser, f"{run_id}.{kind}")):
+                if os.path.relpath(path) not in self.ingested:
+                    self.submit(path)
+
+    """
+    Parse the logs of the given experiment (of every mode and browser) that were not parsed yet
+    """
+    def submit_experiment(self, experiment_id: int):
+        for path in find_logs(glob.glob(os.path.join(QLOG_ROOT, f"*-{experiment_id}"))):
+            if os.path.relpath(path) not in self.ingested:
+                _, browser, _ = log_info(path)
+                self.submit(path, self.windows.get((str(experiment_id), browser), []))
+        for key in [key for key in self.windows if key[0] == str(experiment_id)]:
+            del self.windows[key]
+
+    def submit(self, path: str, windows: List[Window] = None):
+        self.ingested.add(os.path.relpath(path))
+        future = self.executor.submit(ingest_file, path, windows)
+        # called in a thread of the executor, the writer is thread-safe
+        future.add_done_callback(lambda future: self.done(path, future))
+
+    def done(self, path: str, future: Future):
+        try:
+            rows = future.result()
+        except Exception as e:
+            logger.error(f"Cannot parse {path}: {e}")
+            return
+        self.database.execute_group([(insert_statement("quic_metrics"), row) for row in rows])
+
+    """
+    Wait for the logs submitted so far
+    """
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+"""
+Return the logs that are in the quic_metrics table of the database
+"""
+def ingested_files(database: str) -> set:
+    if database == ":memory:":
+        return set()
+    db = setup_data_file_headers(database)
+    try:
+        return {row[0] for row in db.execute("SELECT DISTINCT file FROM quic_metrics")}
+    finally:
+        db.close()
+
+
+"""
+Ingest the logs under the given directories that are not in the database yet, return
+the number of files ingested
+"""
+def ingest(database: str, directories: List[str], workers: int) -> int:
+    ingested = ingested_files(database)
+    paths = [path for path in find_logs(directories) if os.path.relpath(path) not in ingested]
+    logger.info(f"{len(paths)} logs to ingest")
+    db = setup_data_file_headers(database)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ingest_file, path): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(f"Cannot parse {futures[future]}: {e}")
+                continue
+            db.executemany(insert_statement("quic_metrics"), rows)
+            db.commit()
+    db.close()
+    return len(paths)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = docopt(__doc__)
+    ingest(args['DB'], args['DIRS'] or [QLOG_ROOT], int(args['--workers']))
@@ -0,0 +1,166 @@
+import os, time, threading
+from typing import Dict, Optional
+import psutil
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+Per-run attribution of the resources used by the browser.
+
+Every browser is launched with a marker in its environment (see `browser_env`), which its
+processes inherit. At the start of a run the tracker finds the root process of the browser
+by that marker, and until the end of the run it polls the process tree of that root to
+sum the CPU time of every process (including the ones spawned or exiting during the run)
+and to find the peak RSS of the whole tree. Bytes sent and received are the counters of
+the experiment's network device over the run.
+
+When several runs share a warm browser at the same time (async mode), each of them is
+charged the whole browser's usage; `concurrentRuns` records how many runs were sharing it.
+Device byte counters are likewise shared by all the runs in flight.
+"""
+
+# name of the environment variable holding the marker of a browser
+MARKER = "QUIC_HARNESS_BROWSER"
+# default seconds between two polls of the process trees of the runs in flight
+POLL_INTERVAL = 0.05
+
+
+"""
+Return the environment to launch a browser with: ours, plus the marker and the
+key log file if given
+"""
+def browser_env(marker: str, keylog: Optional[str] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    env[MARKER] = marker
+    if keylog:
+        env["SSLKEYLOGFILE"] = keylog
+    return env
+
+
+"""
+Find the root process of the browser launched with the given marker among our descendants
+"""
+def find_browser_root(marker: str) -> Optional[psutil.Process]:
+    marked = set()
+    for proc in psutil.Process().children(recursive=True):
+        try:
+            if proc.environ().get(MARKER) == marker:
+                marked.add(proc.pid)
+        except psutil.Error:
+            pass
+    for pid in marked:
+        try:
+            proc = psutil.Process(pid)
+            if proc.ppid() not in marked:
+                return proc
+        except psutil.Error:
+            pass
+    return None
+
+
+class RunUsage():
+    def __init__(self, root: psutil.Process, net_start):
+        self.root = root
+        self.start = time.monotonic()
+        self.net_start = net_start
+        # CPU time (user, system) of every process of the tree, when first and last seen
+        self.first_seen: Dict[int, tuple] = {}
+        self.last_seen: Dict[int, tuple] = {}
+        self.peak_rss = 0
+        self.concurrent = 1
+
+
+class RunResourceTracker():
+    def __init__(self, device: str, poll_interval: float = POLL_INTERVAL):
+        self.device = device
+        self.poll_interval = poll_interval
+        self.runs: Dict[int, RunUsage] = {}
+        self.roots: Dict[str, psutil.Process] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    """
+    Start attributing the usage of the browser with the given marker to the given run
+    """
+    def start(self, run_id: int, marker: str):
+        root = self.roots.get(marker)
+        if root is None or not root.is_running():
+            root = find_browser_root(marker)
+            if root is None:
+                logger.debug(f"No browser process found for run {run_id}")
+                return
+            self.roots[marker] = root
+        usage = RunUsage(root, self.net_counters())
+        with self.lock:
+            sharing = [other for other in self.runs.values() if other.root.pid == root.pid]
+            for other in sharing:
+                other.concurrent += 1
+            usage.concurrent += len(sharing)
+            self.poll_run(usage, first=True)
+            self.runs[run_id] = usage
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="run-resources", daemon=True)
+            self.thread.start()
+
+    """
+    Stop tracking the given run, return its row of the run_resources table
+    (without the experimentID and browser), or None if it was not tracked
+    """
+    def stop(self, run_id: int) -> Optional[dict]:
+        with self.lock:
+            usage = self.runs.pop(run_id, None)
+            if usage is None:
+                return None
+            self.poll_run(usage)
+        net_end = self.net_counters()
+        user = sum(cpu[0] - usage.first_seen.get(pid, (0, 0))[0] for pid, cpu in usage.last_seen.items())
+        system = sum(cpu[1] - usage.first_seen.get(pid, (0, 0))[1] for pid, cpu in usage.last_seen.items())
+        return {
+            "runID": run_id,
+            "rootPid": usage.root.pid,
+            "procs": len(usage.last_seen),
+            "userTime": user,
+            "systemTime": system,
+            "peakRSS": usage.peak_rss,
+            "bytesSent": net_end.bytes_sent - usage.net_start.bytes_sent if net_end and usage.net_start else None,
+            "bytesRecv": net_end.bytes_recv - usage.net_start.bytes_recv if net_end and usage.net_start else None,
+            "concurrentRuns": usage.concurrent,
+            "duration": time.monotonic() - usage.start,
+        }
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.runs:
+                    # the next start() starts a new thread
+                    self.thread = None
+                    return
+                for usage in self.runs.values():
+                    self.poll_run(usage)
+            time.sleep(self.poll_interval)
+
+    """
+    Read the CPU time and RSS of every process of the tree of the given run.
+    Processes seen for the first time after the start of the run count from zero.
+    """
+    def poll_run(self, usage: RunUsage, first: bool = False):
+        rss = 0
+        try:
+            procs = [usage.root] + usage.root.children(recursive=True)
+        except psutil.Error:
+            return
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    cpu = proc.cpu_times()
+                    rss += proc.memory_info().rss
+            except psutil.Error:
+                continue
+            if first:
+                usage.first_seen[proc.pid] = (cpu.user, cpu.system)
+            usage.last_seen[proc.pid] = (cpu.user, cpu.system)
+        usage.peak_rss = max(usage.peak_rss, rss)
+
+    def net_counters(self):
+        return psutil.net_io_counters(pernic=True).get(self.device)
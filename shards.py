@@ -0,0 +1,185 @@
+"""Network Namespace Shards
+
+Runs several network conditions at the same time, each in its own client network
+namespace ("shard") connected to a shared server namespace.
+
+Topology (building on install/namespace.sh):
+    harness-srv       server namespace, with a bridge harness-br at 10.77.0.1/16
+    harness-c<i>      client namespace of shard i, with veth-c<i> at 10.77.<1+i/250>.<2+i%250>/16,
+                      whose peer veth-c<i>-br is a port of harness-br in harness-srv
+
+Servers must be started inside harness-srv (`sudo ip netns exec harness-srv ...`) and are
+reached by every shard at 10.77.0.1. Loopback endpoints (local-ref, localhost, 127.0.0.1)
+would go over the shard's own lo, which is never shaped, so they are rejected. A condition is shaped on both ends of the shard's
+veth pair: experiment.py shapes the client end (uploads) like it would shape --device,
+and the dispatcher shapes the server end (downloads).
+
+Usage:
+    shards.py setup SHARDS
+    shards.py teardown SHARDS
+"""
+
+import time, json, getpass, ipaddress, subprocess
+from typing import List, Dict
+from urllib.parse import urlparse
+from docopt import docopt
+
+from qdisc import QdiscManager
+from endpoint import local_endpoint_to_port
+from local_server import LOCAL_REF_HOST
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+SERVER_NETNS = "harness-srv"
+BRIDGE = "harness-br"
+SERVER_ADDRESS = "10.77.0.1"
+PREFIX_LENGTH = 16
+
+
+class Shard():
+    def __init__(self, index: int):
+        self.index = index
+        self.netns = f"harness-c{index}"
+        # client end of the veth pair, inside the shard namespace
+        self.device = f"veth-c{index}"
+        # server end of the veth pair, a port of the bridge in the server namespace
+        self.peer = f"veth-c{index}-br"
+        self.address = f"10.77.{1 + index // 250}.{2 + index % 250}"
+
+
+"""
+Run the given command with sudo, inside the given network namespace if any.
+Return the return code of the command.
+"""
+def run_cmd(cmd: str, netns: str = None) -> int:
+    prefix = f"sudo ip netns exec {netns} " if netns else "sudo "
+    logger.debug(f"commands are {prefix + cmd}")
+    return subprocess.run((prefix + cmd).split()).returncode
+
+
+def netns_exists(netns: str) -> bool:
+    names = subprocess.run(["ip", "netns", "list"], capture_output=True, text=True).stdout
+    return any(line.split()[0] == netns for line in names.splitlines() if line.strip())
+
+
+"""
+Create the server namespace and its bridge, unless they already exist
+"""
+def setup_server_namespace():
+    if netns_exists(SERVER_NETNS):
+        return
+    run_cmd(f"ip netns add {SERVER_NETNS}")
+    run_cmd("ip link set lo up", SERVER_NETNS)
+    run_cmd(f"ip link add {BRIDGE} type bridge", SERVER_NETNS)
+    run_cmd(f"ip addr add {SERVER_ADDRESS}/{PREFIX_LENGTH} dev {BRIDGE}", SERVER_NETNS)
+    run_cmd(f"ip link set {BRIDGE} up", SERVER_NETNS)
+
+
+"""
+Create the namespaces of the given number of shards, and the server namespace,
+skipping the ones that already exist. Return the shards.
+"""
+def setup_shards(num_shards: int) -> List[Shard]:
+    setup_server_namespace()
+    shards = [Shard(i) for i in range(num_shards)]
+    for shard in shards:
+        if netns_exists(shard.netns):
+            continue
+        run_cmd(f"ip netns add {shard.netns}")
+        run_cmd("ip link set lo up", shard.netns)
+        # create the pair with each end directly in its namespace
+        run_cmd(f"ip link add {shard.device} netns {shard.netns} type veth peer name {shard.peer} netns {SERVER_NETNS}")
+        run_cmd(f"ip addr add {shard.address}/{PREFIX_LENGTH} dev {shard.device}", shard.netns)
+        run_cmd(f"ip link set {shard.device} up", shard.netns)
+        run_cmd(f"ip link set {shard.peer} master {BRIDGE}", SERVER_NETNS)
+        run_cmd(f"ip link set {shard.peer} up", SERVER_NETNS)
+    return shards
+
+
+"""
+Delete the namespaces of the given number of shards. Deleting a namespace also deletes
+its end of the veth pair, and with it the peer. The server namespace is kept, since
+servers are running in it.
+"""
+def teardown_shards(num_shards: int):
+    for shard in [Shard(i) for i in range(num_shards)]:
+        if netns_exists(shard.netns):
+            run_cmd(f"ip netns del {shard.netns}")
+
+
+"""
+Return the endpoints and URLs of the given arguments of experiment.py that are on the loopback
+interface: inside a shard they would go over the namespace's own lo instead of its veth pair
+"""
+def loopback_targets(args: Dict) -> List[str]:
+    targets = [endpoint for endpoint in args.get('--endpoints') or [] if endpoint in local_endpoint_to_port]
+    for url in args.get('--urls') or []:
+        host = urlparse(url).hostname or ""
+        if host in ("localhost", LOCAL_REF_HOST):
+            targets.append(url)
+            continue
+        try:
+            if ipaddress.ip_address(host).is_loopback:
+                targets.append(url)
+        except ValueError:
+            pass
+    return targets
+
+
+"""
+Run experiment.py once per condition, each in a free shard, with up to one run per shard
+at a time. `args` are the parsed arguments of experiment.py, which are passed on to the
+children with the condition and device of their shard. Return the conditions that failed.
+"""
+def run_sharded(shards: List[Shard], conditions: List[str], args: Dict, poll_interval: float = 1.0) -> List[str]:
+    user = getpass.getuser()
+    pending = list(conditions)
+    free = list(shards)
+    running: Dict[subprocess.Popen, tuple] = {}
+    failed = []
+    qdiscs = {shard.index: QdiscManager(shard.peer, SERVER_NETNS) for shard in shards}
+    try:
+        while pending or running:
+            while pending and free:
+                shard = free.pop(0)
+                condition = pending.pop(0)
+                # the children shape the client end themselves
+                qdiscs[shard.index].apply(condition)
+                child_args = dict(args)
+                child_args.update({"--conditions": [condition], "--device": shard.device, "--shards": None, "--json": None,
+                                   "--trace": None, "--serve": None, "--agent": None})
+                cmd = ["sudo", "ip", "netns", "exec", shard.netns, "sudo", "-u", user,
+                       "python3", "experiment.py", "--json", json.dumps(child_args)]
+                logger.info(f"Shard {shard.index}: {condition}")
+                running[subprocess.Popen(cmd)] = (shard, condition)
+            time.sleep(poll_interval)
+            for proc, (shard, condition) in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                del running[proc]
+                qdiscs[shard.index].reset()
+                free.append(shard)
+                if proc.returncode != 0:
+                    logger.error(f"Shard {shard.index}: {condition} exited with {proc.returncode}")
+                    failed.append(condition)
+                else:
+                    logger.info(f"Shard {shard.index}: {condition} done")
+    finally:
+        for proc, (shard, condition) in running.items():
+            proc.terminate()
+            proc.wait()
+            qdiscs[shard.index].reset()
+    return failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = docopt(__doc__)
+    num_shards = int(args['SHARDS'])
+    if args['setup']:
+        for shard in setup_shards(num_shards):
+            print(f"{shard.netns}: {shard.device} {shard.address}")
+        print(f"{SERVER_NETNS}: {BRIDGE} {SERVER_ADDRESS}")
+    elif args['teardown']:
+        teardown_shards(num_shards)
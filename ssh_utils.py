@@ -1,103 +1,294 @@
-import time, sys, json
-import paramiko
+import os, time, json, select, signal, subprocess
 from os import path
-from paramiko import SSHClient
+from typing import Optional, Tuple
 
-import logging 
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+import logging
 logger = logging.getLogger('__main__.' + __name__)
 
+"""
+Control of the server VM: restarting the servers and running systemUtil.py on it while an
+experiment runs.
+
+A single session is kept for the whole sweep (see `get_session`) instead of a new SSH
+connection per experiment, with keepalives so that idle periods between experiments do
+not get it dropped. Connecting is retried a bounded number of times with exponential
+backoff, and a dropped session is reconnected the same way on its next command. Command
+output is read with select, waiting for data instead of polling the channel, so that the
+harness does not take a client core while `restart-all.sh` runs.
+
+Commands go through a transport: `SSHTransport` runs them on the server VM over one
+paramiko connection, `LocalTransport` runs them in a local checkout with subprocesses, to
+stand in for the server VM when testing the harness on one machine (`--server_dir`).
+"""
+
 SERVER_KEY = "MSFT_Clinic_Key.pem"
 SERVER_IPS_FILENAME = "ips.json"
 SERVER_IPS_EXAMPLE_FILENAME = "ips.example.json"
 
-CMD_CD_ROOT = "cd ~/hmc-clinic-msft-2020"
-
-
-def execute_cmd_blocking(ssh: SSHClient, cmd: str): 
-    logger.debug(f"\t>\t{cmd}")
-    # ssh.exec_command will only run ONE command, and it gives us 
-    # stdin, stdout, and stderr to work with. We have no further input, 
-    # so we just want to read everything from stdout and stderr.
-    _, stdout, stderr = ssh.exec_command(cmd)
-    dat = ""
-    dat_err = ""
-    # until both channels are done transmitting...
-    while not stderr.channel.exit_status_ready() or not stdout.channel.exit_status_ready():
-        # check each channel to see if any bytes are ready to be received
-        # and receive at most 1024 at a time.
-        if stdout.channel.recv_ready():
-            dat = dat + str(stdout.channel.recv(1024))
-        if stderr.channel.recv_ready():
-            dat_err = dat + str(stderr.channel.recv(1024))
-    
-    # split the received data by newlines, and print.
-    lines = dat.splitlines()
-    lines_err = dat_err.splitlines()
-    for line in lines:
-        logger.debug(f"\t\t{line}")
-    for line in lines_err:
-        logger.debug(f"\t\t{line}")
-
-
-# This mutates ssh, so later down the line we can recover the 
-# channels later if we want.
-def execute_cmd(ssh: SSHClient, cmd: str):
-    logger.debug(f"\t>\t{cmd}")
-    # ignoring stdout, stderr from this. Polling every so often would 
-    # perhaps be too complex. Maybe we can get all of stdout,stderr in 
-    # end_server_monitoring?
-    _, _, _ = ssh.exec_command(cmd)
-
-
-# thanks to https://stackoverflow.com/questions/3586106/perform-commands-over-ssh-with-python/57439663#57439663
-def start_server_monitoring(exp_id: str, out: str) -> SSHClient:
-    key = paramiko.RSAKey.from_private_key_file(SERVER_KEY)
-    while True:  # keep trying until things work or everything breaks
-        logger.info("Trying to connect to server...")
-        try: 
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ip = get_server_ips_dict()["public_ip"]
-            ssh.connect(ip, username="clinic", pkey=key, banner_timeout=200)
-            break
-        except paramiko.AuthenticationException as e:
-            logger.error("Auth failed when connecting to Server:")
-            logger.error(e)
-            logger.info("Trying again")
-        except paramiko.ssh_exception.SSHException as e: 
-            logger.error("Encountered exception:")
-            logger.error(e) 
-            logger.info("Trying again...")
-        except Exception as e: 
-            logger.critical("Unexpected exception")
-            logger.critical(e)
-            sys.exit(1)
-    
-    logger.info("Successful Connection: Running Commands")
-    commands = [
-        CMD_CD_ROOT,
-        "cd install",
-        "./restart-all.sh",
-    ]
-    execute_cmd_blocking(ssh, " && ".join(commands))
-
-    ## TODO - Test
-    cmd_start_monitor = f"python3 systemUtil.py {exp_id} server {out}"
-    execute_cmd(ssh, " && ".join([CMD_CD_ROOT, cmd_start_monitor]))
+# the checkout of this repository on the server VM
+SERVER_ROOT = "~/hmc-clinic-msft-2020"
+SERVER_USER = "clinic"
+CONNECT_ATTEMPTS = 5
+# seconds between two connection attempts, doubled after every failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+CONNECT_TIMEOUT = 30
+KEEPALIVE_INTERVAL = 30
+# seconds a command may run
+COMMAND_TIMEOUT = 600
+# seconds a background command gets to exit after being interrupted
+STOP_TIMEOUT = 10
+# longest wait for output between two checks of the exit status
+SELECT_INTERVAL = 1.0
+
+
+class SSHTransport():
+    def __init__(self, host: str, user: str = SERVER_USER, key_file: str = SERVER_KEY, root: str = SERVER_ROOT):
+        if paramiko is None:
+            raise ImportError("Controlling the server VM needs paramiko: pip3 install paramiko")
+        self.host = host
+        self.user = user
+        self.key_file = key_file
+        self.root = root
+        self.client = None
+
+    def connected(self) -> bool:
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+    def connect(self):
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(self.host, username=self.user, pkey=paramiko.RSAKey.from_private_key_file(self.key_file),
+                            timeout=CONNECT_TIMEOUT, banner_timeout=200)
+        self.client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+
+    def open(self, cmd: str, pty: bool = False) -> "paramiko.Channel":
+        channel = self.client.get_transport().open_session()
+        if pty:
+            # the command then gets the signals of the terminal, e.g. ^C
+            channel.get_pty()
+        channel.exec_command(f"cd {self.root} && {cmd}")
+        return channel
+
+    """
+    Run the command in the root directory, return its exit status, stdout and stderr
+    """
+    def run(self, cmd: str, timeout: float = COMMAND_TIMEOUT) -> Tuple[int, str, str]:
+        channel = self.open(cmd)
+        stdout, stderr = [], []
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                # the channel is readable once stdout has data or the channel is closed;
+                # stderr is checked on every wake up
+                select.select([channel], [], [], min(SELECT_INTERVAL, max(deadline - time.monotonic(), 0)))
+                while channel.recv_ready():
+                    stdout.append(channel.recv(4096))
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(4096))
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"{cmd} did not finish within {timeout} s")
+            return channel.recv_exit_status(), b"".join(stdout).decode(errors="replace"), b"".join(stderr).decode(errors="replace")
+        finally:
+            channel.close()
+
+    """
+    Start the command in the background, return its handle for `stop`
+    """
+    def start(self, cmd: str) -> "paramiko.Channel":
+        # exec, so that the interrupt goes to the command rather than to the shell
+        return self.open(f"exec {cmd}", pty=True)
+
+    """
+    Interrupt a command started in the background, and wait for it to exit
+    """
+    def stop(self, channel: "paramiko.Channel"):
+        try:
+            if not channel.exit_status_ready():
+                channel.send(b"\x03")
+                deadline = time.monotonic() + STOP_TIMEOUT
+                while not channel.exit_status_ready() and time.monotonic() < deadline:
+                    select.select([channel], [], [], SELECT_INTERVAL)
+                    while channel.recv_ready():
+                        channel.recv(4096)
+        except OSError as e:
+            logger.warning(f"Could not interrupt a server command: {e}")
+        finally:
+            # the command gets hung up on if it did not exit
+            channel.close()
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+
+class LocalTransport():
+    def __init__(self, root: str):
+        self.root = os.path.expanduser(root)
+
+    def connected(self) -> bool:
+        return path.isdir(self.root)
+
+    def connect(self):
+        if not path.isdir(self.root):
+            raise ConnectionError(f"No such directory: {self.root}")
+
+    def run(self, cmd: str, timeout: float = COMMAND_TIMEOUT) -> Tuple[int, str, str]:
+        process = subprocess.Popen(["bash", "-c", cmd], cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, start_new_session=True)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+            raise TimeoutError(f"{cmd} did not finish within {timeout} s")
+        return process.returncode, stdout, stderr
+
+    def start(self, cmd: str) -> subprocess.Popen:
+        # a session of its own, so that it can be interrupted without the harness
+        return subprocess.Popen(["bash", "-c", f"exec {cmd}"], cwd=self.root, start_new_session=True)
+
+    def stop(self, process: subprocess.Popen):
+        if process.poll() is not None:
+            return
+        os.killpg(process.pid, signal.SIGINT)
+        try:
+            process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+    def close(self):
+        pass
+
+
+class ServerSession():
+    def __init__(self, transport):
+        self.transport = transport
+
+    """
+    Connect unless the transport is connected, retrying with backoff;
+    raise ConnectionError once every attempt failed
+    """
+    def ensure_connected(self):
+        if self.transport.connected():
+            return
+        delay = RETRY_DELAY
+        for attempt in range(1, CONNECT_ATTEMPTS + 1):
+            logger.info("Trying to connect to server...")
+            try:
+                self.transport.connect()
+                logger.info("Successful Connection")
+                return
+            except Exception as e:
+                logger.error(f"Connecting to the server failed (attempt {attempt}/{CONNECT_ATTEMPTS}): {e}")
+            if attempt < CONNECT_ATTEMPTS:
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        raise ConnectionError("Could not connect to the server")
+
+    """
+    Run the command on the server and log its output, return its exit status
+    """
+    def run(self, cmd: str, timeout: float = COMMAND_TIMEOUT) -> int:
+        self.ensure_connected()
+        logger.debug(f"\t>\t{cmd}")
+        status, stdout, stderr = self.transport.run(cmd, timeout)
+        for line in (stdout + stderr).splitlines():
+            logger.debug(f"\t\t{line}")
+        if status != 0:
+            logger.error(f"{cmd} exited with {status}")
+        return status
+
+    def start(self, cmd: str):
+        self.ensure_connected()
+        logger.debug(f"\t>\t{cmd} &")
+        return self.transport.start(cmd)
+
+    def stop(self, handle):
+        self.transport.stop(handle)
+
+    def close(self):
+        self.transport.close()
+
+
+# the session of the sweep, created on first use
+session: Optional[ServerSession] = None
+
+
+"""
+Run the server commands in the given local checkout instead of on the server VM
+"""
+def use_local_server(root: str):
+    global session
+    close_session()
+    session = ServerSession(LocalTransport(root))
+
+
+def get_session() -> ServerSession:
+    global session
+    if session is None:
+        session = ServerSession(SSHTransport(get_server_ips_dict()["public_ip"]))
+    return session
+
+
+def close_session():
+    global session
+    if session:
+        session.close()
+        session = None
+
+
+"""
+Return whether the experiments of the endpoint restart and monitor the server: always with
+a local checkout (see use_local_server), only for the endpoints on the server VM otherwise
+"""
+def monitors_server(endpoint) -> bool:
+    if session is not None and isinstance(session.transport, LocalTransport):
+        return True
+    return endpoint.is_on_server()
+
+
+"""
+Restart the servers and start systemUtil on the server for the experiment, return the
+handle of the monitoring process for `end_server_monitoring`, None if the server cannot
+be reached (the experiment then goes on without them)
+"""
+def start_server_monitoring(exp_id: str, out: str):
+    try:
+        server = get_session()
+        server.run("cd install && ./restart-all.sh")
+        monitor = server.start(f"python3 systemUtil.py {exp_id} server {out}")
+    except Exception as e:
+        # a server that cannot be reached must not stop the sweep
+        logger.error(f"No server monitoring for experiment {exp_id}: {e}")
+        return None
     logger.info("successfully ran systemUtil on server")
-    return ssh
+    return monitor
 
 
-# hopefully closing connection is sufficient to end process
-def end_server_monitoring(ssh: SSHClient): 
-    ssh.close()
+"""
+Stop the systemUtil of an experiment; the session stays open for the next experiments
+"""
+def end_server_monitoring(monitor):
+    if monitor is not None and session is not None:
+        session.stop(monitor)
 
 
-def get_server_ips_dict(): 
+def get_server_ips_dict():
     name = SERVER_IPS_FILENAME
-    if not path.exists(SERVER_IPS_FILENAME): 
+    if not path.exists(SERVER_IPS_FILENAME):
         name = SERVER_IPS_EXAMPLE_FILENAME
-    with open(name) as f: 
+    with open(name) as f:
         return json.load(f)
 
 
@@ -1,60 +1,99 @@
 import psutil
-import time 
+import time
 import signal
 import csv
 import os
 import sys
-import subprocess
-from experiment_utils import write_monitoring_data, get_time, write_processes_data
+from typing import Dict, List, Optional
+from experiment_utils import write_monitoring_data, get_time, write_processes_data, BufferedWriter, FLUSH_SIZE, FLUSH_INTERVAL, \
+    write_process_sample_data, write_sampler_overhead_data
+from tracing import tracer
 
 
 hz = os.sysconf('SC_CLK_TCK')
 
+# names of the processes at the root of the trees we monitor
+CLIENT_PROCS = ['firefox', 'chrome', 'msedge', 'headless_shell']
+SERVER_PROCS = ['nginx', 'caddy', 'openlitespeed', 'lshttpd']
+# default number of samples per second of the tracked processes
+SAMPLE_RATE = 10
+# seconds between two searches for new processes to track
+DISCOVER_INTERVAL = 1.0
+
 """
-Return data about browser processes (the client) in two lists and a float
-broswers_names: a list of the names of the processes (browser type: firefox, edge, chromium)
-broswers_cpu_times: a list of the corresponding CPU time
-broswers_iowait: the current iowait
+Return the inode of the network namespace of the given process, None if it cannot be read
+(e.g. the process of another user)
 """
-def get_broswer_util_data():
-    procs = os.listdir('/proc')
-    procs_cpu_times = []
-    procs_names = []
+def netns_of(pid: int) -> Optional[int]:
+    try:
+        return os.stat(f"/proc/{pid}/ns/net").st_ino
+    except OSError:
+        return None
 
-    # Determine if we're monitoring client or server
-    if sys.argv[2] == 'client':
-        procs_checklist = ['(firefox)', '(chrome)', '(msedge)']
-    elif sys.argv[2] == 'server':
-        procs_checklist = ['(nginx)','(caddy)','(openlitespeed)']
-
-    # iterate through all the running process with numeric pid
-    for proc in procs:
-        if proc.isnumeric():
+
+"""
+Samples the browser (client) or server process trees.
+Only discovering new processes walks the whole process table, which happens once every
+DISCOVER_INTERVAL seconds. Sampling only reads the tracked pids, with psutil's oneshot()
+so that every /proc file of a process is read once per sample.
+
+With `netns`, only the trees whose root is in that network namespace are tracked: the
+shards of shards.py share the process table, and each only monitors its own browsers.
+Only the roots are checked, the sandboxed children of a browser have namespaces of their own.
+"""
+class ProcessSampler():
+    def __init__(self, names: List[str], netns: Optional[int] = None):
+        self.names = names
+        self.netns = netns
+        self.procs: Dict[int, psutil.Process] = {}
+
+    """
+    Track the processes whose name is in `names`, and all of their descendants
+    """
+    def discover(self):
+        for proc in psutil.process_iter(['name']):
+            if proc.info['name'] in self.names and proc.pid not in self.procs:
+                if self.netns is not None and netns_of(proc.pid) != self.netns:
+                    continue
+                try:
+                    for tracked in [proc] + proc.children(recursive=True):
+                        self.procs[tracked.pid] = tracked
+                except psutil.Error:
+                    pass
+        # children spawned by processes we already track
+        for proc in list(self.procs.values()):
+            try:
+                for child in proc.children():
+                    self.procs.setdefault(child.pid, child)
+            except psutil.Error:
+                self.procs.pop(proc.pid, None)
+
+    """
+    Return one row of the process_samples table (without the experimentID) per tracked process
+    """
+    def sample(self) -> List[tuple]:
+        rows = []
+        now = time.time()
+        for pid, proc in list(self.procs.items()):
             try:
-                # get the status information about the process
-                # https://man7.org/linux/man-pages/man5/procfs.5.html 
-                with open('/proc/'+proc+'/stat', 'r') as f:
-                    data = f.read()
-                stat = data.split()
-                # find the process corresponding to the browser instances
-                # proc/[pid]/stat[1]:comm is the filename of the executable 
-                if str(stat[1]) in procs_checklist:
-                    # add the CPU time to the list
-                    # proc/[pid]/stat[13]:utime is the amount of time that this process has been scheduled
-                    # in user mode, measured in clock ticks 
-                    procs_cpu_times.append(int(stat[13])/hz)
-                    # add the name of the process (browser instance) to the list
-                    procs_names.append(stat[1][1:-1])
-            # sometimes right after we obtain the pid, the process ends, then we will ignore the process
-            except FileNotFoundError:
+                with proc.oneshot():
+                    name = proc.name()
+                    cpu = proc.cpu_times()
+                    rss = proc.memory_info().rss
+                    ctx = proc.num_ctx_switches()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except psutil.AccessDenied:
+                        # the io counters of other users' processes (e.g. servers running as root)
+                        read_bytes, write_bytes = None, None
+                rows.append((now, pid, name, cpu.user, cpu.system, rss, ctx.voluntary, ctx.involuntary, read_bytes, write_bytes))
+            # sometimes right after we obtain the pid, the process ends, then we will stop tracking the process
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                del self.procs[pid]
+            except psutil.AccessDenied:
                 pass
-    # Get iowait data
-    with open('/proc/stat', 'r') as f:
-        data = f.read()
-        # proc/stat[4]: iowait is the time  a task waits for I/O to complete
-        # this number is not reliable, detailed see https://man7.org/linux/man-pages/man5/procfs.5.html
-        iowait = data.split()[4]
-    return procs_names, procs_cpu_times, iowait
+        return rows
 
 
 """
@@ -73,35 +112,88 @@ class GracefulKiller:
         self.kill_now = True
 
 """
-Return data of all running processes, collected from the command `ps aux`
+Return data of all running processes, with the same columns as the command `ps aux`,
 as a list of tuples of information about processes
 """
 def get_all_processes_data():
-    ps = subprocess.check_output(['ps', 'aux']).strip().decode('utf-8').replace("'","")
-    processes = ps.split('\n')
-    nfields = len(processes[0].split()) - 1
+    now = time.time()
     data = []
-    for row in processes[1:]:
-        data.append(tuple([int(time.time())] + row.split(None, nfields)))
+    attrs = ['username', 'pid', 'cpu_times', 'memory_percent', 'memory_info', 'terminal', 'status', 'create_time', 'cmdline', 'name']
+    for proc in psutil.process_iter(attrs):
+        info = proc.info
+        if info['cpu_times'] is None or info['memory_info'] is None:
+            continue
+        cpu_time = info['cpu_times'].user + info['cpu_times'].system
+        # like ps, %CPU is the CPU time used divided by the time the process has been running
+        cpu_percent = 100 * cpu_time / max(now - info['create_time'], 1e-9)
+        command = " ".join(info['cmdline']) if info['cmdline'] else f"[{info['name']}]"
+        data.append((
+            int(now), info['username'], info['pid'], round(cpu_percent, 1), round(info['memory_percent'] or 0, 1),
+            info['memory_info'].vms // 1024, info['memory_info'].rss // 1024,
+            (info['terminal'] or "?").replace("/dev/", ""), info['status'],
+            time.strftime("%H:%M", time.localtime(info['create_time'])),
+            f"{int(cpu_time // 60)}:{int(cpu_time % 60):02d}", command.replace("'", ""),
+        ))
     return data
-        
+
 
 if __name__ == "__main__":
     # getting experimentID and database name from the arguments
     experimentID = sys.argv[1]
+    # Determine if we're monitoring client or server
+    procs_checklist = CLIENT_PROCS if sys.argv[2] == 'client' else SERVER_PROCS
     output_database_name = sys.argv[3]
+    # optional buffering and sampling parameters, passed on by experiment.py
+    flush_size = int(sys.argv[4]) if len(sys.argv) > 4 else FLUSH_SIZE
+    flush_interval = float(sys.argv[5]) if len(sys.argv) > 5 else FLUSH_INTERVAL
+    sample_rate = float(sys.argv[6]) if len(sys.argv) > 6 else SAMPLE_RATE
+    # the sampler reports its own overhead in the sampler_overhead table
+    tracer.enabled = False
     killer = GracefulKiller()
+    database = BufferedWriter(output_database_name, flush_size, flush_interval)
     # Write processdata to the database TODO how often should we write process data to the database?
     process_data = get_all_processes_data()
     for row in process_data:
-        write_processes_data(row, output_database_name)
-    # every sec, collect browsers information
+        write_processes_data(row, database)
+    database.flush()
+
+    # the browsers of the experiment run in the network namespace of its shard, like this process
+    sampler = ProcessSampler(procs_checklist, netns_of(os.getpid()) if sys.argv[2] == 'client' else None)
+    myself = psutil.Process()
+    period = 1 / sample_rate
+    next_sample = time.monotonic()
+    last_summary = next_sample - DISCOVER_INTERVAL
+    # time and CPU time spent sampling since the last summary
+    samples, wall_time = 0, 0.0
+    cpu_start = sum(myself.cpu_times()[:2])
+    rows = []
     while not killer.kill_now:
-        time.sleep(1)
-        # get a lists of browsers processes and the coresponding cpu time and iowait
-        procs_names, procs_cpu_times, procs_iowait = get_broswer_util_data()
-        # get the load average in 1 min, 5 mins, and 15 mins
-        load1, load5, load15 = os.getloadavg()
-        row_tuple = (experimentID, get_time(),int(time.time()),str(procs_names), \
-            str(procs_cpu_times), procs_iowait, load1, load5, load15) # need to turn lsits into strs
-        write_monitoring_data(row_tuple, output_database_name)
+        start = time.monotonic()
+        if start - last_summary >= DISCOVER_INTERVAL:
+            # once every second, look for new processes and write the summary rows
+            sampler.discover()
+            if rows:
+                procs_names = [row[2] for row in rows]
+                procs_cpu_times = [row[3] for row in rows]
+                # iowait is the time a task waits for I/O to complete, in clock ticks
+                # this number is not reliable, detailed see https://man7.org/linux/man-pages/man5/procfs.5.html
+                procs_iowait = int(psutil.cpu_times().iowait * hz)
+                # get the load average in 1 min, 5 mins, and 15 mins
+                load1, load5, load15 = os.getloadavg()
+                row_tuple = (experimentID, get_time(),int(time.time()),str(procs_names), \
+                    str(procs_cpu_times), procs_iowait, load1, load5, load15) # need to turn lsits into strs
+                write_monitoring_data(row_tuple, database)
+            cpu_now = sum(myself.cpu_times()[:2])
+            write_sampler_overhead_data((experimentID, time.time(), samples, len(sampler.procs), wall_time, cpu_now - cpu_start), database)
+            samples, wall_time, cpu_start = 0, 0.0, cpu_now
+            last_summary = start
+        rows = sampler.sample()
+        for row in rows:
+            write_process_sample_data((experimentID,) + row, database)
+        samples += 1
+        wall_time += time.monotonic() - start
+        # keep a fixed rate, without catching up on missed samples
+        next_sample = max(next_sample + period, time.monotonic())
+        time.sleep(max(next_sample - time.monotonic(), 0))
+    # SIGTERM/SIGINT end the loop above, write whatever is still buffered
+    database.close()
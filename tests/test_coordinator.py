@@ -0,0 +1,114 @@
+import os, sys, socket, asyncio, threading, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import coordinator
+from coordinator import Coordinator, AgentClient
+from endpoint import Endpoint
+from failures import DEFAULT_TIMEOUT
+from plan import PlannedExperiment, PlannedRun
+
+# seconds to wait for the coordinator to finish serving
+WAIT = 10
+
+
+class FakeWriter():
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement: str, row: tuple):
+        self.statements.append((statement, row))
+
+
+def experiment(experiment_id: int, condition: str, run_ids: list) -> PlannedExperiment:
+    planned = PlannedExperiment(experiment_id, Endpoint("https://example.com/1kb", None, None), condition, False)
+    planned.runs = [PlannedRun(run_id, "chromium", run_id % 2 == 0) for run_id in run_ids]
+    return planned
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.recorded = []
+        self.coordinator = Coordinator([experiment(1, "4g-lte-good", [10, 11]), experiment(2, "3g-unts-good", [20])],
+                                       lambda experiment, run, results, spans: self.recorded.append(run.run_id),
+                                       FakeWriter(), lease_timeout=60)
+
+    def test_leases_the_runs_of_the_agents_condition(self):
+        self.assertEqual(self.coordinator.lease("a", 0, "3g-unts-good")["runID"], 20)
+        self.assertEqual(self.coordinator.lease("a", 0, "3g-unts-good")["runID"], 10)
+        reply = self.coordinator.lease("b", 1, None)
+        self.assertEqual((reply["type"], reply["runID"], reply["condition"]), ("run", 11, "4g-lte-good"))
+        self.assertEqual(reply["timeout"], DEFAULT_TIMEOUT)
+
+    def test_wait_until_done(self):
+        leased = [self.coordinator.lease("a", 0, None)["runID"] for _ in range(3)]
+        self.assertEqual(self.coordinator.lease("a", 0, None)["type"], "wait")
+        for run_id in leased:
+            self.assertTrue(self.coordinator.complete("a", run_id, {}, []))
+        self.assertEqual(self.coordinator.lease("a", 0, None)["type"], "done")
+        self.assertTrue(self.coordinator.finished.is_set())
+        self.assertEqual(sorted(self.recorded), [10, 11, 20])
+
+    def test_expired_lease_is_reissued(self):
+        run_id = self.coordinator.lease("a", 0, None)["runID"]
+        self.coordinator.leases[run_id].deadline = 0
+        self.assertEqual(self.coordinator.lease("b", 1, None)["runID"], run_id)
+        self.assertEqual(self.coordinator.leases[run_id].agent, "b")
+
+    def test_disconnected_agent_leases_are_reissued(self):
+        run_id = self.coordinator.lease("a", 0, None)["runID"]
+        other = self.coordinator.lease("b", 1, None)["runID"]
+        self.coordinator.expire(0)
+        self.assertEqual(set(self.coordinator.leases), {other})
+        self.assertEqual(self.coordinator.lease("c", 2, None)["runID"], run_id)
+
+    def test_results_are_recorded_once(self):
+        run_id = self.coordinator.lease("a", 0, None)["runID"]
+        self.coordinator.leases[run_id].deadline = 0
+        self.coordinator.expire()
+        # the lease expired, but no other agent completed the run yet
+        self.assertTrue(self.coordinator.complete("a", run_id, {}, []))
+        self.assertNotIn(run_id, [run.run_id for _, run in self.coordinator.pending])
+        self.assertFalse(self.coordinator.complete("b", run_id, {}, []))
+        self.assertFalse(self.coordinator.complete("a", 99, {}, []))
+        self.assertEqual(self.recorded, [run_id])
+
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        coordinator.WAIT_SECONDS, self.wait_seconds = 0.05, coordinator.WAIT_SECONDS
+
+    def tearDown(self):
+        coordinator.WAIT_SECONDS = self.wait_seconds
+
+    def test_agent_does_the_plan(self):
+        recorded = {}
+        served = Coordinator([experiment(1, "4g-lte-good", [10, 11])],
+                             lambda experiment, run, results, spans: recorded.setdefault(run.run_id, results),
+                             FakeWriter(), lease_timeout=60)
+        port = free_port()
+        thread = threading.Thread(target=asyncio.run, args=(served.serve("127.0.0.1", port),), daemon=True)
+        thread.start()
+        agent = AgentClient(f"127.0.0.1:{port}", "agent", connect_timeout=WAIT)
+        try:
+            while True:
+                reply = agent.lease("4g-lte-good")
+                if reply["type"] == "done":
+                    break
+                self.assertEqual(reply["type"], "run")
+                self.assertTrue(agent.complete(reply["runID"], {"server": "test"}, []))
+        finally:
+            agent.close()
+        thread.join(WAIT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(recorded, {10: {"server": "test"}, 11: {"server": "test"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os, sys, time, shutil, sqlite3, asyncio, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import experiment_utils
+from experiment_utils import ThreadedWriter, insert_statement
+
+# seconds to wait for the writer thread to write the rows
+WAIT = 10
+
+
+def span_row(span_id: int) -> tuple:
+    return (1, 1, span_id, None, "run", 0.0, 1.0, 1, 1, None)
+
+
+def count_spans(out: str) -> int:
+    db = sqlite3.connect(out)
+    try:
+        return db.execute("SELECT count(*) FROM spans").fetchone()[0]
+    finally:
+        db.close()
+
+
+"""
+A writer whose flush fails the given number of times before it succeeds
+"""
+class FlakyWriter():
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.num_pending = 1
+        self.flushed = False
+        self.flushed_each = False
+
+    def flush(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        self.flushed = True
+
+    def flush_each(self):
+        self.flushed_each = True
+
+
+class ThreadedWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.out = os.path.join(self.root, "results.db")
+        experiment_utils.RETRY_DELAY, self.delay = 0, experiment_utils.RETRY_DELAY
+        self.writer = ThreadedWriter(self.out, flush_size=1000, flush_interval=60)
+
+    def tearDown(self):
+        self.writer.close()
+        experiment_utils.RETRY_DELAY = self.delay
+        shutil.rmtree(self.root)
+
+    def test_close_writes_queued_rows(self):
+        for span_id in range(10):
+            self.writer.insert("spans", span_row(span_id))
+        asyncio.run(self.writer.insert_async("spans", span_row(10)))
+        self.writer.close()
+        self.assertEqual(count_spans(self.out), 11)
+
+    def test_flush_writes_without_closing(self):
+        self.writer.insert("spans", span_row(1))
+        self.writer.flush()
+        deadline = time.monotonic() + WAIT
+        while count_spans(self.out) == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(count_spans(self.out), 1)
+        self.assertTrue(self.writer.thread.is_alive())
+
+    def test_retry_recovers(self):
+        writer = FlakyWriter(experiment_utils.FLUSH_RETRIES - 1)
+        self.writer.retry(writer, sqlite3.OperationalError("database is locked"))
+        self.assertTrue(writer.flushed)
+        self.assertFalse(writer.flushed_each)
+
+    def test_retry_gives_up_statement_by_statement(self):
+        writer = FlakyWriter(experiment_utils.FLUSH_RETRIES)
+        self.writer.retry(writer, sqlite3.OperationalError("database is locked"))
+        self.assertFalse(writer.flushed)
+        self.assertTrue(writer.flushed_each)
+
+    def test_failing_statement_keeps_the_other_rows(self):
+        self.writer.execute_group([("INSERT INTO missing (a) VALUES (?)", (1,)),
+                                   (insert_statement("spans"), span_row(1))])
+        self.writer.close()
+        self.assertEqual(count_spans(self.out), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from failures import FailureTracker, CLOSED, OPEN, HALF_OPEN, COOLDOWN, DEFAULT_TIMEOUT, MIN_SAMPLES, MIN_TIMEOUT, MAX_TIMEOUT
+
+CONDITION = "4g-lte-good"
+
+
+class FakeEndpoint():
+    def __init__(self, url: str):
+        self.url = url
+
+    def get_url(self) -> str:
+        return self.url
+
+
+def loaded(load_time: float) -> dict:
+    return {"startTime": 0, "loadEventEnd": load_time}
+
+
+def failed() -> dict:
+    return {"error": "net::ERR_CONNECTION_REFUSED"}
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = FailureTracker(max_failures=3)
+        self.endpoint = FakeEndpoint("https://example.com/1kb")
+        self.key = self.tracker.key(self.endpoint, "chromium", True, CONDITION)
+
+    def add(self, results: dict):
+        self.tracker.add(self.endpoint, "chromium", True, CONDITION, results)
+
+    def allow(self) -> bool:
+        return self.tracker.allow(self.endpoint, "chromium", True, CONDITION)
+
+    def test_opens_after_failures_in_a_row(self):
+        self.add(failed())
+        self.add(failed())
+        self.add(loaded(100))
+        self.add(failed())
+        self.add(failed())
+        self.assertTrue(self.allow())
+        self.add(failed())
+        self.assertEqual(self.tracker.breakers[self.key].state, OPEN)
+        self.assertFalse(self.allow())
+        # other combinations are not affected
+        self.assertTrue(self.tracker.allow(self.endpoint, "chromium", False, CONDITION))
+
+    def test_trial_run_after_cooldown(self):
+        for _ in range(3):
+            self.add(failed())
+        self.tracker.breakers[self.key].reopen = 0
+        self.assertTrue(self.allow())
+        self.assertEqual(self.tracker.breakers[self.key].state, HALF_OPEN)
+        # a single trial run
+        self.assertFalse(self.allow())
+        self.add(failed())
+        breaker = self.tracker.breakers[self.key]
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.cooldown, 2 * COOLDOWN)
+        breaker.reopen = 0
+        self.assertTrue(self.allow())
+        self.add(loaded(100))
+        self.assertEqual(self.tracker.breakers[self.key].state, CLOSED)
+        self.assertTrue(self.allow())
+
+    def test_disabled(self):
+        tracker = FailureTracker(max_failures=0)
+        for _ in range(10):
+            tracker.add(self.endpoint, "chromium", True, CONDITION, failed())
+        self.assertTrue(tracker.allow(self.endpoint, "chromium", True, CONDITION))
+
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = FailureTracker(factor=3)
+        self.endpoint = FakeEndpoint("https://example.com/1kb")
+
+    def timeout(self, endpoint=None, browser: str = "chromium", h3: bool = True) -> float:
+        return self.tracker.timeout(endpoint or self.endpoint, browser, h3, CONDITION)
+
+    def test_default_until_enough_samples(self):
+        for _ in range(MIN_SAMPLES - 1):
+            self.tracker.add(self.endpoint, "chromium", True, CONDITION, loaded(5000))
+        self.assertEqual(self.timeout(), DEFAULT_TIMEOUT)
+        self.tracker.add(self.endpoint, "chromium", True, CONDITION, loaded(5000))
+        self.assertAlmostEqual(self.timeout(), 15000, delta=15000 * 0.05)
+
+    def test_clamped(self):
+        fast, slow = FakeEndpoint("https://example.com/fast"), FakeEndpoint("https://example.com/slow")
+        for _ in range(MIN_SAMPLES):
+            self.tracker.add(fast, "chromium", True, CONDITION, loaded(10))
+            self.tracker.add(slow, "chromium", True, CONDITION, loaded(120000))
+        self.assertEqual(self.timeout(fast), MIN_TIMEOUT)
+        self.assertEqual(self.timeout(slow), MAX_TIMEOUT)
+
+    def test_timeouts_count_at_their_timeout(self):
+        for _ in range(MIN_SAMPLES):
+            self.tracker.add(self.endpoint, "chromium", True, CONDITION, {"error": "Timeout", "timedOut": 40000})
+        self.assertAlmostEqual(self.timeout(), 120000, delta=120000 * 0.05)
+
+    def test_falls_back_to_the_same_endpoint_only(self):
+        for _ in range(MIN_SAMPLES):
+            self.tracker.add(self.endpoint, "firefox", False, CONDITION, loaded(5000))
+        # another browser and HTTP version of the same endpoint/payload under the same condition
+        self.assertAlmostEqual(self.timeout(browser="chromium", h3=True), 15000, delta=15000 * 0.05)
+        # never another payload
+        self.assertEqual(self.timeout(FakeEndpoint("https://example.com/5mb")), DEFAULT_TIMEOUT)
+        self.assertEqual(self.tracker.timeout(self.endpoint, "chromium", True, "3g-unts-good"), DEFAULT_TIMEOUT)
+
+
+if __name__ == "__main__":
+    unittest.main()
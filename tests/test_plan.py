@@ -0,0 +1,89 @@
+import os, sys, shutil, sqlite3, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from endpoint import Endpoint
+from plan import COMPLETE_RUN, plan_key, create_plan, find_plan, load_plan
+
+BROWSERS = ["chromium", "firefox"]
+CONDITIONS = ["4g-lte-good", "3g-unts-good"]
+RUNS = 3
+
+
+def plan_rows(out: str, plan_id: int) -> list:
+    db = sqlite3.connect(out)
+    try:
+        return db.execute("SELECT experimentID, runID, condition, browser, h3, repetition FROM plan WHERE planID = ? ORDER BY experimentID, position",
+                          (plan_id,)).fetchall()
+    finally:
+        db.close()
+
+
+def complete(out: str, run_ids: list):
+    db = sqlite3.connect(out)
+    try:
+        db.executemany(COMPLETE_RUN, [(run_id,) for run_id in run_ids])
+        db.commit()
+    finally:
+        db.close()
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.out = os.path.join(self.root, "results.db")
+        self.endpoints = [Endpoint("https://example.com/1kb", None, None), Endpoint("https://example.com/10kb", None, None)]
+        self.key = plan_key(self.endpoints, CONDITIONS, BROWSERS, RUNS)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create(self, rounds: bool = False) -> int:
+        return create_plan(self.out, self.key, self.endpoints, CONDITIONS, BROWSERS, RUNS, rounds)
+
+    def test_one_experiment_per_endpoint_and_condition(self):
+        rows = plan_rows(self.out, self.create())
+        self.assertEqual(len(rows), len(self.endpoints) * len(CONDITIONS) * len(BROWSERS) * 2 * RUNS)
+        self.assertEqual(len({row[0] for row in rows}), len(self.endpoints) * len(CONDITIONS))
+        self.assertEqual(len({row[1] for row in rows}), len(rows))
+
+    def test_later_plans_get_new_ids(self):
+        first = plan_rows(self.out, self.create())
+        second = plan_rows(self.out, self.create())
+        self.assertGreater(min(row[0] for row in second), max(row[0] for row in first))
+        self.assertGreater(min(row[1] for row in second), max(row[1] for row in first))
+
+    def test_rounds_run_every_combination_once(self):
+        rows = plan_rows(self.out, self.create(rounds=True))
+        per_experiment = 2 * len(BROWSERS) * RUNS
+        for start in range(0, len(rows), per_experiment):
+            experiment = rows[start:start + per_experiment]
+            for repetition in range(RUNS):
+                round_rows = experiment[repetition * 2 * len(BROWSERS):(repetition + 1) * 2 * len(BROWSERS)]
+                self.assertEqual({row[5] for row in round_rows}, {repetition})
+                self.assertEqual(len({(row[3], row[4]) for row in round_rows}), 2 * len(BROWSERS))
+
+    def test_resume_loads_the_runs_left(self):
+        plan_id = self.create()
+        rows = plan_rows(self.out, plan_id)
+        done = [row[1] for row in rows if row[0] == rows[0][0]][:2]
+        complete(self.out, done)
+        self.assertEqual(find_plan(self.out, self.key), plan_id)
+        experiments = load_plan(self.out, plan_id, self.endpoints)
+        self.assertEqual(len(experiments), len(self.endpoints) * len(CONDITIONS))
+        runs = [run.run_id for experiment in experiments for run in experiment.runs]
+        self.assertEqual(len(runs), len(rows) - len(done))
+        self.assertFalse(set(done) & set(runs))
+        self.assertEqual([experiment.started for experiment in experiments].count(True), 1)
+        self.assertTrue(experiments[0].started)
+
+    def test_finished_plans_are_not_resumed(self):
+        plan_id = self.create()
+        self.assertIsNone(find_plan(self.out, plan_key(self.endpoints, CONDITIONS, BROWSERS, RUNS + 1)))
+        complete(self.out, [row[1] for row in plan_rows(self.out, plan_id)])
+        self.assertIsNone(find_plan(self.out, self.key))
+        self.assertEqual(load_plan(self.out, plan_id, self.endpoints), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import io, os, sys, json, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quic_metrics import JsonStream, parse_qlog, parse_netlog, log_info, run_at, ingest_file
+
+# milliseconds since the epoch of the logs' time 0
+TIME_ORIGIN = 1700000000000
+EVENT_TYPES = {"QUIC_SESSION": 1, "QUIC_SESSION_PACKET_SENT": 2, "QUIC_SESSION_PACKET_RECEIVED": 3,
+               "QUIC_SESSION_PACKET_LOST": 4, "URL_REQUEST_START_JOB": 5}
+
+
+"""
+A neqo (draft-01) qlog with one trace: the client sends an initial packet, gets the
+server's 25 ms later, and loses one packet
+"""
+def qlog(time_units: str = "ms") -> str:
+    scale = 1000 if time_units == "us" else 1
+    return json.dumps({"qlog_version": "draft-01", "traces": [{
+        "common_fields": {"reference_time": str(TIME_ORIGIN)},
+        "configuration": {"time_units": time_units},
+        "event_fields": ["relative_time", "category", "event", "data"],
+        "events": [
+            [str(100 * scale), "transport", "packet_sent", {"header": {"packet_type": "initial"},
+                                                           "frames": [{"frame_type": "stream", "stream_id": 0}]}],
+            [str(125 * scale), "transport", "packet_received", {"header": {"packet_type": "initial"}}],
+            [str(130 * scale), "recovery", "metrics_updated", {"smoothed_rtt": 25, "min_rtt": 24, "congestion_window": 12000}],
+            [str(140 * scale), "recovery", "packet_lost", {}],
+        ],
+    }]})
+
+
+"""
+A netlog with a QUIC session starting at each of the given times (in milliseconds), and an
+event of another source
+"""
+def netlog(times: list) -> str:
+    events = [{"type": 5, "time": "0", "source": {"id": 1}, "params": {}}]
+    for source, time in enumerate(times, 2):
+        events += [
+            {"type": 1, "time": str(time), "source": {"id": source}, "phase": 1, "params": {}},
+            {"type": 2, "time": str(time + 10), "source": {"id": source}, "params": {"encryption_level": "ENCRYPTION_INITIAL"}},
+            {"type": 3, "time": str(time + 40), "source": {"id": source}, "params": {}},
+            {"type": 4, "time": str(time + 50), "source": {"id": source}, "params": {}},
+        ]
+    return json.dumps({"constants": {"logEventTypes": EVENT_TYPES, "timeTickOffset": str(TIME_ORIGIN)}, "events": events})
+
+
+class JsonStreamTest(unittest.TestCase):
+    def test_find_across_chunks(self):
+        document = json.dumps({"padding": "x" * 50, "constants": {"a": [1, 2, 3]}, "events": list(range(20))})
+        stream = JsonStream(io.StringIO(document), chunk_size=7)
+        self.assertEqual(stream.find("constants"), "constants")
+        self.assertEqual(stream.value(), {"a": [1, 2, 3]})
+        self.assertEqual(stream.find("events"), "events")
+        self.assertEqual(list(stream.array()), list(range(20)))
+        self.assertIsNone(stream.find("constants"))
+
+    def test_number_at_the_end_of_a_chunk(self):
+        stream = JsonStream(io.StringIO('{"value": 1234567890}'), chunk_size=12)
+        stream.find("value")
+        self.assertEqual(stream.value(), 1234567890)
+
+    def test_truncated_array(self):
+        stream = JsonStream(io.StringIO('{"events": [1, 2, {"a": '), chunk_size=4)
+        stream.find("events")
+        elements = stream.array()
+        self.assertEqual(next(elements), 1)
+        self.assertEqual(next(elements), 2)
+        with self.assertRaises(ValueError):
+            next(elements)
+
+
+class ParseTest(unittest.TestCase):
+    def test_qlog(self):
+        for time_units in ("ms", "us"):
+            [connection] = parse_qlog(io.StringIO(qlog(time_units)))
+            row = connection.row("1", 2, "firefox", "x.qlog")
+            self.assertEqual(row[5:], (25.0, 25.0, 24.0, 12000, 1, 1, 1, 0, False, 1))
+            self.assertAlmostEqual(connection.start_time(), (TIME_ORIGIN + 100) / 1000)
+
+    def test_netlog(self):
+        connections = parse_netlog(io.StringIO(netlog([1000, 5000])))
+        self.assertEqual([connection.connection for connection in connections], ["2", "3"])
+        self.assertEqual(connections[0].row("1", None, "chromium", "x.netlog")[5:13], (30.0, None, None, None, 1, 1, 1, 0))
+        self.assertEqual([connection.start_time() for connection in connections],
+                         [(TIME_ORIGIN + 1000) / 1000, (TIME_ORIGIN + 5000) / 1000])
+
+    def test_truncated_netlog(self):
+        document = netlog([1000])
+        connections = parse_netlog(io.StringIO(document[:document.rindex("{")]))
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(connections[0].received, 1)
+
+
+class AttributionTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        self.directory = os.path.join("results", "qlogs", "sync-7", "chromium")
+        os.makedirs(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def write(self, name: str, content: str) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_log_info(self):
+        self.assertEqual(log_info("results/qlogs/sync-7/chromium/12.netlog"), ("7", "chromium", 12))
+        self.assertEqual(log_info("results/qlogs/async-7/firefox/1700000000-0.qlog"), ("7", "firefox", None))
+        self.assertEqual(log_info("results/qlogs/sync-7/edge/warm-12.netlog"), ("7", "edge", None))
+        self.assertIsNone(log_info("results/qlogs/sync-7/chromium/12.json"))
+
+    def test_run_at(self):
+        windows = [(10.0, 20.0, 1), (15.0, 30.0, 2)]
+        self.assertEqual(run_at(windows, 12.0), 1)
+        # overlapping windows: the run that started last
+        self.assertEqual(run_at(windows, 16.0), 2)
+        self.assertIsNone(run_at(windows, 31.0))
+        self.assertIsNone(run_at(windows, None))
+
+    def test_named_log_keeps_its_run(self):
+        path = self.write("12.netlog", netlog([1000]))
+        rows = ingest_file(path, [(0.0, 1e10, 99)])
+        self.assertEqual([row[:4] for row in rows], [("7", 12, "chromium", path)])
+
+    def test_shared_log_is_split_by_start_time(self):
+        path = self.write("warm-12.netlog", netlog([1000, 5000, 9000]))
+        origin = TIME_ORIGIN / 1000
+        windows = [(origin, origin + 3, 12), (origin + 4, origin + 6, 13)]
+        self.assertEqual([row[1] for row in ingest_file(path, windows)], [12, 13, None])
+        self.assertEqual([row[1] for row in ingest_file(path)], [None, None, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os, sys, time, shutil, tempfile, textwrap, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ssh_utils
+
+# seconds to wait for the fake server scripts to write their files
+WAIT = 10
+
+
+"""
+A fake server checkout: restart-all.sh records that it ran, and systemUtil.py records its
+arguments and waits for the SIGINT of end_server_monitoring
+"""
+def fake_server(root: str):
+    os.makedirs(os.path.join(root, "install"))
+    restart = os.path.join(root, "install", "restart-all.sh")
+    with open(restart, "w") as f:
+        f.write("#!/bin/bash\ntouch ../restarted\n")
+    os.chmod(restart, 0o755)
+    with open(os.path.join(root, "systemUtil.py"), "w") as f:
+        f.write(textwrap.dedent("""
+            import sys, time
+            try:
+                with open("monitoring", "w") as f:
+                    f.write(" ".join(sys.argv[1:]))
+                while True:
+                    time.sleep(0.1)
+            except KeyboardInterrupt:
+                open("stopped", "w").close()
+        """))
+
+
+def wait_for(file: str) -> bool:
+    deadline = time.monotonic() + WAIT
+    while time.monotonic() < deadline:
+        if os.path.exists(file):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class OffServerEndpoint():
+    def is_on_server(self) -> bool:
+        return False
+
+
+class LocalServerMonitoringTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        fake_server(self.root)
+        ssh_utils.use_local_server(self.root)
+
+    def tearDown(self):
+        ssh_utils.close_session()
+        shutil.rmtree(self.root)
+
+    def test_monitors_every_endpoint(self):
+        self.assertTrue(ssh_utils.monitors_server(OffServerEndpoint()))
+        ssh_utils.close_session()
+        self.assertFalse(ssh_utils.monitors_server(OffServerEndpoint()))
+
+    def test_start_and_end_monitoring(self):
+        monitor = ssh_utils.start_server_monitoring("7", "results/results.db")
+        self.assertIsNotNone(monitor)
+        self.assertTrue(os.path.exists(os.path.join(self.root, "restarted")))
+        self.assertTrue(wait_for(os.path.join(self.root, "monitoring")))
+        with open(os.path.join(self.root, "monitoring")) as f:
+            self.assertEqual(f.read(), "7 server results/results.db")
+        ssh_utils.end_server_monitoring(monitor)
+        self.assertIsNotNone(monitor.poll())
+        self.assertTrue(wait_for(os.path.join(self.root, "stopped")))
+
+    def test_missing_checkout(self):
+        ssh_utils.use_local_server(os.path.join(self.root, "missing"))
+        ssh_utils.RETRY_DELAY, delay = 0, ssh_utils.RETRY_DELAY
+        try:
+            self.assertIsNone(ssh_utils.start_server_monitoring("7", "results/results.db"))
+        finally:
+            ssh_utils.RETRY_DELAY = delay
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""Run Lifecycle Tracing
+
+Spans time the stages of the harness (launching a browser, shaping, goto, writing results,
+...) with the monotonic clock. Each span knows the experiment and run it belongs to and its
+parent span, so a slow run can be broken down afterwards. Recording a span is two clock
+reads and appending a tuple to a deque, so tracing stays on during sweeps; the finished
+spans are drained into the spans table of the results database along with the results.
+
+The run and the parent span are kept in context variables, so spans opened in concurrent
+asyncio tasks (the async workers) or threads do not mix.
+
+This script exports the spans of a results database as Chrome trace-event JSON, which can
+be opened in chrome://tracing or https://ui.perfetto.dev (one track per run).
+
+Usage:
+    tracing.py DB OUT [--experiment EXPERIMENT]
+
+Options:
+    -h --help                 Show this screen
+    --experiment EXPERIMENT   Only export the spans of this experiment
+"""
+
+import os, json, time, sqlite3, inspect, threading, itertools, contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import List, Optional
+from docopt import docopt
+
+"""
+Headers/columns of the spans table. `startTime` and `endTime` are monotonic seconds,
+comparable between the processes of a machine. `error` is the name of the exception
+that ended the span, if any.
+"""
+spans_fmt = {
+    "experimentID" : "INTEGER",
+    "runID" : "INTEGER",
+    "spanID" : "INTEGER",
+    "parentID" : "INTEGER",
+    "name" : "TEXT",
+    "startTime" : "REAL",
+    "endTime" : "REAL",
+    "pid" : "INTEGER",
+    "thread" : "INTEGER",
+    "error" : "TEXT",
+}
+
+# (experiment ID, run ID) of the code running in this context
+current_run = contextvars.ContextVar("current_run", default=(None, None))
+# ID of the innermost open span of this context
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer():
+    def __init__(self):
+        self.enabled = True
+        self.pid = os.getpid()
+        # finished spans, as rows of the spans table; deques are safe to use from several threads
+        self.finished = deque()
+        self.ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        span_id = next(self.ids)
+        token = current_span.set(span_id)
+        error = None
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            end = time.monotonic()
+            current_span.reset(token)
+            experiment_id, run_id = current_run.get()
+            self.finished.append((experiment_id, run_id, span_id, current_span.get(), name, start, end,
+                                  self.pid, threading.get_ident(), error))
+
+    """
+    Return the spans finished since the last call, removing them from the tracer
+    """
+    def drain(self) -> List[tuple]:
+        rows = []
+        while self.finished:
+            rows.append(self.finished.popleft())
+        return rows
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+"""
+Attribute the spans opened in this context to the given experiment and run
+"""
+@contextmanager
+def run_context(experiment_id, run_id: Optional[int] = None):
+    token = current_run.set((experiment_id, run_id))
+    try:
+        yield
+    finally:
+        current_run.reset(token)
+
+
+"""
+Decorator recording a span for every call of a function or coroutine function
+"""
+def traced(name: str):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+"""
+Return the Chrome trace-event JSON of the given rows of the spans table: one complete
+event per span, on the track of its run (or of its thread, outside of runs)
+"""
+def chrome_trace(rows: List[tuple]) -> dict:
+    events = []
+    tracks = set()
+    for experiment_id, run_id, span_id, parent_id, name, start, end, pid, thread, error in rows:
+        tid = run_id if run_id is not None else thread
+        events.append({
+            "name": name,
+            "cat": "harness",
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": tid,
+            "args": {"experimentID": experiment_id, "runID": run_id, "spanID": span_id, "parentID": parent_id, "error": error},
+        })
+        if (pid, tid) not in tracks:
+            tracks.add((pid, tid))
+            track_name = f"run {run_id}" if run_id is not None else f"thread {thread}"
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track_name}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+"""
+Write the spans of the given results database to `out` as Chrome trace-event JSON,
+only those of the given experiments if any
+"""
+def export_chrome_trace(database: str, out: str, experiment_ids: Optional[List[int]] = None):
+    db = sqlite3.connect(database, timeout=30)
+    query = f"SELECT {', '.join(spans_fmt.keys())} FROM spans"
+    params = []
+    if experiment_ids is not None:
+        query += f" WHERE experimentID IN ({', '.join('?' * len(experiment_ids))})"
+        params = [int(experiment_id) for experiment_id in experiment_ids]
+    rows = db.execute(query + " ORDER BY startTime", params).fetchall()
+    db.close()
+    with open(out, "w") as f:
+        json.dump(chrome_trace(rows), f)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    experiment = args['--experiment']
+    export_chrome_trace(args['DB'], args['OUT'], [experiment] if experiment is not None else None)
@@ -3,6 +3,8 @@ import numpy as np
 import pandas as pd
 import argparse
 
+from analysis import PHASES, StreamingAnalysis
+
 
 def cleanData(cvsFile):
     # original_data = np.genfromtxt(cvsFile, delimiter=',', 
@@ -18,16 +20,7 @@ def cleanData(cvsFile):
     return h3_data, h2_data
 
 def processData(data):
-    app_fetch = data.domainLookupStart - data.fetchStart
-    dnc = data.domainLookupEnd - data.domainLookupStart
-    secure_connection_start = data.secureConnectionStart - data.connectStart
-    tcp_connection = data.connectEnd - data.connectStart
-    request = data.responseStart - data.requestStart
-    response = data.responseEnd - data.responseStart
-    processing = data.domComplete - data.responseEnd
-    onload = data.loadEventEnd - data.loadEventStart
-    page_load = data.domInteractive - data.startTime
-    return [app_fetch, dnc, secure_connection_start, tcp_connection, request, response, processing, onload, page_load]
+    return [data[end] - data[start] for end, start in PHASES.values()]
 
 # take a dataframe of one column, return a sorted numpy array
 def sortData(data):
@@ -35,14 +28,20 @@ def sortData(data):
     data = np.sort(data)
     return data
 
+# the percentile of each value of a sorted array
+def percentiles(data):
+    length = data.size
+    return [i/length for i in range(length)]
+
 def plotCDF(h3_data, h2_data, outputFileName, plotName):
     h3_data = sortData(h3_data)
     h2_data = sortData(h2_data)
-    length = h3_data.size
-    y = [i/length for i in range(length)]
+    plotPoints(h3_data, percentiles(h3_data), h2_data, percentiles(h2_data), outputFileName, plotName)
+
+def plotPoints(h3_x, h3_y, h2_x, h2_y, outputFileName, plotName):
     _, ax = plt.subplots()
-    ax.scatter(h3_data, y, c = 'tab:purple', label='HTTP/3', linestyle='solid')
-    ax.scatter(h2_data, y, c = 'tab:olive', label= 'HTTP/2', linestyle='solid')
+    ax.scatter(h3_x, h3_y, c = 'tab:purple', label='HTTP/3', linestyle='solid')
+    ax.scatter(h2_x, h2_y, c = 'tab:olive', label= 'HTTP/2', linestyle='solid')
     plt.xlabel('Time (ms)')
     plt.ylabel('Percentile')
     plt.title('Cumulative Distribution of '+plotName)
@@ -50,7 +49,25 @@ def plotCDF(h3_data, h2_data, outputFileName, plotName):
     ax.legend()
     plt.savefig(outputFileName+plotName+'png')
 
+# plot the CDFs from the summaries of the database, updated with the new runs first
+def plotDatabase(database, outputFileName):
+    analysis = StreamingAnalysis(database)
+    analysis.update()
+    versions = analysis.grouped(["httpVersion"])
+    for event in PHASES:
+        points = {}
+        for version in ["h3", "h2"]:
+            stats = versions.get((version,))
+            cdf = stats.phases[event].sketch.cdf() if stats else []
+            points[version] = ([x for x, _ in cdf], [y for _, y in cdf])
+        plotPoints(*points["h3"], *points["h2"], outputFileName, event)
+
 def main(args):
+    if args.db:
+        for i, database in enumerate(args.db):
+            plotDatabase(database, args.output[i])
+        return
+
     dataList = args.dir
     outputList = args.output
 
@@ -60,7 +77,7 @@ def main(args):
         h3_event_data = processData(h3_data)
         h2_event_data = processData(h2_data)
         
-        for j, event in enumerate(['App_Fetch', 'DNC_Lookup', 'Secure_Connection_Start', 'TCP_Connection', 'Request', 'Response', 'Processing', 'Onload', 'Page_Load']):
+        for j, event in enumerate(PHASES):
 
             plotCDF(h3_event_data[j], h2_event_data[j], outputList[i], event)
         
@@ -118,9 +135,12 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="basic vitualization for data specified")
-    parser.add_argument("--dir", "-d", metavar = "FILE", required = True, action = "append",
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument("--dir", "-d", metavar = "FILE", action = "append",
                         # type = argparse.FileType('r'),
                         help = "read data from FILE")
+    source.add_argument("--db", metavar = "FILE", action = "append",
+                        help = "read the summaries of the results database FILE (see analysis.py)")
     parser.add_argument("--output", "-o", metavar="FILE", required=True, action = "append",
                         # type = argparse.FileType('wb'),
                         help="save output to FILE")
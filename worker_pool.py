@@ -0,0 +1,156 @@
+import os, time, queue, signal, multiprocessing
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+from playwright.sync_api import sync_playwright
+
+from endpoint import Endpoint
+from browser_pool import BrowserPool
+from run_resources import RunResourceTracker
+from launchBrowserSync import launch_browser_sync
+from tracing import tracer, span, run_context
+from failures import DEFAULT_TIMEOUT
+
+import logging
+logger = logging.getLogger('__main__.' + __name__)
+
+"""
+A pool of worker processes doing page loads.
+
+In async mode every browser's protocol traffic and the handling of every result go through
+one event loop and one Playwright driver, so with many page loads in flight the loop's lag
+leaks into the measured timings. Here each worker process owns its own sync Playwright
+instance, browser pool and resource tracker, and takes runs off a shared task queue; the
+results (with the spans of the run) go back on a single result queue to the parent, which
+is the only one writing to the database, applying the network condition and capturing
+packets.
+
+Workers are spawned rather than forked: by the time they start, the parent runs the
+database writer, ingest and tracker threads, and forking a process with threads can leave
+locks held forever in the child. Spawned workers do not inherit the logging handlers, so
+they append to the parent's log file themselves. They ignore SIGINT, the parent resets tc
+and stops them.
+"""
+
+# seconds between two checks that the workers are still alive while waiting for a result
+RESULT_POLL = 5
+
+
+class Task(NamedTuple):
+    experiment_id: int
+    run_id: int
+    browser: str
+    h3: bool
+    endpoint: Endpoint
+    warmup: bool
+    qlog: bool
+    pcap: bool
+    # navigation timeout, milliseconds
+    timeout: float = DEFAULT_TIMEOUT
+
+
+def setup_logging(log_file: Optional[str]):
+    if log_file is None:
+        return
+    handler = logging.FileHandler(log_file)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter(f'%(asctime)s - %(levelname)s: [{os.getpid()}] %(message)s'))
+    main_logger = logging.getLogger('__main__')
+    main_logger.setLevel(logging.DEBUG)
+    main_logger.addHandler(handler)
+
+
+def worker(tasks: multiprocessing.Queue, results: multiprocessing.Queue, device: str, cold_launch: bool,
+           log_file: Optional[str]):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(log_file)
+    with sync_playwright() as p:
+        tracker = RunResourceTracker(device)
+        pool, pool_experiment = None, None
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            # warm browsers are shared by the runs of an experiment this worker gets
+            if task.experiment_id != pool_experiment:
+                if pool:
+                    pool.close()
+                pool, pool_experiment = BrowserPool(cold=cold_launch), task.experiment_id
+            with run_context(task.experiment_id, task.run_id), span("run"):
+                start = time.time()
+                try:
+                    result = launch_browser_sync(p, task.browser, task.h3, task.endpoint, task.warmup, task.qlog,
+                                                 task.pcap, task.experiment_id, task.run_id, pool, tracker, task.timeout)
+                except Exception as e:
+                    # a single failing page load must not take down the worker
+                    logger.error(str(e))
+                    result = {"error": str(e)}
+            # the wall-clock window of the run attributes its packets to it (see capture.py)
+            results.put((task, result, tracer.drain(), (start, time.time())))
+        if pool:
+            pool.close()
+
+
+class WorkerPool():
+    def __init__(self, workers: int, device: str, cold_launch: bool = False, log_file: Optional[str] = None):
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=worker, args=(self.tasks, self.results, device, cold_launch, log_file),
+                            name=f"page-load-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+        self.in_flight = 0
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def submit(self, task: Task):
+        self.tasks.put(task)
+        self.in_flight += 1
+
+    """
+    Return the next (task, result, spans, window) done by a worker, None when there is no run in flight.
+    Raise RuntimeError if every worker died.
+    """
+    def next_result(self) -> Optional[Tuple[Task, dict, List[tuple], Tuple[float, float]]]:
+        if self.in_flight == 0:
+            return None
+        while True:
+            try:
+                item = self.results.get(timeout=RESULT_POLL)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise RuntimeError("All page load workers died")
+                continue
+            self.in_flight -= 1
+            return item
+
+    """
+    Run the given tasks, keeping `2 * workers` of them queued so that no worker waits for the
+    parent, and yield their results as they are done. `tasks` is consumed lazily, so that it
+    can depend on the results already yielded.
+    """
+    def run(self, tasks: Iterator[Task]) -> Iterator[Tuple[Task, dict, List[tuple], Tuple[float, float]]]:
+        tasks = iter(tasks)
+        exhausted = False
+        while True:
+            while not exhausted and self.in_flight < 2 * len(self):
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                else:
+                    self.submit(task)
+            item = self.next_result()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()